@@ -0,0 +1,117 @@
+"""
+In-process cache of serialized /api/activities responses.
+
+A user's activities only change when something writes them (a sync, a
+webhook, a backfill page, a goal or Strava change), and every such write
+bumps Users.data_version in the same transaction. Responses are cached per
+user and request params, stamped with the data_version they were built
+from; the version each request loads with its user context decides whether
+they can be served. So a write committed by any process (the sync worker,
+another gunicorn worker) makes every worker's copies stale, without any
+message between processes or an extra query.
+
+Each process keeps at most MAX_ENTRIES responses and MAX_BYTES of them; the
+least recently used users' responses are evicted first.
+
+    body = get(user_id, data_version, params)
+    if body is None:
+        body = build_response()
+        put(user_id, data_version, params, body)
+"""
+import threading
+from collections import OrderedDict
+import metrics
+
+MAX_ENTRIES = 1024
+MAX_BYTES = 32 * 1024 * 1024
+
+# user_id -> (data_version, {params: body}), least recently used first
+_users = OrderedDict()
+_lock = threading.Lock()
+_entries = 0
+_bytes = 0
+_stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+
+
+def _drop(user_id):
+    """Forget a user's responses. Caller holds _lock."""
+    global _entries, _bytes
+    _, bodies = _users.pop(user_id)
+    _entries -= len(bodies)
+    _bytes -= sum(len(body) for body in bodies.values())
+    return len(bodies)
+
+
+def _count(stat, metric, labels, amount=1):
+    _stats[stat] += amount
+    metrics.inc(metric, labels, amount)
+
+
+def get(user_id, data_version, params):
+    """The cached response body for these params at this data_version, or None."""
+    with _lock:
+        entry = _users.get(user_id)
+        if entry is not None and entry[0] < data_version:
+            # Written since: nothing cached for this user is current any more
+            _count('invalidations', 'activity_cache_evictions_total', {'reason': 'stale'}, _drop(user_id))
+            entry = None
+        body = entry[1].get(params) if entry is not None and entry[0] == data_version else None
+        if body is None:
+            _count('misses', 'activity_cache_requests_total', {'result': 'miss'})
+            return None
+        _users.move_to_end(user_id)
+        _count('hits', 'activity_cache_requests_total', {'result': 'hit'})
+        return body
+
+
+def put(user_id, data_version, params, body):
+    """Cache a response body built from the user's data at data_version."""
+    global _entries, _bytes
+    if len(body) > MAX_BYTES:
+        return
+    with _lock:
+        entry = _users.get(user_id)
+        if entry is not None and entry[0] > data_version:
+            # Built by a request that loaded an older version; a newer one is cached
+            return
+        if entry is not None and entry[0] < data_version:
+            _count('invalidations', 'activity_cache_evictions_total', {'reason': 'stale'}, _drop(user_id))
+            entry = None
+        if entry is None:
+            entry = _users[user_id] = (data_version, {})
+        bodies = entry[1]
+        old = bodies.pop(params, None)
+        if old is not None:
+            _entries -= 1
+            _bytes -= len(old)
+        bodies[params] = body
+        _entries += 1
+        _bytes += len(body)
+        _users.move_to_end(user_id)
+
+        while _entries > MAX_ENTRIES or _bytes > MAX_BYTES:
+            evicted = next(iter(_users))
+            _count('evictions', 'activity_cache_evictions_total', {'reason': 'size'}, _drop(evicted))
+
+
+def invalidate(user_id=None):
+    """Forget one user's cached responses in this process, or everyone's."""
+    global _entries, _bytes
+    with _lock:
+        if user_id is None:
+            _users.clear()
+            _entries = _bytes = 0
+        elif user_id in _users:
+            _drop(user_id)
+
+
+def stats():
+    """This process's hit/miss/eviction counts and current size."""
+    with _lock:
+        return dict(_stats, users=len(_users), entries=_entries, bytes=_bytes)
+
+
+def reset_stats():
+    with _lock:
+        for key in _stats:
+            _stats[key] = 0
@@ -1,11 +1,19 @@
 import os
+import datetime
+import hashlib
 import logging
 import time
-from flask import Flask, render_template, redirect, url_for, request, flash, jsonify
+from flask import Flask, render_template, redirect, url_for, request, flash, jsonify, g
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
 from dotenv import load_dotenv
+import activity_cache
 import database
 import collector
+import metrics
+import passwords
+import payloads
+import streams
+import webhooks
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -14,6 +22,7 @@ logger = logging.getLogger(__name__)
 load_dotenv()
 
 app = Flask(__name__)
+app.json = payloads.JSONProvider(app)
 app.config['SECRET_KEY'] = os.getenv('FLASK_SECRET_KEY')
 
 # FLASK LOGIN STUFF
@@ -24,20 +33,77 @@ login_manager.login_view = 'login_page'
 login_manager.login_message = ""
 
 class User(UserMixin):
-    def __init__(self, id, username, last_sync_time=0 ):
+    def __init__(self, id, username, last_sync_time=0, has_strava=False, mileage_goal=0, long_run_goal=0,
+                 data_version=0, data_modified_at=0):
         self.id = id
         self.username = username
         self.last_sync_time = last_sync_time
+        self.has_strava = has_strava
+        self.mileage_goal = mileage_goal
+        self.long_run_goal = long_run_goal
+        self.data_version = data_version
+        self.data_modified_at = data_modified_at
         
 
+def get_user_context(user_id):
+    """The user's Users + Athletes fields, fetched with one query per request and memoized on flask.g."""
+    contexts = g.setdefault('user_contexts', {})
+    user_id = int(user_id)
+    if user_id not in contexts:
+        contexts[user_id] = database.get_user_context(user_id)
+    return contexts[user_id]
+
 @login_manager.user_loader
 def load_user(user_id):
-    user_row = database.get_user_by_id(user_id)
+    context = get_user_context(user_id)
     
-    if user_row:
-        return User(id=user_row['id'], username=user_row['username'],last_sync_time=user_row['last_sync_time'])
+    if context:
+        return User(
+            id=context['id'],
+            username=context['username'],
+            last_sync_time=context['last_sync_time'] or 0,
+            has_strava=context['has_strava'],
+            mileage_goal=context['mileage_goal'] or 0,
+            long_run_goal=context['long_run_goal'] or 0,
+            data_version=context.get('data_version') or 0,
+            data_modified_at=context.get('data_modified_at') or 0
+        )
     return None
 
+# METRICS
+
+# If set, /metrics requires "Authorization: Bearer <METRICS_TOKEN>"
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    start = g.pop('request_start', None)
+    if start is not None:
+        route = request.url_rule.rule if request.url_rule else '<unmatched>'
+        labels = {'route': route, 'method': request.method, 'status': str(response.status_code)}
+        metrics.observe('http_request_duration_seconds', labels, time.perf_counter() - start)
+        metrics.maybe_flush()
+    return response
+
+@app.route('/metrics')
+def get_metrics():
+    if METRICS_TOKEN and request.headers.get('Authorization') != f"Bearer {METRICS_TOKEN}":
+        return "Unauthorized\n", 401
+    return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+# A dashboard visit queues a sync when the last one is older than this. With a
+# Strava push subscription, new activities arrive by webhook and polling is a
+# once-a-day safety net.
+SYNC_STALE_SECONDS = 900
+WEBHOOK_SYNC_STALE_SECONDS = 24 * 3600
+
+def sync_stale_seconds():
+    return WEBHOOK_SYNC_STALE_SECONDS if webhooks.enabled() else SYNC_STALE_SECONDS
+
 # FRONTEND ROUTING
 
 @app.route('/')
@@ -45,12 +111,11 @@ def load_user(user_id):
 def dashboard():
     current_time = time.time()
     last_sync = current_user.last_sync_time
-    has_strava = database.user_has_strava(current_user.id)
+    has_strava = current_user.has_strava
 
-    if current_time - last_sync > 900:
-        collector.fetch_and_save_user_data(current_user.id)
-        database.update_last_sync_time(current_user.id)
-    
+    # The sync itself runs in sync_worker.py; the page polls /api/sync-status
+    if has_strava and current_time - last_sync > sync_stale_seconds():
+        database.enqueue_sync_job(current_user.id)
     
     return render_template('index.html', user=current_user, has_strava=has_strava)
 
@@ -68,18 +133,24 @@ def register_page():
 def login_action():
     username = request.form.get('username')
     password = request.form.get('password')
+
+    # Refuse guessing before spending any time hashing
+    if passwords.login_blocked(username, request.remote_addr):
+        flash("Too many failed attempts. Please try again later.")
+        return redirect(url_for('login_page'))
+
+    # Check DB for username and password hash in one lookup
+    user_row = database.authenticate(username, password)
     
-    # Check DB for username
-    user_row = database.get_user_by_username(username)
-    is_valid_password = database.validate_password(username, password)
-    
-    # Check Password Hash
-    if user_row and is_valid_password:
+    if user_row:
+        passwords.clear_failed_logins(username)
         user_obj = User(id=user_row['id'], username=user_row['username'])
         login_user(user_obj)
+        database.update_last_login_time(user_row['id'])
 
         return redirect(url_for('dashboard'))
         
+    passwords.record_failed_login(username, request.remote_addr)
     flash("Invalid credentials")
     return redirect(url_for('login_page'))
 
@@ -107,6 +178,7 @@ def register_action():
         
         user_obj = User(id=new_user_id, username=username)
         login_user(user_obj)
+        database.update_last_login_time(new_user_id)
         
         return redirect(url_for('dashboard'))
         
@@ -133,6 +205,10 @@ def logout_action():
 
 # STRAVA INTEGRATION STUFF
 
+# Views that wait on Strava during the request (the OAuth token exchange);
+# asgi.py runs them on their own thread pool so they can't hold up the rest
+STRAVA_BOUND_ENDPOINTS = {'strava_callback'}
+
 @app.route('/connect/strava')
 @login_required
 def connect_strava():
@@ -161,8 +237,9 @@ def strava_callback():
     
     try:
         collector.authorize_and_save_user(code, current_user.id)
-        collector.fetch_and_save_user_data(current_user.id)
-        database.update_last_sync_time(current_user.id)
+        database.enqueue_sync_job(current_user.id)
+        # The sync covers the last 30 days; sync_worker.py imports the rest of their history
+        database.enqueue_backfill(current_user.id)
         
         flash("Connected! Syncing your runs now...")
         return redirect(url_for('dashboard'))
@@ -170,22 +247,225 @@ def strava_callback():
         print(f"OAuth failed: {e}")
         return redirect(url_for('dashboard'))
 
+@app.route('/strava/webhook', methods=['GET'])
+def verify_strava_webhook():
+    challenge = webhooks.verify_subscription(request.args)
+    if challenge is None:
+        return jsonify({'error': 'verification failed'}), 403
+    return jsonify({'hub.challenge': challenge})
+
+@app.route('/strava/webhook', methods=['POST'])
+def receive_strava_webhook():
+    # Strava wants a 200 within 2 seconds, so only store the event; sync_worker.py applies it
+    if not webhooks.accept_event(request.get_json(silent=True)):
+        return jsonify({'error': 'invalid event'}), 400
+    return jsonify({'status': 'received'})
+
+# CONDITIONAL RESPONSES
+# The dashboard APIs only change when the user's data_version is bumped (new
+# activities, goal or Strava changes), so repeat requests are answered with 304
+# straight from the user context, without reading DailyMileage or the rollups.
+# /api/activities responses are also kept in activity_cache at that version,
+# for requests that don't have the ETag.
+
+def _data_etag(*params):
+    """Strong ETag for the current user's data at its current version, for these request params."""
+    key = ":".join(str(part) for part in (current_user.id, current_user.data_version) + params)
+    return hashlib.sha256(key.encode()).hexdigest()[:32]
+
+def _not_modified(etag):
+    """A 304 response if the client already has this ETag, else None."""
+    if request.if_none_match.contains(etag):
+        return _revalidate(app.response_class(status=304), etag)
+    return None
+
+def _revalidate(response, etag, last_modified=True):
+    response.set_etag(etag)
+    if last_modified and current_user.data_modified_at:
+        response.last_modified = current_user.data_modified_at
+    # Browsers may keep the response but must check the ETag before reusing it
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+# /api/activities pages: default and largest page size
+ACTIVITIES_PAGE_SIZE = 200
+MAX_ACTIVITIES_PAGE_SIZE = 1000
+# Without ?from=, activities start this many weeks before the current week (what the dashboard shows)
+DEFAULT_ACTIVITY_WEEKS = 4
+
+def _parse_date_arg(name):
+    value = request.args.get(name)
+    return datetime.date.fromisoformat(value).isoformat() if value else None
+
+def _parse_cursor(cursor):
+    """A cursor is '<date>,<activity_id>' of the last activity on the previous page."""
+    date, activity_id = cursor.split(',')
+    return datetime.date.fromisoformat(date).isoformat(), int(activity_id)
+
 @app.route('/api/activities')
 @login_required
 def get_activities_data():
-    activities = database.get_activities_for_user(current_user.id)
+    fmt = request.args.get('format', 'rows')
+    if fmt not in payloads.ACTIVITY_FORMATS:
+        return jsonify({'error': f"format must be one of {', '.join(payloads.ACTIVITY_FORMATS)}"}), 400
+
+    every = request.args.get('all') == 'true'
+    if every:
+        # Every activity in one response; kept for exports and older clients
+        params = ('all', fmt)
+    else:
+        try:
+            date_from = _parse_date_arg('from')
+            date_to = _parse_date_arg('to')
+            before = _parse_cursor(request.args['cursor']) if 'cursor' in request.args else None
+        except ValueError:
+            return jsonify({'error': "from/to must be YYYY-MM-DD dates and cursor must come from next_cursor"}), 400
+        if date_from is None:
+            this_week = database.week_start_for(datetime.date.today())
+            date_from = (this_week - datetime.timedelta(weeks=DEFAULT_ACTIVITY_WEEKS)).isoformat()
+        limit = request.args.get('limit', ACTIVITIES_PAGE_SIZE, type=int)
+        limit = max(1, min(limit, MAX_ACTIVITIES_PAGE_SIZE))
+        params = (date_from, date_to, before, limit, fmt)
+
+    etag = _data_etag(*params)
+    not_modified = _not_modified(etag)
+    if not_modified:
+        return not_modified
+
+    body = activity_cache.get(current_user.id, current_user.data_version, params)
+    if body is not None:
+        return _revalidate(app.response_class(body, mimetype=app.json.mimetype), etag)
+
+    if every:
+        activities = database.get_activities_for_user(current_user.id)
+        next_cursor = None
+    else:
+        # Ask for one extra row to learn whether there is another page
+        activities = database.get_activities_for_user(current_user.id, date_from, date_to, before, limit + 1)
+        next_cursor = None
+        if len(activities) > limit:
+            activities = activities[:limit]
+            next_cursor = f"{activities[-1]['date']},{activities[-1]['activity_id']}"
+
     logger.info(f"API: Returning {len(activities)} activities for user: {current_user.username} (ID: {current_user.id})")
     
-    athlete_row = database.get_row_from_athletes_table(current_user.id)
-    mileage_goal = athlete_row.get('mileage_goal', 0) if athlete_row else 0
-    long_run_goal = athlete_row.get('long_run_goal', 0) if athlete_row else 0
-    has_strava = database.user_has_strava(current_user.id)
-    
+    response = jsonify({
+        'format': fmt,
+        'activities': payloads.encode_activities(activities, fmt),
+        'next_cursor': next_cursor,
+        'mileage_goal': current_user.mileage_goal,
+        'long_run_goal': current_user.long_run_goal,
+        'has_strava' : current_user.has_strava
+    })
+    activity_cache.put(current_user.id, current_user.data_version, params, response.get_data())
+    return _revalidate(response, etag)
+
+@app.route('/api/activities/changes')
+@login_required
+def get_activity_changes():
+    fmt = request.args.get('format', 'rows')
+    if fmt not in payloads.ACTIVITY_FORMATS:
+        return jsonify({'error': f"format must be one of {', '.join(payloads.ACTIVITY_FORMATS)}"}), 400
+    since = request.args.get('since', 0, type=int)
+    # A version from the future means the client's copy is from another database; start over
+    full = since <= 0 or since > current_user.data_version
+    if full:
+        since = 0
+    elif since == current_user.data_version:
+        # Nothing changed: answered from the user context without touching DailyMileage
+        return jsonify({
+            'version': since, 'full': False, 'format': fmt,
+            'activities': payloads.encode_activities([], fmt), 'deleted': []
+        })
+
+    changes = database.get_activity_changes(current_user.id, since)
+    return jsonify({
+        'version': changes['version'],
+        'full': full,
+        'format': fmt,
+        'activities': payloads.encode_activities(changes['activities'], fmt),
+        'deleted': changes['deleted']
+    })
+
+# Weeks returned by /api/weekly-summary when ?weeks= is missing, and the most it will return
+WEEKLY_SUMMARY_WEEKS = 5
+MAX_WEEKLY_SUMMARY_WEEKS = 52
+
+@app.route('/api/weekly-summary')
+@login_required
+def get_weekly_summary():
+    weeks = request.args.get('weeks', WEEKLY_SUMMARY_WEEKS, type=int)
+    weeks = max(1, min(weeks, MAX_WEEKLY_SUMMARY_WEEKS))
+    try:
+        # The browser sends its own current week so users ahead of/behind UTC see the right one
+        end = datetime.date.fromisoformat(request.args['end']) if 'end' in request.args else datetime.date.today()
+    except ValueError:
+        return jsonify({'error': 'end must be a YYYY-MM-DD date'}), 400
+
+    etag = _data_etag('weeks', database.week_start_for(end), weeks)
+    not_modified = _not_modified(etag)
+    if not_modified:
+        return not_modified
+
+    return _revalidate(jsonify({
+        'weeks': database.get_weekly_summary(current_user.id, end, weeks),
+        'mileage_goal': current_user.mileage_goal,
+        'long_run_goal': current_user.long_run_goal,
+        'has_strava': current_user.has_strava
+    }), etag)
+
+# Samples per series returned by /api/activities/<id>/streams by default, and at most
+STREAM_POINTS = 500
+MAX_STREAM_POINTS = 2000
+
+@app.route('/api/activities/<int:activity_id>/streams')
+@login_required
+def get_activity_streams(activity_id):
+    points = request.args.get('points', STREAM_POINTS, type=int)
+    if points is None or not 2 <= points <= MAX_STREAM_POINTS:
+        return jsonify({'error': f'points must be between 2 and {MAX_STREAM_POINTS}'}), 400
+    types = request.args.get('types')
+    types = types.split(',') if types else list(streams.STREAM_TYPES)
+    unknown = [stream_type for stream_type in types if stream_type not in streams.STREAM_SCALES]
+    if unknown:
+        return jsonify({'error': f"unknown stream types: {', '.join(unknown)}"}), 400
+
+    # Streams have their own version, so activity and goal changes don't touch this ETag
+    version = database.get_streams_version(current_user.id, activity_id)
+    if version is None:
+        return jsonify({'error': 'no streams for this activity'}), 404
+    key = ":".join(str(part) for part in (current_user.id, 'streams', activity_id, version, points, ','.join(types)))
+    etag = hashlib.sha256(key.encode()).hexdigest()[:32]
+    if request.if_none_match.contains(etag):
+        return _revalidate(app.response_class(status=304), etag, last_modified=False)
+
+    series = streams.load_series(current_user.id, activity_id, types, points)
+    if not series:
+        return jsonify({'error': 'no streams for this activity'}), 404
+    return _revalidate(jsonify({'activity_id': activity_id, 'series': series}), etag, last_modified=False)
+
+@app.route('/api/sync-status')
+@login_required
+def get_sync_status():
+    job = database.get_latest_sync_job(current_user.id)
+    last_sync_time = current_user.last_sync_time or None
+    backfill = database.get_backfill(current_user.id)
+    if backfill:
+        backfill = {key: backfill[key] for key in
+                    ('status', 'activities_imported', 'pages_fetched', 'oldest_date', 'finished_at')}
+
+    if not job:
+        return jsonify({'status': 'idle', 'last_sync_time': last_sync_time, 'backfill': backfill})
+
     return jsonify({
-        'activities': activities,
-        'mileage_goal': mileage_goal,
-        'long_run_goal': long_run_goal,
-        'has_strava' : has_strava
+        'status': job['status'],
+        'job_id': job['id'],
+        'activities_imported': job['activities_imported'],
+        'finished_at': job['finished_at'],
+        'error': job['error'],
+        'last_sync_time': last_sync_time,
+        'backfill': backfill
     })
 
 if __name__ == "__main__":
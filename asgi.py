@@ -0,0 +1,150 @@
+"""
+ASGI entry point: app.py's Flask app served from an asyncio event loop.
+
+Under gunicorn every request holds one of a worker's --threads until it
+returns, including one waiting on Strava (the OAuth token exchange in
+/strava/callback can take seconds when Strava is slow), so a handful of slow
+Strava responses leave nothing for the rest of the site. Here the event loop
+accepts every connection and reads every request, and each request then runs
+on one of two thread pools, the way sync_engine.py runs blocking collector
+and database calls from asyncio:
+
+- Views in app.STRAVA_BOUND_ENDPOINTS run on STRAVA_THREADS threads. They
+  spend their time waiting on a socket
+- Everything else (SQLite reads and writes of a few milliseconds) runs on
+  REQUEST_THREADS threads, which Strava-bound requests never take
+
+The views still block their thread; this doesn't make them faster or let a
+process do more at once than gunicorn with as many threads would. What it
+changes is that a burst of slow Strava responses only fills the Strava pool,
+so the rest of the site keeps answering (bench/serving.py). A request that
+finds its pool busy waits on the loop, which costs a coroutine rather than
+a thread.
+
+Usage:
+    uvicorn asgi:app --host 0.0.0.0 --port 8000 --workers 4
+"""
+import asyncio
+import io
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.exceptions import HTTPException
+from werkzeug.routing import RequestRedirect
+import app as flask_app_module
+import strava_http
+
+REQUEST_THREADS = int(os.getenv("ASGI_REQUEST_THREADS", 16))
+STRAVA_THREADS = int(os.getenv("ASGI_STRAVA_THREADS", 256))
+
+flask_app = flask_app_module.app
+_request_pool = ThreadPoolExecutor(max_workers=REQUEST_THREADS, thread_name_prefix="asgi-request")
+_strava_pool = ThreadPoolExecutor(max_workers=STRAVA_THREADS, thread_name_prefix="asgi-strava")
+
+# Every Strava-bound thread may have a request open at once
+strava_http.set_pool_size(STRAVA_THREADS)
+
+
+def pool_for(method, path):
+    """The thread pool a request runs on, by the endpoint it routes to."""
+    try:
+        endpoint, _ = flask_app.url_map.bind("localhost").match(path, method)
+    except (HTTPException, RequestRedirect):
+        # 404s, 405s and redirects are answered by Flask without calling a view
+        return _request_pool
+    return _strava_pool if endpoint in flask_app_module.STRAVA_BOUND_ENDPOINTS else _request_pool
+
+
+def build_environ(scope, body):
+    """A WSGI environ (PEP 3333) for an ASGI HTTP scope and its request body."""
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": client[0],
+        "REMOTE_PORT": str(client[1]),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    for raw_name, raw_value in scope.get("headers", []):
+        name = raw_name.decode("latin-1").upper().replace("-", "_")
+        value = raw_value.decode("latin-1")
+        if name in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            key = name
+        else:
+            key = f"HTTP_{name}"
+        if key in environ:
+            value = f"{environ[key]}{'; ' if key == 'HTTP_COOKIE' else ','}{value}"
+        environ[key] = value
+    return environ
+
+
+def call_wsgi(environ):
+    """Run the Flask app for one request. Returns (status code, ASGI headers, body bytes)."""
+    response = {}
+
+    def start_response(status, headers, exc_info=None):
+        response["status"] = int(status.split(" ", 1)[0])
+        response["headers"] = [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers]
+
+    result = flask_app(environ, start_response)
+    try:
+        body = b"".join(result)
+    finally:
+        if hasattr(result, "close"):
+            result.close()
+    return response["status"], response["headers"], body
+
+
+async def _read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return None
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body"):
+            return b"".join(chunks)
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            _request_pool.shutdown(wait=False, cancel_futures=True)
+            _strava_pool.shutdown(wait=False, cancel_futures=True)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await _lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        # No websockets here; returning without accepting makes the server refuse it
+        return
+
+    body = await _read_body(receive)
+    if body is None:
+        # The client left before sending its whole request
+        return
+    pool = pool_for(scope["method"], scope["path"])
+    loop = asyncio.get_running_loop()
+    status, headers, content = await loop.run_in_executor(pool, call_wsgi, build_environ(scope, body))
+
+    await send({"type": "http.response.start", "status": status, "headers": headers})
+    await send({"type": "http.response.body", "body": content})
@@ -0,0 +1,112 @@
+"""
+Full-history import for newly connected athletes.
+
+The first sync only looks back 30 days, so connecting Strava also queues a
+backfill (database.enqueue_backfill) that walks the athlete's whole history,
+newest first, one page of MAX_PER_PAGE activities at a time. Each page is
+saved together with the checkpoint of the next page to fetch, so a backfill
+interrupted by a crash, a deploy or the Strava budget picks up where it left
+off. Pages are requested for activities started before the backfill was
+queued, so runs saved in the meantime don't shift the page numbers.
+
+sync_worker.py runs one slice (PAGES_PER_RUN pages) of one backfill between
+its other work, rotating through users, and backfill requests have to leave
+collector.BACKFILL_RESERVE of every rate-limit window for everything else.
+
+Usage:
+    python -m backfill start <user_id> [<user_id> ...] [--all] [--restart]
+    python -m backfill run [--pages-per-run 5]
+    python -m backfill status <user_id>
+"""
+import argparse
+import json
+import sys
+import database
+import collector
+
+PER_PAGE = collector.MAX_PER_PAGE
+PAGES_PER_RUN = 5
+
+
+def run_backfill(backfill, max_pages=PAGES_PER_RUN):
+    """
+    Fetch and save up to max_pages pages of a claimed backfill, from its checkpoint.
+    Returns True once the athlete's whole history is saved.
+    Raises collector.RateLimitDeferred if the backfill's share of the budget is used up.
+    """
+    user_id = backfill['user_id']
+    token = collector.get_valid_access_token(user_id)
+    if token is None:
+        raise RuntimeError(f"No Strava tokens for User {user_id}")
+
+    page = backfill['next_page']
+    for _ in range(max_pages):
+        # No `after`, so Strava pages newest first and oldest_date tracks the progress
+        activities = collector.fetch_activity_page(token, None, page, PER_PAGE, 'backfill',
+                                                   before=backfill['before_time'])
+        database.save_backfill_page(user_id, [collector.parse_activity(a) for a in activities], page + 1)
+        if len(activities) < PER_PAGE:
+            return True
+        page += 1
+    return False
+
+
+def run_pending_backfills(max_pages=PAGES_PER_RUN):
+    """Run one slice of the queued backfill that advanced least recently. Returns True if one ran."""
+    backfill = database.claim_next_backfill()
+    if backfill is None:
+        return False
+
+    user_id = backfill['user_id']
+    try:
+        if run_backfill(backfill, max_pages):
+            database.finish_backfill(user_id)
+        else:
+            database.release_backfill(user_id)
+    except collector.RateLimitDeferred as e:
+        print(f"Pausing backfill for User {user_id} until {e.retry_at}: Strava budget is low")
+        database.release_backfill(user_id, e.retry_at)
+    except Exception as e:
+        print(f"Backfill for User {user_id} failed: {e}")
+        database.finish_backfill(user_id, error=str(e))
+    return True
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m backfill", description="Import athletes' full Strava history.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    start_parser = commands.add_parser('start', help="queue backfills")
+    start_parser.add_argument('user_ids', nargs='*', type=int)
+    start_parser.add_argument('--all', action='store_true', help="every user connected to Strava")
+    start_parser.add_argument('--restart', action='store_true', help="start over instead of resuming")
+    run_parser = commands.add_parser('run', help="run queued backfills in the foreground until none are due")
+    run_parser.add_argument('--pages-per-run', type=int, default=PAGES_PER_RUN)
+    status_parser = commands.add_parser('status', help="show a user's backfill")
+    status_parser.add_argument('user_id', type=int)
+    args = parser.parse_args(argv)
+
+    database.init_db()
+
+    if args.command == 'start':
+        user_ids = args.user_ids
+        if args.all:
+            user_ids = [user['id'] for user in database.get_users_with_strava()]
+        for user_id in user_ids:
+            backfill = database.enqueue_backfill(user_id, restart=args.restart)
+            print(f"User {user_id}: {backfill['status']} (next page {backfill['next_page']})")
+    elif args.command == 'run':
+        slices = 0
+        while run_pending_backfills(args.pages_per_run):
+            slices += 1
+        print(f"Ran {slices} backfill slices")
+    else:
+        backfill = database.get_backfill(args.user_id)
+        if backfill is None:
+            print(f"No backfill for User {args.user_id}")
+            return 1
+        print(json.dumps(backfill, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,12 @@
+"""
+Offline benchmarks for the Strava Mileage Tracker.
+
+Benchmarks use a throwaway SQLite file and never touch MileageTracker.db or
+the network.
+"""
+import os
+
+from cryptography.fernet import Fernet
+
+# database.py refuses to import without a key; benchmarks only need a valid one
+os.environ.setdefault("ENCRYPTION_KEY", Fernet.generate_key().decode())
@@ -0,0 +1,5 @@
+import sys
+
+from bench import suite
+
+sys.exit(suite.main())
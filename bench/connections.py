@@ -0,0 +1,96 @@
+"""
+Connections-per-request and per-call latency, connect-per-call vs pooled.
+
+Usage:
+    python -m bench.connections [--requests 2000] [--activities 500]
+"""
+import argparse
+import os
+import tempfile
+import time
+from unittest.mock import patch
+
+import bench  # noqa: F401  (sets a throwaway ENCRYPTION_KEY)
+import database
+
+
+def seed(user_count, activities_per_user):
+    database.init_db()
+    with database.db_connection() as conn:
+        for n in range(user_count):
+            user_id = conn.execute(
+                "INSERT INTO Users (username, password_hash, strava_access_token) VALUES (?, ?, ?)",
+                (f"runner{n}", "x", "token")
+            ).lastrowid
+            conn.execute(
+                "INSERT INTO Athletes (user_id, mileage_goal, long_run_goal) VALUES (?, 30, 10)",
+                (user_id,)
+            )
+            conn.executemany(
+                "INSERT INTO DailyMileage (user_id, activity_id, date, distance) VALUES (?, ?, ?, ?)",
+                [
+                    (user_id, user_id * 1_000_000 + i, f"2025-{1 + i % 12:02d}-{1 + i % 28:02d}", 3.1)
+                    for i in range(activities_per_user)
+                ]
+            )
+
+
+def dashboard_request(user_id):
+    """The database calls made by one GET / followed by GET /api/activities."""
+    database.get_user_by_id(user_id)
+    database.user_has_strava(user_id)
+    database.get_user_by_id(user_id)
+    database.get_activities_for_user(user_id)
+    database.get_row_from_athletes_table(user_id)
+    database.user_has_strava(user_id)
+
+
+CALLS_PER_REQUEST = 6
+
+
+def run(pooled, requests, user_count):
+    database.close_pooled_connection()
+    opened = 0
+    real_get_connection = database.get_connection
+
+    def counting_get_connection(*args):
+        nonlocal opened
+        opened += 1
+        return real_get_connection(*args)
+
+    with patch.object(database, 'POOL_CONNECTIONS', pooled), \
+         patch.object(database, 'get_connection', counting_get_connection):
+        start = time.perf_counter()
+        for n in range(requests):
+            dashboard_request(1 + n % user_count)
+        elapsed = time.perf_counter() - start
+    database.close_pooled_connection()
+
+    return {
+        'mode': 'pooled' if pooled else 'connect-per-call',
+        'connections_per_request': opened / requests,
+        'per_call_us': elapsed / (requests * CALLS_PER_REQUEST) * 1e6,
+        'per_request_ms': elapsed / requests * 1e3,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--activities', type=int, default=200)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        with patch.object(database, 'DB_NAME', os.path.join(tmp, 'bench.db')):
+            seed(args.users, args.activities)
+            results = [run(False, args.requests, args.users), run(True, args.requests, args.users)]
+
+    print(f"{'mode':<18}{'conns/request':>15}{'us/call':>12}{'ms/request':>13}")
+    for r in results:
+        print(f"{r['mode']:<18}{r['connections_per_request']:>15.3f}"
+              f"{r['per_call_us']:>12.1f}{r['per_request_ms']:>13.3f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+"""
+Seeded synthetic data for benchmarks: Users, Athletes and DailyMileage at a
+configurable scale, plus the rollups and versions the app keeps alongside them.
+
+The same --seed always produces the same database, so runs can be compared.
+Every user's password is "password" and every user is connected to Strava.
+
+Usage:
+    python -m bench.datagen --db /tmp/bench.db [--users 10000] [--activities-per-user 100]
+"""
+import argparse
+import datetime
+import random
+import time
+from unittest.mock import patch
+
+import bench  # noqa: F401  (sets a throwaway ENCRYPTION_KEY)
+import database
+import passwords
+from werkzeug.security import generate_password_hash
+
+PASSWORD = "password"
+
+# Activities are spread over this many days ending on END_DATE
+HISTORY_DAYS = 5 * 365
+END_DATE = datetime.date(2025, 12, 31)
+
+INSERT_BATCH = 50_000
+
+
+def username_for(user_id):
+    return f"runner{user_id}"
+
+
+def activity_id_for(user_id, n):
+    return user_id * 10_000_000 + n
+
+
+def _user_activities(rng, user_id, count):
+    # Each user runs on a random subset of days, occasionally twice a day
+    start = END_DATE - datetime.timedelta(days=HISTORY_DAYS - 1)
+    for n in range(count):
+        day = start + datetime.timedelta(days=rng.randrange(HISTORY_DAYS))
+        distance = round(rng.lognormvariate(1.4, 0.45), 2)
+        title = "Race" if rng.random() < 0.02 else None
+        yield (user_id, activity_id_for(user_id, n), day.isoformat(), distance, title)
+
+
+def generate(users=1000, activities_per_user=100, seed=1):
+    """
+    Fill database.DB_NAME (which should be empty) with `users` connected users
+    and `activities_per_user` activities each. Returns a summary dict.
+    """
+    rng = random.Random(seed)
+    start = time.perf_counter()
+    database.init_db()
+
+    # Hashing and encryption are deliberately slow, so every user shares one of each
+    password_hash = generate_password_hash(PASSWORD, method=passwords.hash_method())
+    access_token = database.encrypt_token("bench-access")
+    refresh_token = database.encrypt_token("bench-refresh")
+    now = int(time.time())
+
+    with database.db_connection() as conn:
+        conn.executemany(
+            """INSERT INTO Users (id, username, password_hash, strava_athlete_id, strava_access_token,
+                                  strava_refresh_token, token_expiration, last_sync_time, last_login_time,
+                                  data_version, data_modified_at)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 1, ?)""",
+            [
+                (user_id, username_for(user_id), password_hash, user_id, access_token,
+                 refresh_token, now + 6 * 3600, now, now - rng.randrange(30 * 86400), now)
+                for user_id in range(1, users + 1)
+            ]
+        )
+        conn.executemany(
+            "INSERT INTO Athletes (user_id, mileage_goal, long_run_goal) VALUES (?, ?, ?)",
+            [(user_id, rng.choice([20, 30, 40, 50]), rng.choice([8, 10, 13, 16]))
+             for user_id in range(1, users + 1)]
+        )
+
+        batch = []
+        for user_id in range(1, users + 1):
+            batch.extend(_user_activities(rng, user_id, activities_per_user))
+            if len(batch) >= INSERT_BATCH:
+                _insert_activities(conn, batch)
+                batch = []
+        _insert_activities(conn, batch)
+
+        # Build the rollups the same way the migration backfills them
+        database._migration_mileage_rollups(conn.cursor())
+
+    return {
+        'users': users,
+        'activities': users * activities_per_user,
+        'seed': seed,
+        'seconds': time.perf_counter() - start,
+    }
+
+
+def _insert_activities(conn, rows):
+    conn.executemany(
+        """INSERT INTO DailyMileage (user_id, activity_id, date, distance, activity_title, version)
+           VALUES (?, ?, ?, ?, ?, 1)""",
+        rows
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--db', required=True, help="SQLite file to create")
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--activities-per-user', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    with patch.object(database, 'DB_NAME', args.db):
+        summary = generate(args.users, args.activities_per_user, args.seed)
+        database.close_pooled_connection()
+    print(f"{summary['users']} users, {summary['activities']} activities in {summary['seconds']:.1f}s -> {args.db}")
+
+
+if __name__ == '__main__':
+    main()
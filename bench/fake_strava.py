@@ -0,0 +1,189 @@
+"""
+A local stand-in for the parts of the Strava API the collector uses.
+
+Serves POST /oauth/token, GET /api/v3/athlete/activities,
+GET /api/v3/activities/<id> and GET /api/v3/activities/<id>/streams with an
+optional artificial delay, so syncs can be benchmarked without network
+access. Access tokens look like "token-<user_id>"; each athlete has
+`activities_per_user` activities, served honoring page/per_page, each with
+synthetic per-second streams. Tests can edit (`server.edits`) or delete (`server.deleted`)
+single activities to go with simulated webhook events.
+
+Usage:
+    python -m bench.fake_strava [--port 8765] [--latency 0.05] [--activities 120]
+"""
+import argparse
+import json
+import math
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+RATE_LIMIT_HEADERS = {
+    "X-RateLimit-Limit": "100000,1000000",
+    "X-RateLimit-Usage": "0,0",
+}
+
+
+def fake_activity(user_id, n):
+    return {
+        'id': user_id * 1_000_000 + n,
+        'name': f"Run {n}",
+        'distance': 5000.0 + (n % 10) * 500,
+        'start_date_local': f"2025-{1 + n % 12:02d}-{1 + n % 28:02d}T07:00:00Z",
+    }
+
+
+def fake_streams(activity_id, keys):
+    """A steady run with rolling hills: 1 sample a second, 20-60 minutes long."""
+    seconds = 1200 + (activity_id % 5) * 600
+    time_s = list(range(seconds))
+    speed = [3.0 + 0.3 * math.sin(t / 97) for t in time_s]
+    distance = []
+    total = 0.0
+    for v in speed:
+        distance.append(round(total, 1))
+        total += v
+    streams = {
+        'time': time_s,
+        'distance': distance,
+        'velocity_smooth': [round(v, 2) for v in speed],
+        'altitude': [round(120 + 15 * math.sin(d / 800), 1) for d in distance],
+        'heartrate': [int(135 + 15 * (1 - math.exp(-t / 300)) + 3 * math.sin(t / 61)) for t in time_s],
+        'cadence': [86 + t % 3 for t in time_s],
+    }
+    return {
+        key: {'data': data, 'series_type': 'distance', 'original_size': seconds, 'resolution': 'high'}
+        for key, data in streams.items() if key in keys
+    }
+
+
+class FakeStravaHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "FakeStrava/1.0"
+
+    def _send_json(self, status, body):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in RATE_LIMIT_HEADERS.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        form = parse_qs(self.rfile.read(length).decode())
+        time.sleep(self.server.latency)
+        self.server.count("token")
+
+        if urlparse(self.path).path != "/oauth/token":
+            self._send_json(404, {"message": "Record Not Found"})
+            return
+
+        # Refresh tokens look like "refresh-<user_id>"; codes like "code-<user_id>"
+        subject = (form.get("refresh_token") or form.get("code") or ["x-0"])[0]
+        user_id = subject.rsplit("-", 1)[-1]
+        self._send_json(200, {
+            'access_token': f"token-{user_id}",
+            'refresh_token': f"refresh-{user_id}",
+            'expires_at': int(time.time()) + 6 * 3600,
+            'athlete': {'id': int(user_id) if user_id.isdigit() else 0},
+        })
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        time.sleep(self.server.latency)
+        self.server.count("activities")
+
+        token = self.headers.get("Authorization", "").removeprefix("Bearer ")
+        if not token.startswith("token-"):
+            self._send_json(401, {"message": "Authorization Error"})
+            return
+        user_id = int(token.removeprefix("token-"))
+
+        if url.path.startswith("/api/v3/activities/") and url.path.endswith("/streams"):
+            keys = parse_qs(url.query).get("keys", [""])[0].split(",")
+            self._send_activity(user_id, url.path.split("/")[-2], keys)
+            return
+        if url.path.startswith("/api/v3/activities/"):
+            self._send_activity(user_id, url.path.rsplit("/", 1)[-1])
+            return
+        if url.path != "/api/v3/athlete/activities":
+            self._send_json(404, {"message": "Record Not Found"})
+            return
+
+        query = parse_qs(url.query)
+        page = int(query.get("page", ["1"])[0])
+        per_page = int(query.get("per_page", ["30"])[0])
+        start = (page - 1) * per_page
+        end = min(start + per_page, self.server.activities_per_user)
+        self._send_json(200, [fake_activity(user_id, n) for n in range(start, end)])
+
+    def _send_activity(self, user_id, activity_id, stream_keys=None):
+        activity_id = int(activity_id) if activity_id.isdigit() else -1
+        owner, n = divmod(activity_id, 1_000_000)
+        if owner != user_id or activity_id in self.server.deleted:
+            self._send_json(404, {"message": "Record Not Found"})
+            return
+        if stream_keys is not None:
+            self._send_json(200, fake_streams(activity_id, stream_keys))
+            return
+        self._send_json(200, {**fake_activity(user_id, n), **self.server.edits.get(activity_id, {})})
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeStravaServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # socketserver's default backlog of 5 drops bursts of concurrent connections
+    request_queue_size = 256
+
+    def __init__(self, port=0, latency=0.0, activities_per_user=120):
+        super().__init__(("127.0.0.1", port), FakeStravaHandler)
+        self.latency = latency
+        self.activities_per_user = activities_per_user
+        self.requests = {"token": 0, "activities": 0}
+        # activity_id -> fields to change, and deleted activity ids
+        self.edits = {}
+        self.deleted = set()
+        self._lock = threading.Lock()
+
+    def count(self, kind):
+        with self._lock:
+            self.requests[kind] += 1
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def start(self):
+        """Serve from a background thread. Returns self for chaining."""
+        threading.Thread(target=self.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a fake Strava API locally.")
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.05, help="seconds added to every response")
+    parser.add_argument('--activities', type=int, default=120, help="activities per athlete")
+    args = parser.parse_args()
+
+    server = FakeStravaServer(args.port, args.latency, args.activities)
+    print(f"Fake Strava listening on {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+"""
+Commits (fsyncs) per synced user during sync-all, with and without the write buffer.
+
+Runs the same sync-all against a local fake Strava twice: once committing
+every page, sync time and token update on its own, and once through
+database.write_buffer(). Every connection uses synchronous=FULL in both runs,
+so each commit is one fsync of the WAL and the comparison is like for like.
+Commits of the shared Strava rate-limit budget (one or two per request, never
+buffered) are counted separately.
+
+Usage:
+    python -m bench.group_commit [--users 200] [--activities 120] [--per-page 50] [--concurrency 32]
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import os
+import tempfile
+import threading
+from unittest.mock import patch
+
+import bench  # noqa: F401  (sets a throwaway ENCRYPTION_KEY)
+import collector
+import database
+import strava_http
+import sync_engine
+from bench.fake_strava import FakeStravaServer
+from bench.sync_all import seed_connected_users, reset_activities, reset_rate_limit
+
+DURABLE_PRAGMAS = tuple(
+    "PRAGMA synchronous = FULL" if pragma.startswith("PRAGMA synchronous") else pragma
+    for pragma in database.CONNECTION_PRAGMAS
+)
+
+
+class CommitCounter:
+    """Counts COMMITs, split into rate-limit budget transactions and everything else."""
+
+    def __init__(self):
+        self.sync_commits = 0
+        self.budget_commits = 0
+        self.lock = threading.Lock()
+
+    def tracer(self):
+        touched_budget = False
+
+        def trace(sql):
+            nonlocal touched_budget
+            if 'StravaRateLimit' in sql:
+                touched_budget = True
+            elif sql == 'COMMIT':
+                with self.lock:
+                    if touched_budget:
+                        self.budget_commits += 1
+                    else:
+                        self.sync_commits += 1
+                touched_budget = False
+        return trace
+
+
+def run(buffered, users, concurrency, per_page):
+    reset_activities()
+    reset_rate_limit()
+    database.close_pooled_connection()
+    counter = CommitCounter()
+    real_configure = database._configure_connection
+
+    def counting_configure(conn):
+        conn.set_trace_callback(counter.tracer())
+        return real_configure(conn)
+
+    buffer = database.write_buffer if buffered else (lambda **kwargs: contextlib.nullcontext())
+    with patch.object(database, '_configure_connection', counting_configure), \
+         patch.object(database, 'write_buffer', buffer), \
+         contextlib.redirect_stdout(io.StringIO()):
+        report = asyncio.run(sync_engine.sync_all(database.get_users_with_strava(), concurrency, per_page))
+    database.close_pooled_connection()
+
+    totals = report['totals']
+    return {
+        'mode': 'write buffer' if buffered else 'commit per write',
+        'sync_commits': counter.sync_commits,
+        'sync_commits_per_user': counter.sync_commits / users,
+        'budget_commits_per_user': counter.budget_commits / users,
+        'seconds': totals['seconds'],
+        'users_per_second': totals['users_per_second'],
+        'activities': totals['activities_imported'],
+        'ok': totals['ok'],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--activities', type=int, default=120, help="activities per user on the fake server")
+    parser.add_argument('--per-page', type=int, default=50)
+    parser.add_argument('--latency', type=float, default=0.02, help="fake Strava response delay in seconds")
+    parser.add_argument('--concurrency', type=int, default=32)
+    args = parser.parse_args()
+
+    server = FakeStravaServer(latency=args.latency, activities_per_user=args.activities).start()
+    collector.use_strava_base_url(server.url)
+    strava_http.set_pool_size(args.concurrency)
+    try:
+        with tempfile.TemporaryDirectory() as tmp, \
+             patch.object(database, 'DB_NAME', os.path.join(tmp, 'bench.db')), \
+             patch.object(database, 'CONNECTION_PRAGMAS', DURABLE_PRAGMAS):
+            seed_connected_users(args.users)
+            results = [run(buffered, args.users, args.concurrency, args.per_page) for buffered in (False, True)]
+    finally:
+        server.stop()
+
+    print(f"{args.users} users, {args.activities} activities each in pages of {args.per_page}, "
+          f"concurrency {args.concurrency}")
+    print(f"{'mode':<18}{'sync commits':>13}{'per user':>10}{'budget/user':>13}{'seconds':>9}{'users/s':>9}"
+          f"{'activities':>12}{'ok':>6}")
+    for r in results:
+        print(f"{r['mode']:<18}{r['sync_commits']:>13}{r['sync_commits_per_user']:>10.2f}"
+              f"{r['budget_commits_per_user']:>13.2f}{r['seconds']:>9.2f}{r['users_per_second']:>9.1f}"
+              f"{r['activities']:>12}{r['ok']:>6}")
+
+
+if __name__ == '__main__':
+    main()
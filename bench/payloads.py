@@ -0,0 +1,89 @@
+"""
+Size and serialization time of /api/activities payloads, rows vs columnar.
+
+Builds synthetic activity lists (a run most days, a few with titles) and
+serializes each one the way the app does: with Flask's stdlib encoder and,
+when orjson is installed, with payloads.JSONProvider.
+
+Usage:
+    python -m bench.payloads [--sizes 1000 10000 100000] [--repeat 5]
+"""
+import argparse
+import datetime
+import gzip
+import time
+
+from flask import Flask
+from flask.json.provider import DefaultJSONProvider
+
+import payloads
+
+
+def fake_activities(count):
+    start = datetime.date(2015, 1, 1)
+    return [
+        {
+            'activity_id': 10_000_000_000 + n,
+            'date': (start + datetime.timedelta(days=n * 9 // 10)).isoformat(),
+            'distance': round(3 + (n % 17) * 0.73, 2),
+            'activity_title': "Race" if n % 50 == 0 else None,
+        }
+        for n in reversed(range(count))
+    ]
+
+
+def time_dumps(provider, body, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        text = provider.dumps(body, separators=(",", ":"))
+        best = min(best, time.perf_counter() - start)
+    return text, best
+
+
+def run(sizes, repeat):
+    app = Flask(__name__)
+    providers = [('json', DefaultJSONProvider(app))]
+    if payloads.orjson is not None:
+        providers.append(('orjson', payloads.JSONProvider(app)))
+
+    results = []
+    for size in sizes:
+        activities = fake_activities(size)
+        for fmt in payloads.ACTIVITY_FORMATS:
+            # Include the encoding step, since columnar is built per request
+            start = time.perf_counter()
+            body = {'format': fmt, 'activities': payloads.encode_activities(activities, fmt)}
+            encode_ms = (time.perf_counter() - start) * 1e3
+            for encoder, provider in providers:
+                text, seconds = time_dumps(provider, body, repeat)
+                data = text.encode()
+                results.append({
+                    'activities': size,
+                    'format': fmt,
+                    'encoder': encoder,
+                    'bytes': len(data),
+                    'gzip_bytes': len(gzip.compress(data)),
+                    'encode_ms': encode_ms,
+                    'dumps_ms': seconds * 1e3,
+                })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    if payloads.orjson is None:
+        print("orjson is not installed; only the stdlib encoder is measured")
+
+    print(f"{'activities':>10} {'format':>9} {'encoder':>8} {'bytes':>11} {'gzip':>10} {'encode ms':>10} {'dumps ms':>9}")
+    for r in run(args.sizes, args.repeat):
+        print(f"{r['activities']:>10} {r['format']:>9} {r['encoder']:>8} {r['bytes']:>11,} "
+              f"{r['gzip_bytes']:>10,} {r['encode_ms']:>10.2f} {r['dumps_ms']:>9.2f}")
+
+
+if __name__ == '__main__':
+    main()
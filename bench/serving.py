@@ -0,0 +1,208 @@
+"""
+One app process under a burst of Strava-bound requests: gunicorn vs asgi.py.
+
+Starts a slow local fake Strava and, in turn, one gunicorn worker (app:app)
+and one uvicorn process (asgi:app), each with --threads threads in all: the
+gunicorn worker's --threads, or asgi.py's --request-threads plus the rest as
+its Strava pool. Each one gets a burst of /strava/callback requests whose
+token exchange waits --latency seconds on Strava, while a few clients keep
+requesting /api/activities. The table shows how long the burst took and
+what it did to the latency of everything else.
+
+With the same number of threads both modes block a thread per request;
+what differs is that asgi.py keeps the Strava-bound requests off the
+threads serving the rest of the site. --threads defaults to enough for the
+whole burst plus the request threads.
+
+Usage:
+    python -m bench.serving [--strava-requests 100] [--latency 1.0] [--fast-clients 4] [--threads N] [--request-threads 4]
+"""
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+
+import requests
+from flask import Flask
+from flask.sessions import SecureCookieSessionInterface
+
+import bench  # noqa: F401  (sets a throwaway ENCRYPTION_KEY)
+import database
+import strava_http
+from bench.fake_strava import FakeStravaServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SECRET_KEY = "bench-serving"
+ACTIVITIES_PER_USER = 50
+
+
+def seed(users):
+    """Users with goals and a few weeks of activities, not yet connected to Strava."""
+    database.init_db()
+    with database.db_connection() as conn:
+        for n in range(1, users + 1):
+            conn.execute("INSERT INTO Users (id, username, password_hash) VALUES (?, ?, 'x')", (n, f"runner{n}"))
+            conn.execute("INSERT INTO Athletes (user_id, mileage_goal, long_run_goal) VALUES (?, 30, 10)", (n,))
+        database.create_activities(1, [
+            {'date': f"2025-01-{1 + i % 28:02d}", 'distance': 3.1, 'activity_id': i}
+            for i in range(ACTIVITIES_PER_USER)
+        ])
+    # Start from the fake server's limits rather than Strava's defaults
+    database.record_strava_rate_limit(strava_http.parse_rate_limit(
+        {"X-RateLimit-Limit": "100000,1000000", "X-RateLimit-Usage": "0,0"}
+    ))
+    database.close_pooled_connection()
+
+
+def session_cookie(user_id):
+    """A Flask-Login session for user_id, signed like the app signs it."""
+    signer = Flask(__name__, root_path=ROOT)
+    signer.secret_key = SECRET_KEY
+    serializer = SecureCookieSessionInterface().get_signing_serializer(signer)
+    return serializer.dumps({'_user_id': str(user_id), '_fresh': True})
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def server_command(mode, port, threads):
+    if mode == 'gunicorn':
+        return [sys.executable, "-m", "gunicorn", "--bind", f"127.0.0.1:{port}", "--workers", "1",
+                "--threads", str(threads), "--timeout", "120", "--pythonpath", ROOT, "app:app"]
+    return [sys.executable, "-m", "uvicorn", "asgi:app", "--host", "127.0.0.1", "--port", str(port),
+            "--app-dir", ROOT, "--workers", "1", "--log-level", "warning", "--no-access-log"]
+
+
+def wait_until_ready(url, process, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited with status {process.returncode}")
+        try:
+            requests.get(f"{url}/login", timeout=1)
+            return
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Server at {url} did not start within {timeout}s")
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else float('nan')
+
+
+def run(mode, strava_url, strava_requests, fast_clients, threads, request_threads):
+    with tempfile.TemporaryDirectory() as tmp:
+        with patch.object(database, 'DB_NAME', os.path.join(tmp, database.DB_NAME)):
+            seed(strava_requests)
+
+        port = free_port()
+        url = f"http://127.0.0.1:{port}"
+        env = dict(os.environ, STRAVA_BASE_URL=strava_url, FLASK_SECRET_KEY=SECRET_KEY,
+                   ASGI_REQUEST_THREADS=str(request_threads),
+                   ASGI_STRAVA_THREADS=str(threads - request_threads))
+        with open(os.path.join(tmp, "server.log"), "w") as log:
+            # The app finds MileageTracker.db in its working directory
+            process = subprocess.Popen(server_command(mode, port, threads), cwd=tmp, env=env,
+                                       stdout=log, stderr=subprocess.STDOUT)
+        try:
+            wait_until_ready(url, process)
+            result = load(url, strava_requests, fast_clients)
+        finally:
+            process.terminate()
+            process.wait(timeout=30)
+
+        with patch.object(database, 'DB_NAME', os.path.join(tmp, database.DB_NAME)):
+            result['connected'] = len(database.get_users_with_strava())
+            database.close_pooled_connection()
+    result['mode'] = 'gunicorn (app:app)' if mode == 'gunicorn' else 'uvicorn (asgi:app)'
+    return result
+
+
+def load(url, strava_requests, fast_clients):
+    """Send the callback burst while fast clients poll /api/activities; returns timings."""
+    burst_done = threading.Event()
+    fast_latencies = []
+    fast_lock = threading.Lock()
+
+    def callback(user_id):
+        with requests.Session() as session:
+            session.cookies.set("session", session_cookie(user_id))
+            start = time.perf_counter()
+            response = session.get(f"{url}/strava/callback?code=code-{user_id}", allow_redirects=False, timeout=600)
+            return response.status_code, time.perf_counter() - start
+
+    def poll_activities():
+        with requests.Session() as session:
+            session.cookies.set("session", session_cookie(1))
+            while not burst_done.is_set():
+                start = time.perf_counter()
+                session.get(f"{url}/api/activities?all=true", timeout=600).raise_for_status()
+                with fast_lock:
+                    fast_latencies.append(time.perf_counter() - start)
+
+    pollers = [threading.Thread(target=poll_activities) for _ in range(fast_clients)]
+    for poller in pollers:
+        poller.start()
+    began = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=strava_requests) as executor:
+        callbacks = list(executor.map(callback, range(1, strava_requests + 1)))
+    elapsed = time.perf_counter() - began
+    burst_done.set()
+    for poller in pollers:
+        poller.join()
+
+    callback_seconds = [seconds for _, seconds in callbacks]
+    return {
+        'burst_seconds': elapsed,
+        'callback_p50': percentile(callback_seconds, 0.5),
+        'fast_requests': len(fast_latencies),
+        'fast_p50_ms': percentile(fast_latencies, 0.5) * 1e3,
+        'fast_p95_ms': percentile(fast_latencies, 0.95) * 1e3,
+        'fast_max_ms': max(fast_latencies, default=float('nan')) * 1e3,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--strava-requests', type=int, default=100, help="concurrent /strava/callback requests")
+    parser.add_argument('--latency', type=float, default=1.0, help="seconds the fake Strava takes per request")
+    parser.add_argument('--fast-clients', type=int, default=4, help="clients polling /api/activities meanwhile")
+    parser.add_argument('--threads', type=int, help="threads per app process in both modes "
+                        "(default: --strava-requests + --request-threads)")
+    parser.add_argument('--request-threads', type=int, default=4, help="asgi.py's request pool; "
+                        "the rest of --threads are its Strava pool")
+    parser.add_argument('--modes', nargs='+', choices=['gunicorn', 'asgi'], default=['gunicorn', 'asgi'])
+    args = parser.parse_args()
+    threads = args.threads or args.strava_requests + args.request_threads
+    if threads <= args.request_threads:
+        parser.error("--threads must be more than --request-threads")
+
+    server = FakeStravaServer(latency=args.latency).start()
+    try:
+        print(f"{args.strava_requests} callbacks at {args.latency}s of Strava latency each, "
+              f"{args.fast_clients} clients polling /api/activities, one app process with {threads} threads "
+              f"(asgi.py: {args.request_threads} request + {threads - args.request_threads} Strava)")
+        results = [run(mode, server.url, args.strava_requests, args.fast_clients, threads, args.request_threads)
+                   for mode in args.modes]
+    finally:
+        server.stop()
+
+    print(f"{'mode':<20}{'burst s':>9}{'connected':>11}{'callback p50 s':>16}"
+          f"{'fast reqs':>11}{'fast p50 ms':>13}{'fast p95 ms':>13}{'fast max ms':>13}")
+    for r in results:
+        print(f"{r['mode']:<20}{r['burst_seconds']:>9.2f}{r['connected']:>11}{r['callback_p50']:>16.2f}"
+              f"{r['fast_requests']:>11}{r['fast_p50_ms']:>13.1f}{r['fast_p95_ms']:>13.1f}{r['fast_max_ms']:>13.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""
+Concurrent ingest throughput, one SQLite file vs per-user shards.
+
+Several writer processes (like gunicorn workers and sync workers) each save
+pages of new activities for their own users, one transaction per page, the
+way a sync does. With one file every commit waits for SQLite's single write
+lock; with shards only writers whose users share a shard wait for each other.
+
+Usage:
+    python -m bench.sharding [--writers 8] [--users 64] [--pages 10] [--per-page 50] [--shards 1 2 4 8]
+"""
+import argparse
+import datetime
+import multiprocessing
+import os
+import tempfile
+import time
+from unittest.mock import patch
+
+import bench  # noqa: F401  (sets a throwaway ENCRYPTION_KEY)
+import database
+
+BASE_DATE = datetime.date(2024, 1, 1)
+
+
+def activity_page(user_id, page, per_page):
+    return [
+        {
+            'date': (BASE_DATE + datetime.timedelta(days=(page * per_page + n) % 365)).isoformat(),
+            'distance': 3.0 + n % 7,
+            'activity_id': user_id * 1_000_000 + page * per_page + n,
+        }
+        for n in range(per_page)
+    ]
+
+
+def writer(user_ids, pages, per_page, start, results):
+    """Save `pages` pages for each of user_ids, round robin, once every writer is ready."""
+    start.wait()
+    began = time.perf_counter()
+    saved = 0
+    for page in range(pages):
+        for user_id in user_ids:
+            saved += database.create_activities(user_id, activity_page(user_id, page, per_page))['inserted']
+    database.close_pooled_connection()
+    results.put((saved, time.perf_counter() - began))
+
+
+def run(backend, shards, writers, users, pages, per_page):
+    with tempfile.TemporaryDirectory() as tmp, \
+         patch.object(database, 'DB_NAME', os.path.join(tmp, 'bench.db')), \
+         patch.object(database, 'STORAGE_BACKEND', backend), \
+         patch.object(database, 'STORAGE_SHARDS', shards):
+        database.init_db()
+        for n in range(1, users + 1):
+            database.create_user(f"runner{n}", "password")
+        database.close_pooled_connection()
+
+        # Forked writers inherit the patched settings
+        context = multiprocessing.get_context('fork')
+        start = context.Event()
+        results = context.Queue()
+        processes = [
+            context.Process(target=writer, args=(list(range(1 + w, users + 1, writers)), pages, per_page, start, results))
+            for w in range(writers)
+        ]
+        for process in processes:
+            process.start()
+        began = time.perf_counter()
+        start.set()
+        outcomes = [results.get() for _ in processes]
+        elapsed = time.perf_counter() - began
+        for process in processes:
+            process.join()
+
+    saved = sum(outcome[0] for outcome in outcomes)
+    return {
+        'layout': 'single file' if backend == 'sqlite' else f"{shards} shards",
+        'activities': saved,
+        'transactions': users * pages,
+        'seconds': elapsed,
+        'activities_per_second': saved / elapsed,
+        'commits_per_second': users * pages / elapsed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--writers', type=int, default=8)
+    parser.add_argument('--users', type=int, default=64)
+    parser.add_argument('--pages', type=int, default=10, help="pages (transactions) per user")
+    parser.add_argument('--per-page', type=int, default=50)
+    parser.add_argument('--shards', type=int, nargs='+', default=[1, 2, 4, 8])
+    args = parser.parse_args()
+
+    print(f"{args.writers} writer processes, {args.users} users, {args.pages} pages of {args.per_page} each "
+          f"({os.cpu_count()} CPUs)")
+    layouts = [('sqlite', 1)] + [('sharded', shards) for shards in args.shards]
+    results = [run(backend, shards, args.writers, args.users, args.pages, args.per_page) for backend, shards in layouts]
+
+    print(f"{'layout':<14}{'activities':>12}{'seconds':>10}{'activities/s':>15}{'commits/s':>12}{'speedup':>10}")
+    for r in results:
+        print(f"{r['layout']:<14}{r['activities']:>12}{r['seconds']:>10.2f}{r['activities_per_second']:>15.0f}"
+              f"{r['commits_per_second']:>12.0f}{r['activities_per_second'] / results[0]['activities_per_second']:>9.2f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,315 @@
+"""
+Benchmark suite: database helpers and app routes against generated data.
+
+Seeds a database with bench.datagen (or reuses one made earlier with
+--db), then times each benchmark over random users. Results are printed as
+JSON so runs can be saved and diffed; --baseline compares against a saved
+run and exits non-zero if any benchmark's median got slower than --threshold.
+
+Usage:
+    python -m bench [--users 1000] [--activities-per-user 100] [--iterations 200]
+                    [--only NAME ...] [--db PATH] [--output FILE] [--baseline FILE]
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from unittest.mock import patch
+
+import bench  # noqa: F401  (sets a throwaway ENCRYPTION_KEY)
+import database
+from bench import datagen
+
+BENCHMARKS = []
+
+
+def benchmark(group):
+    """Register fn(ctx) as a benchmark; ctx has rng, users and (for routes) client."""
+    def register(fn):
+        BENCHMARKS.append((f"{group}.{fn.__name__}", fn))
+        return fn
+    return register
+
+
+class Context:
+    def __init__(self, users, seed):
+        self.users = users
+        self.rng = random.Random(seed)
+        self.client = None
+        self._next_activity = {}
+
+    def user_id(self):
+        return self.rng.randint(1, self.users)
+
+    def new_activity_id(self, user_id):
+        # Past the ids datagen used, so every write is a real insert
+        n = self._next_activity.get(user_id, 5_000_000)
+        self._next_activity[user_id] = n + 1
+        return datagen.activity_id_for(user_id, n)
+
+    def log_in(self, user_id):
+        with self.client.session_transaction() as sess:
+            sess['_user_id'] = str(user_id)
+            sess['_fresh'] = True
+
+
+# DATABASE HELPERS
+
+@benchmark('db')
+def get_user_context(ctx):
+    user_id = ctx.user_id()
+    return lambda: database.get_user_context(user_id)
+
+
+@benchmark('db')
+def get_user_by_username(ctx):
+    username = datagen.username_for(ctx.user_id())
+    return lambda: database.get_user_by_username(username)
+
+
+@benchmark('db')
+def authenticate(ctx):
+    username = datagen.username_for(ctx.user_id())
+    return lambda: database.authenticate(username, datagen.PASSWORD)
+
+
+@benchmark('db')
+def get_activities_for_user_all(ctx):
+    user_id = ctx.user_id()
+    return lambda: database.get_activities_for_user(user_id)
+
+
+@benchmark('db')
+def get_activities_for_user_page(ctx):
+    user_id = ctx.user_id()
+    return lambda: database.get_activities_for_user(user_id, '2025-11-01', None, None, 201)
+
+
+@benchmark('db')
+def get_weekly_summary(ctx):
+    user_id = ctx.user_id()
+    return lambda: database.get_weekly_summary(user_id, datagen.END_DATE, 5)
+
+
+@benchmark('db')
+def get_activity_changes(ctx):
+    user_id = ctx.user_id()
+    return lambda: database.get_activity_changes(user_id, 1)
+
+
+@benchmark('db')
+def create_activity(ctx):
+    user_id = ctx.user_id()
+    activity_id = ctx.new_activity_id(user_id)
+    day = datagen.END_DATE.isoformat()
+    return lambda: database.create_activity(user_id, day, 5.0, activity_id)
+
+
+@benchmark('db')
+def create_activities_page(ctx):
+    user_id = ctx.user_id()
+    rows = [
+        {'date': datagen.END_DATE.isoformat(), 'distance': 3.0, 'activity_id': ctx.new_activity_id(user_id)}
+        for _ in range(200)
+    ]
+    return lambda: database.create_activities(user_id, rows)
+
+
+@benchmark('db')
+def load_user(ctx):
+    import app
+    user_id = ctx.user_id()
+
+    def run():
+        # load_user memoizes on flask.g, so each call gets a fresh request context
+        with app.app.test_request_context():
+            app.load_user(user_id)
+    return run
+
+
+# ROUTES (through Flask's test client, logged in as a random user)
+
+def _get(ctx, url):
+    ctx.log_in(ctx.user_id())
+    return lambda: ctx.client.get(url)
+
+
+def _get_uncached(ctx, url):
+    """Like _get, but the response is built from the database even if the user came up before."""
+    import activity_cache
+    activity_cache.invalidate()
+    return _get(ctx, url)
+
+
+@benchmark('route')
+def dashboard(ctx):
+    return _get(ctx, '/')
+
+
+@benchmark('route')
+def api_activities(ctx):
+    return _get_uncached(ctx, '/api/activities')
+
+
+@benchmark('route')
+def api_activities_all(ctx):
+    return _get_uncached(ctx, '/api/activities?all=true')
+
+
+@benchmark('route')
+def api_activities_all_columnar(ctx):
+    return _get_uncached(ctx, '/api/activities?all=true&format=columnar')
+
+
+@benchmark('route')
+def api_activities_all_cached(ctx):
+    # A repeat request without the ETag (another tab or device), served from activity_cache
+    ctx.log_in(ctx.user_id())
+    ctx.client.get('/api/activities?all=true')
+    return lambda: ctx.client.get('/api/activities?all=true')
+
+
+@benchmark('route')
+def api_activities_not_modified(ctx):
+    user_id = ctx.user_id()
+    ctx.log_in(user_id)
+    etag = ctx.client.get('/api/activities?all=true').headers['ETag']
+    return lambda: ctx.client.get('/api/activities?all=true', headers={'If-None-Match': etag})
+
+
+@benchmark('route')
+def api_weekly_summary(ctx):
+    return _get(ctx, f'/api/weekly-summary?weeks=5&end={datagen.END_DATE.isoformat()}')
+
+
+@benchmark('route')
+def api_sync_status(ctx):
+    return _get(ctx, '/api/sync-status')
+
+
+def run_benchmark(fn, ctx, iterations, warmup):
+    """Time `iterations` calls, each set up by fn(ctx) outside the timed section."""
+    for _ in range(warmup):
+        fn(ctx)()
+    timings = []
+    for _ in range(iterations):
+        call = fn(ctx)
+        start = time.perf_counter()
+        call()
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    return {
+        'iterations': iterations,
+        'mean_us': statistics.fmean(timings) * 1e6,
+        'p50_us': timings[len(timings) // 2] * 1e6,
+        'p95_us': timings[min(len(timings) - 1, int(len(timings) * 0.95))] * 1e6,
+        'max_us': timings[-1] * 1e6,
+        'ops_per_second': len(timings) / sum(timings) if sum(timings) else 0.0,
+    }
+
+
+def run(args):
+    import app
+    app.app.config.update(TESTING=True, SECRET_KEY='bench')
+    # Per-request INFO logs would dominate the route timings
+    logging.getLogger('app').setLevel(logging.WARNING)
+
+    selected = [(name, fn) for name, fn in BENCHMARKS
+                if not args.only or any(pattern in name for pattern in args.only)]
+    ctx = Context(args.users, args.seed)
+    results = {}
+    with app.app.test_client() as client:
+        ctx.client = client
+        for name, fn in selected:
+            results[name] = run_benchmark(fn, ctx, args.iterations, args.warmup)
+            print(f"{name:<40} p50 {results[name]['p50_us']:>10.1f} us   "
+                  f"p95 {results[name]['p95_us']:>10.1f} us", file=sys.stderr)
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Benchmarks whose median is more than `threshold` (a fraction) slower than the baseline's."""
+    regressions = []
+    for name, result in results.items():
+        before = baseline.get('results', {}).get(name)
+        if before and before['p50_us'] and result['p50_us'] > before['p50_us'] * (1 + threshold):
+            regressions.append({
+                'name': name,
+                'baseline_p50_us': before['p50_us'],
+                'p50_us': result['p50_us'],
+                'change': result['p50_us'] / before['p50_us'] - 1,
+            })
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m bench", description=__doc__.splitlines()[1])
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--activities-per-user', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--warmup', type=int, default=10)
+    parser.add_argument('--only', nargs='+', help="run benchmarks whose name contains any of these")
+    parser.add_argument('--db', help="reuse (or create) this database instead of a temporary one")
+    parser.add_argument('--output', help="write the JSON results here instead of stdout")
+    parser.add_argument('--baseline', help="JSON results of an earlier run to compare against")
+    parser.add_argument('--threshold', type=float, default=0.2, help="allowed median slowdown vs --baseline")
+    parser.add_argument('--list', action='store_true', help="list benchmark names and exit")
+    args = parser.parse_args(argv)
+
+    if args.list:
+        print("\n".join(name for name, _ in BENCHMARKS))
+        return 0
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = args.db or os.path.join(tmp, 'bench.db')
+        # A generated database is only reusable with the same scale and seed, so note them next to it
+        meta_path = db_path + '.json'
+        scale = {'users': args.users, 'activities_per_user': args.activities_per_user, 'seed': args.seed}
+        reuse = args.db and os.path.exists(db_path) and os.path.exists(meta_path)
+        if reuse:
+            with open(meta_path) as f:
+                scale = json.load(f)
+            args.users = scale['users']
+
+        with patch.object(database, 'DB_NAME', db_path):
+            if not reuse:
+                print(f"Generating {args.users} users x {args.activities_per_user} activities...", file=sys.stderr)
+                datagen.generate(args.users, args.activities_per_user, args.seed)
+                with open(meta_path, 'w') as f:
+                    json.dump(scale, f)
+            results = run(args)
+            database.close_pooled_connection()
+
+    report = {
+        'meta': {
+            'timestamp': int(time.time()),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+            'iterations': args.iterations,
+            **scale,
+        },
+        'results': results,
+    }
+    if args.baseline:
+        with open(args.baseline) as f:
+            report['regressions'] = compare(results, json.load(f), args.threshold)
+        for r in report['regressions']:
+            print(f"REGRESSION {r['name']}: p50 {r['baseline_p50_us']:.1f} -> {r['p50_us']:.1f} us "
+                  f"({r['change']:+.0%})", file=sys.stderr)
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    return 1 if report.get('regressions') else 0
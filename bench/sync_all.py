@@ -0,0 +1,91 @@
+"""
+Throughput of `python -m collector sync-all` against a local fake Strava.
+
+Seeds a temporary database with connected users, then syncs all of them at
+each concurrency level. Every run starts from an empty DailyMileage table.
+
+Usage:
+    python -m bench.sync_all [--users 200] [--latency 0.05] [--concurrency 1 8 32]
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import tempfile
+import time
+from unittest.mock import patch
+
+import bench  # noqa: F401  (sets a throwaway ENCRYPTION_KEY)
+import collector
+import database
+import strava_http
+import sync_engine
+from bench.fake_strava import FakeStravaServer
+
+
+def seed_connected_users(count):
+    database.init_db()
+    expires_at = int(time.time()) + 6 * 3600
+    for n in range(count):
+        user_id = database.create_user(f"runner{n}", "password")
+        database.update_user_tokens(user_id, f"token-{user_id}", f"refresh-{user_id}", expires_at)
+    # Start from the fake server's limits rather than Strava's defaults
+    database.record_strava_rate_limit(strava_http.parse_rate_limit(
+        {"X-RateLimit-Limit": "100000,1000000", "X-RateLimit-Usage": "0,0"}
+    ))
+
+
+def reset_rate_limit():
+    with database.db_connection() as conn:
+        conn.execute("UPDATE StravaRateLimit SET short_usage = 0, daily_usage = 0")
+
+
+def reset_activities():
+    with database.db_connection() as conn:
+        conn.execute("DELETE FROM DailyMileage")
+        conn.execute("UPDATE Users SET last_sync_time = 0")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--activities', type=int, default=120, help="activities per user on the fake server")
+    parser.add_argument('--per-page', type=int, default=50)
+    parser.add_argument('--latency', type=float, default=0.05, help="fake Strava response delay in seconds")
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--json', action='store_true')
+    args = parser.parse_args()
+
+    server = FakeStravaServer(latency=args.latency, activities_per_user=args.activities).start()
+    collector.use_strava_base_url(server.url)
+    results = []
+    try:
+        with tempfile.TemporaryDirectory() as tmp, \
+             patch.object(database, 'DB_NAME', os.path.join(tmp, 'bench.db')):
+            seed_connected_users(args.users)
+            for concurrency in args.concurrency:
+                reset_activities()
+                reset_rate_limit()
+                strava_http.set_pool_size(concurrency)
+                with contextlib.redirect_stdout(io.StringIO()):
+                    report = asyncio.run(sync_engine.sync_all(
+                        database.get_users_with_strava(), concurrency, args.per_page
+                    ))
+                results.append(report['totals'])
+            database.close_pooled_connection()
+    finally:
+        server.stop()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{'concurrency':>11}{'seconds':>10}{'users/s':>10}{'p50 user s':>12}{'ok':>6}{'failed':>8}{'activities':>12}")
+    for t in results:
+        print(f"{t['concurrency']:>11}{t['seconds']:>10.2f}{t['users_per_second']:>10.1f}"
+              f"{t['p50_user_seconds']:>12.3f}{t['ok']:>6}{t['failed'] + t['deferred']:>8}{t['activities_imported']:>12}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+"""
+Plays Strava's side of a push subscription against a running app.
+
+Sends the verification handshake and activity/athlete events exactly as
+Strava would, so webhook handling can be tried locally together with
+bench/fake_strava.py (whose activity ids are athlete_id * 1_000_000 + n).
+The app only accepts events once STRAVA_WEBHOOK_SUBSCRIPTION_ID is set; 1
+matches the default --subscription-id.
+
+Usage:
+    python -m bench.webhook_simulator --app-url http://127.0.0.1:8000 verify --verify-token TOKEN
+    python -m bench.webhook_simulator create --athlete 3 --activity 3000007
+    python -m bench.webhook_simulator update --athlete 3 --activity 3000007 --title "New name"
+    python -m bench.webhook_simulator delete --athlete 3 --activity 3000007
+    python -m bench.webhook_simulator deauthorize --athlete 3
+    python -m bench.webhook_simulator burst --athletes 20 --events 500
+"""
+import argparse
+import random
+import secrets
+import time
+import requests
+
+DEFAULT_APP_URL = "http://127.0.0.1:8000"
+DEFAULT_SUBSCRIPTION_ID = 1
+
+
+def activity_event(aspect_type, activity_id, athlete_id, updates=None,
+                   subscription_id=DEFAULT_SUBSCRIPTION_ID, event_time=None):
+    """A Strava activity event body (aspect_type is 'create', 'update' or 'delete')."""
+    return {
+        'object_type': 'activity',
+        'object_id': activity_id,
+        'aspect_type': aspect_type,
+        'owner_id': athlete_id,
+        'subscription_id': subscription_id,
+        'event_time': event_time or int(time.time()),
+        'updates': updates or {},
+    }
+
+
+def deauthorization_event(athlete_id, subscription_id=DEFAULT_SUBSCRIPTION_ID, event_time=None):
+    """The athlete event Strava sends when an athlete revokes the app's access."""
+    return {
+        'object_type': 'athlete',
+        'object_id': athlete_id,
+        'aspect_type': 'update',
+        'owner_id': athlete_id,
+        'subscription_id': subscription_id,
+        'event_time': event_time or int(time.time()),
+        'updates': {'authorized': 'false'},
+    }
+
+
+def verify(app_url, verify_token):
+    """Run the subscription handshake. Returns True if the app echoed the challenge."""
+    challenge = secrets.token_hex(8)
+    response = requests.get(f"{app_url}/strava/webhook", params={
+        'hub.mode': 'subscribe', 'hub.verify_token': verify_token, 'hub.challenge': challenge,
+    }, timeout=5)
+    return response.status_code == 200 and response.json().get('hub.challenge') == challenge
+
+
+def send(app_url, event, session=requests):
+    """POST one event. Returns (status code, seconds until the app acknowledged it)."""
+    start = time.perf_counter()
+    response = session.post(f"{app_url}/strava/webhook", json=event, timeout=5)
+    return response.status_code, time.perf_counter() - start
+
+
+def burst(app_url, athletes, events, subscription_id, seed=1):
+    """Send `events` create events spread over `athletes` athletes; report acknowledgement latency."""
+    rng = random.Random(seed)
+    timings = []
+    failures = 0
+    with requests.Session() as session:
+        for n in range(events):
+            athlete_id = rng.randint(1, athletes)
+            event = activity_event('create', athlete_id * 1_000_000 + rng.randrange(1_000_000), athlete_id,
+                                   subscription_id=subscription_id, event_time=int(time.time()) + n)
+            status, seconds = send(app_url, event, session)
+            failures += status != 200
+            timings.append(seconds)
+    timings.sort()
+    return {
+        'events': events,
+        'failures': failures,
+        'p50_ms': timings[len(timings) // 2] * 1e3,
+        'p95_ms': timings[int(len(timings) * 0.95)] * 1e3,
+        'max_ms': timings[-1] * 1e3,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--app-url', default=DEFAULT_APP_URL)
+    parser.add_argument('--subscription-id', type=int, default=DEFAULT_SUBSCRIPTION_ID)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    verify_parser = commands.add_parser('verify', help="run the subscription handshake")
+    verify_parser.add_argument('--verify-token', required=True)
+    for aspect_type in ('create', 'update', 'delete'):
+        event_parser = commands.add_parser(aspect_type, help=f"send an activity {aspect_type} event")
+        event_parser.add_argument('--athlete', type=int, required=True)
+        event_parser.add_argument('--activity', type=int, required=True)
+        if aspect_type == 'update':
+            event_parser.add_argument('--title', help="send as updates.title")
+    deauth_parser = commands.add_parser('deauthorize', help="send an athlete deauthorization event")
+    deauth_parser.add_argument('--athlete', type=int, required=True)
+    burst_parser = commands.add_parser('burst', help="send many create events and time the acknowledgements")
+    burst_parser.add_argument('--athletes', type=int, default=20)
+    burst_parser.add_argument('--events', type=int, default=500)
+    args = parser.parse_args()
+
+    if args.command == 'verify':
+        print("verified" if verify(args.app_url, args.verify_token) else "verification failed")
+    elif args.command == 'burst':
+        result = burst(args.app_url, args.athletes, args.events, args.subscription_id)
+        print(f"{result['events']} events, {result['failures']} failed; acknowledged in "
+              f"p50 {result['p50_ms']:.1f} ms, p95 {result['p95_ms']:.1f} ms, max {result['max_ms']:.1f} ms")
+    else:
+        if args.command == 'deauthorize':
+            event = deauthorization_event(args.athlete, args.subscription_id)
+        else:
+            updates = {'title': args.title} if getattr(args, 'title', None) else {}
+            event = activity_event(args.command, args.activity, args.athlete, updates, args.subscription_id)
+        status, seconds = send(args.app_url, event)
+        print(f"{args.command}: HTTP {status} in {seconds * 1e3:.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
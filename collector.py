@@ -1,11 +1,104 @@
 import os
 from dotenv import load_dotenv
+import threading
 import time
-import requests
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import database
+import strava_http
 
 load_dotenv()
 
+# Point at a local fake server (see bench/fake_strava.py) to run offline
+STRAVA_BASE_URL = os.getenv("STRAVA_BASE_URL", "https://www.strava.com")
+TOKEN_URL = f"{STRAVA_BASE_URL}/oauth/token"
+ACTIVITIES_URL = f"{STRAVA_BASE_URL}/api/v3/athlete/activities"
+ACTIVITY_URL = f"{STRAVA_BASE_URL}/api/v3/activities/{{activity_id}}"
+
+
+def use_strava_base_url(base_url):
+    """Send all Strava calls to base_url instead (e.g. a local fake server)."""
+    global STRAVA_BASE_URL, TOKEN_URL, ACTIVITIES_URL, ACTIVITY_URL
+    STRAVA_BASE_URL = base_url.rstrip("/")
+    TOKEN_URL = f"{STRAVA_BASE_URL}/oauth/token"
+    ACTIVITIES_URL = f"{STRAVA_BASE_URL}/api/v3/athlete/activities"
+    ACTIVITY_URL = f"{STRAVA_BASE_URL}/api/v3/activities/{{activity_id}}"
+
+# Strava caps per_page at 200
+MAX_PER_PAGE = 200
+ACTIVITIES_PER_PAGE = MAX_PER_PAGE
+
+# Low-priority calls must leave this share of each Strava rate-limit window
+# for interactive ones (OAuth, syncs for users who are using the app)
+LOW_PRIORITY_RESERVE = 0.3
+
+# Full-history backfills must leave this share of each window free
+# (configurable, since they can use thousands of requests per athlete)
+BACKFILL_RESERVE = float(os.getenv("BACKFILL_RESERVE_FRACTION", 0.5))
+
+# Users who haven't logged in for this long get low-priority syncs
+INACTIVE_USER_SECONDS = 7 * 86400
+
+
+# Tokens are refreshed this many seconds before they expire
+TOKEN_REFRESH_MARGIN = 300
+
+# Decrypted tokens are cached in-process for TOKEN_CACHE_TTL seconds, for at
+# most TOKEN_CACHE_SIZE users (least recently used are evicted first)
+TOKEN_CACHE_TTL = 300
+TOKEN_CACHE_SIZE = 1024
+# Disconnects in other processes are noticed within this many seconds
+TOKEN_GENERATION_INTERVAL = 5
+
+# A refresh lock in the database lapses after this long if its owner dies;
+# other workers poll every REFRESH_WAIT_INTERVAL seconds for the new token
+REFRESH_LOCK_TTL = 30
+REFRESH_WAIT_INTERVAL = 0.2
+
+_token_cache = OrderedDict()
+_token_cache_lock = threading.Lock()
+# database.get_token_generation() as last seen, and when (monotonic)
+_token_generation = None
+_token_generation_checked_at = 0.0
+# Striped so threads refreshing different users rarely wait on each other
+_refresh_locks = [threading.Lock() for _ in range(64)]
+
+
+class RateLimitDeferred(Exception):
+    """Raised instead of calling Strava when the shared request budget is too low."""
+
+    def __init__(self, retry_at):
+        super().__init__(f"Strava request budget exhausted until {retry_at}")
+        self.retry_at = retry_at
+
+
+def strava_call(send, url, priority='high', **kwargs):
+    """
+    Call Strava through `send` (strava_http.get or strava_http.post) after
+    taking a request from the shared budget, then feed the response's
+    rate-limit headers back into it. Raises RateLimitDeferred if no budget is left.
+    """
+    if priority == 'backfill':
+        reserve_fraction = BACKFILL_RESERVE
+    else:
+        reserve_fraction = LOW_PRIORITY_RESERVE if priority == 'low' else 0.0
+    budget = database.reserve_strava_requests(1, reserve_fraction)
+    if not budget['granted']:
+        raise RateLimitDeferred(budget['retry_at'])
+
+    response = send(url, **kwargs)
+    rate_limit = getattr(response, 'rate_limit', None)
+    if isinstance(rate_limit, dict):
+        database.record_strava_rate_limit(rate_limit)
+    return response
+
+
+def priority_for_last_login(last_login_time):
+    """'high' for users who logged in recently, 'low' for everyone else."""
+    return 'high' if time.time() - (last_login_time or 0) < INACTIVE_USER_SECONDS else 'low'
+
+
 def exchange_code_for_tokens(code):
     client_id = os.getenv("STRAVA_CLIENT_ID")
     client_secret = os.getenv("STRAVA_CLIENT_SECRET")
@@ -16,7 +109,7 @@ def exchange_code_for_tokens(code):
         'code': code,
         'grant_type': 'authorization_code'
     }
-    response = requests.post("https://www.strava.com/oauth/token", data=payload)
+    response = strava_call(strava_http.post, TOKEN_URL, data=payload)
 
     if response.status_code != 200:
         print(f"Error exchanging code: {response.text}")
@@ -45,30 +138,106 @@ def authorize_and_save_user(code, user_id):
         expires_at,
         strava_id,
     )
+    clear_token_cache(user_id)
+
+def _cache_tokens(user_id, tokens):
+    with _token_cache_lock:
+        _token_cache[user_id] = (tokens, time.monotonic())
+        _token_cache.move_to_end(user_id)
+        while len(_token_cache) > TOKEN_CACHE_SIZE:
+            _token_cache.popitem(last=False)
+
+def clear_token_cache(user_id=None):
+    """Forget cached tokens for one user, or for everyone."""
+    global _token_generation, _token_generation_checked_at
+    with _token_cache_lock:
+        if user_id is None:
+            _token_cache.clear()
+            _token_generation = None
+            _token_generation_checked_at = 0.0
+        else:
+            _token_cache.pop(user_id, None)
+
+def _check_token_generation():
+    """
+    Drop every cached token if any user's Strava tokens were revoked since the last
+    check (a deauthorize webhook, the settings page in another worker), which only
+    clears the cache of the process that did it. Asks the database at most once
+    every TOKEN_GENERATION_INTERVAL seconds, so cache hits don't query.
+    """
+    global _token_generation, _token_generation_checked_at
+    now = time.monotonic()
+    if now - _token_generation_checked_at < TOKEN_GENERATION_INTERVAL:
+        return
+    generation = database.get_token_generation()
+    with _token_cache_lock:
+        if _token_generation is not None and generation != _token_generation:
+            _token_cache.clear()
+        _token_generation = generation
+        _token_generation_checked_at = now
+
+def get_cached_tokens(user_id):
+    """Decrypted tokens for a user, from the cache if fresh, otherwise from the database."""
+    _check_token_generation()
+    with _token_cache_lock:
+        entry = _token_cache.get(user_id)
+        if entry and time.monotonic() - entry[1] < TOKEN_CACHE_TTL:
+            _token_cache.move_to_end(user_id)
+            return entry[0]
 
-def get_valid_access_token(user_id):
     tokens = database.get_user_tokens(user_id)
+    if tokens:
+        _cache_tokens(user_id, tokens)
+    return tokens
+
+def _token_expiring(tokens):
+    token_expiration = tokens['token_expiration']
+    return token_expiration is None or time.time() > (token_expiration - TOKEN_REFRESH_MARGIN)
+
+def get_valid_access_token(user_id):
+    tokens = get_cached_tokens(user_id)
 
     if not tokens:
         print(f"No tokens found for User: {user_id}")
         return None
     
-    access_token = tokens['strava_access_token']
-    refresh_token = tokens['strava_refresh_token']
-    token_expiration = tokens['token_expiration']
-    
-    if token_expiration is None or time.time() > (token_expiration - 300):
-        print(f"DEBUG: Refreshing token for User {user_id}")
-        return refresh_access_token(user_id, refresh_token)
+    if not _token_expiring(tokens):
+        return tokens['strava_access_token']
 
-    return access_token
+    # Only one thread per process refreshes a given user at a time
+    with _refresh_locks[hash(user_id) % len(_refresh_locks)]:
+        return _refresh_once(user_id)
+
+def _refresh_once(user_id):
+    """Refresh a user's token unless another worker already is; workers coordinate through the database."""
+    owner = f"{os.getpid()}-{uuid.uuid4().hex}"
+    while True:
+        if database.acquire_token_refresh_lock(user_id, owner, REFRESH_LOCK_TTL):
+            try:
+                # Re-read under the lock: another thread or worker may have just refreshed
+                tokens = database.get_user_tokens(user_id)
+                if not tokens:
+                    return None
+                if not _token_expiring(tokens):
+                    _cache_tokens(user_id, tokens)
+                    return tokens['strava_access_token']
+                print(f"Refreshing Strava token for User: {user_id}")
+                return refresh_access_token(user_id, tokens['strava_refresh_token'])
+            finally:
+                database.release_token_refresh_lock(user_id, owner)
+
+        # Another worker is refreshing; use its token as soon as it lands
+        time.sleep(REFRESH_WAIT_INTERVAL)
+        tokens = database.get_user_tokens(user_id)
+        if tokens and not _token_expiring(tokens):
+            _cache_tokens(user_id, tokens)
+            return tokens['strava_access_token']
 
 
 def refresh_access_token(user_id, refresh_token):
     client_id = os.getenv('STRAVA_CLIENT_ID')
     client_secret = os.getenv('STRAVA_CLIENT_SECRET')
     """Refresh Strava access token. Returns new access token."""
-    token_url = "https://www.strava.com/oauth/token"
     payload = {
         'client_id': client_id,
         'client_secret': client_secret,
@@ -76,7 +245,7 @@ def refresh_access_token(user_id, refresh_token):
         'refresh_token': refresh_token
     }
     
-    response = requests.post(token_url, data=payload)
+    response = strava_call(strava_http.post, TOKEN_URL, data=payload)
     response.raise_for_status()
     data = response.json()
 
@@ -86,10 +255,96 @@ def refresh_access_token(user_id, refresh_token):
         data['refresh_token'],
         data['expires_at']
     )
+    _cache_tokens(user_id, {
+        'strava_access_token': data['access_token'],
+        'strava_refresh_token': data['refresh_token'],
+        'token_expiration': data['expires_at']
+    })
 
     return data['access_token']
 
-def fetch_and_save_user_data(user_id):
+def parse_activity(activity):
+    """Convert a Strava activity into the row shape database.create_activities expects."""
+    return {
+        'date': activity['start_date_local'].split('T')[0],
+        'distance': round(activity['distance'] * 0.000621371, 2),
+        'activity_id': activity['id'],
+        'activity_title': activity.get('name'),
+    }
+
+def fetch_activity_page(token, after, page, per_page, priority='high', before=None):
+    """
+    Fetch one page of the athlete's activities started after the `after` (and before the `before`) timestamp.
+    Strava lists activities oldest first when `after` is given, and newest first when it is None.
+    """
+    headers = {"Authorization": f"Bearer {token}"}
+    params = {"page": page, "per_page": per_page}
+    if after is not None:
+        params["after"] = after
+    if before is not None:
+        params["before"] = before
+
+    response = strava_call(strava_http.get, ACTIVITIES_URL, priority, headers=headers, params=params)
+    response.raise_for_status()
+    return response.json()
+
+def fetch_activity(token, activity_id, priority='high'):
+    """Fetch one activity. Returns None if Strava no longer shows it to us (deleted, or made private)."""
+    headers = {"Authorization": f"Bearer {token}"}
+    response = strava_call(strava_http.get, ACTIVITY_URL.format(activity_id=activity_id), priority, headers=headers)
+    if response.status_code == 404:
+        return None
+    response.raise_for_status()
+    return response.json()
+
+def fetch_activity_streams(token, activity_id, stream_types, priority='low'):
+    """
+    Fetch an activity's per-second streams. Returns {stream_type: [values]} for the
+    types Strava has, or None if Strava no longer shows the activity to us.
+    """
+    headers = {"Authorization": f"Bearer {token}"}
+    params = {"keys": ",".join(stream_types), "key_by_type": "true"}
+    url = ACTIVITY_URL.format(activity_id=activity_id) + "/streams"
+    response = strava_call(strava_http.get, url, priority, headers=headers, params=params)
+    if response.status_code == 404:
+        return None
+    response.raise_for_status()
+    return {stream_type: stream['data'] for stream_type, stream in response.json().items()}
+
+def iter_activity_pages(token, after, per_page=ACTIVITIES_PER_PAGE, priority='high'):
+    """
+    Yield pages of activities until Strava returns a short page.
+    While the caller handles one page the next one is already being fetched,
+    so at most two pages are held in memory.
+    """
+    per_page = max(1, min(per_page, MAX_PER_PAGE))
+    page_number = 1
+
+    executor = ThreadPoolExecutor(max_workers=1)
+    next_page = executor.submit(fetch_activity_page, token, after, page_number, per_page, priority)
+    try:
+        while next_page is not None:
+            page = next_page.result()
+            next_page = None
+            if len(page) == per_page:
+                page_number += 1
+                next_page = executor.submit(fetch_activity_page, token, after, page_number, per_page, priority)
+            if page:
+                yield page
+    finally:
+        # Don't leave a prefetch running if the caller stopped early or a write failed
+        if next_page is not None:
+            next_page.cancel()
+        # The prefetch thread opened pooled connections of its own (strava_call
+        # reserves budget in the database); close them there once it's idle
+        executor.submit(database.close_pooled_connection)
+        executor.shutdown(wait=False)
+
+def fetch_and_save_user_data(user_id, per_page=ACTIVITIES_PER_PAGE, priority='high'):
+    """
+    Sync new activities for a user. Returns the number imported, or None if the sync failed.
+    Raises RateLimitDeferred if the Strava budget ran out; pages already fetched stay saved.
+    """
     seconds_in_30_days = 2592000
 
     try:
@@ -102,30 +357,25 @@ def fetch_and_save_user_data(user_id):
         else:
             start_date = int(time.time()) - seconds_in_30_days
 
-        url = "https://www.strava.com/api/v3/athlete/activities"
-        headers = {"Authorization": f"Bearer {token}"}
-        params = {"after": start_date, "per_page": 50}
-
-        response = requests.get(url,headers=headers, params=params)
-        response.raise_for_status()
-        activities = response.json()
-
-        count = 0
-        for activity in activities:
-            miles = round(activity['distance'] * 0.000621371, 2)
-            date_str = activity['start_date_local'].split('T')[0]
-            activity_id = activity['id']
+        inserted = 0
+        skipped = 0
+        for page in iter_activity_pages(token, start_date, per_page, priority):
+            rows = [parse_activity(activity) for activity in page]
+            result = database.create_activities(user_id, rows)
+            inserted += result['inserted']
+            skipped += result['skipped']
 
-            database.create_activity(
-                user_id=user_id,
-                date=date_str,
-                distance=miles,
-                activity_id=activity_id
+        print(f"Imported {inserted} activities for User: {user_id} ({skipped} already saved)")
+        return inserted
 
-            )
-            count += 1
+    except RateLimitDeferred:
+        raise
+    except Exception as e:
+        print(f"Error for User {user_id}: {e}")
+        return None
 
-        print(f"Imported {count} activities for User: {user_id}")
 
-    except Exception as e:
-        print(f"Error for User {user_id}: {e}")
\ No newline at end of file
+if __name__ == "__main__":
+    # python -m collector sync-all --concurrency 32
+    import sync_engine
+    sync_engine.main()
@@ -1,14 +1,45 @@
+import datetime
+import functools
+import json
 import os
 import sqlite3
+import threading
 import time
-from werkzeug.security import generate_password_hash, check_password_hash
+from concurrent.futures import Future
+from contextlib import contextmanager
 from dotenv import load_dotenv
 from cryptography.fernet import Fernet
+import metrics
+import passwords
+import storage
 
 DB_NAME = "MileageTracker.db"
 
+# Reuse one connection per thread (per gunicorn worker) instead of opening a new
+# one for every query. Set to False to fall back to connect-per-call.
+POOL_CONNECTIONS = True
+
+# Size of sqlite3's per-connection prepared statement cache
+STATEMENT_CACHE_SIZE = 128
+
+# How long a writer waits for another connection's write lock
+BUSY_TIMEOUT_MS = 5000
+
+CONNECTION_PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA cache_size = -16000",
+    "PRAGMA mmap_size = 134217728",
+    f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}",
+)
+
 load_dotenv()
 
+# 'sqlite' keeps every table in DB_NAME; 'sharded' moves each user's rows into
+# one of STORAGE_SHARDS files next to it (see storage.py)
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "sqlite")
+STORAGE_SHARDS = int(os.getenv("STORAGE_SHARDS", 8))
+
 #ENCRYPTION/DECRYPTION STUFF
 
 key = os.getenv("ENCRYPTION_KEY")
@@ -33,122 +64,846 @@ def decrypt_token(token):
 
 
 def init_db():
-    with sqlite3.connect(DB_NAME) as conn:
-        cursor = conn.cursor()
-    
-        # User table
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS Users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username VARCHAR(50) UNIQUE NOT NULL,
-            password_hash VARCHAR(128) NOT NULL,
-                       
-            strava_athlete_id INTEGER UNIQUE,
-            strava_access_token TEXT,
-            strava_refresh_token TEXT,
-            token_expiration INTEGER,
-            last_sync_time INTEGER DEFAULT 0
-        )
-        """)
-        # Athlete table
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS  Athletes (
-            user_id INTEGER PRIMARY KEY,
-            mileage_goal REAL,
-            long_run_goal REAL,
-            FOREIGN KEY (user_id) REFERENCES Users(id)
-        )
-        """)
-        # DailyMileage table
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS  DailyMileage (
-            user_id INTEGER,
-            activity_id INTEGER PRIMARY KEY,
-            date DATE,
-            distance REAL,
-            activity_title VARCHAR(100),
-            FOREIGN KEY (user_id) REFERENCES Users(id),
-            UNIQUE(user_id, date, activity_id)
-        )
-        """)
+    """Create the database files if needed and apply any pending schema migrations to each."""
+    for path in get_storage().paths():
+        with _connection_to(path) as conn:
+            migrate(conn)
+
+
+# SCHEMA MIGRATIONS
+# Each migration runs once, in order, and is recorded in SchemaMigrations.
+# Add new ones to the end of MIGRATIONS; never edit one that has shipped.
+# Databases created before versioning start at version 0, so the early
+# migrations only create what is missing.
+
+def _migration_initial_schema(cursor):
+    # User table
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS Users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        username VARCHAR(50) UNIQUE NOT NULL,
+        password_hash VARCHAR(128) NOT NULL,
+                   
+        strava_athlete_id INTEGER UNIQUE,
+        strava_access_token TEXT,
+        strava_refresh_token TEXT,
+        token_expiration INTEGER,
+        last_sync_time INTEGER DEFAULT 0
+    )
+    """)
+    # Athlete table
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS  Athletes (
+        user_id INTEGER PRIMARY KEY,
+        mileage_goal REAL,
+        long_run_goal REAL,
+        FOREIGN KEY (user_id) REFERENCES Users(id)
+    )
+    """)
+    # DailyMileage table
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS  DailyMileage (
+        user_id INTEGER,
+        activity_id INTEGER PRIMARY KEY,
+        date DATE,
+        distance REAL,
+        activity_title VARCHAR(100),
+        FOREIGN KEY (user_id) REFERENCES Users(id),
+        UNIQUE(user_id, date, activity_id)
+    )
+    """)
+
+
+def _migration_sync_jobs(cursor):
+    # SyncJobs table (background Strava sync queue, see sync_worker.py)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS SyncJobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        status VARCHAR(10) NOT NULL DEFAULT 'queued',
+        created_at INTEGER NOT NULL,
+        started_at INTEGER,
+        finished_at INTEGER,
+        activities_imported INTEGER DEFAULT 0,
+        error TEXT,
+        FOREIGN KEY (user_id) REFERENCES Users(id)
+    )
+    """)
+    # At most one queued/running job per user
+    cursor.execute("""
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_syncjobs_active_user
+        ON SyncJobs(user_id) WHERE status IN ('queued', 'running')
+    """)
+
+
+def _migration_strava_rate_limit(cursor):
+    # StravaRateLimit table (single row: the app-wide Strava request budget)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS StravaRateLimit (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        short_limit INTEGER NOT NULL,
+        short_usage INTEGER NOT NULL DEFAULT 0,
+        window_start INTEGER NOT NULL DEFAULT 0,
+        daily_limit INTEGER NOT NULL,
+        daily_usage INTEGER NOT NULL DEFAULT 0,
+        day INTEGER NOT NULL DEFAULT 0
+    )
+    """)
+    _add_column_if_missing(cursor, "Users", "last_login_time", "INTEGER DEFAULT 0")
+    _add_column_if_missing(cursor, "SyncJobs", "priority", "VARCHAR(4) NOT NULL DEFAULT 'high'")
+    _add_column_if_missing(cursor, "SyncJobs", "run_after", "INTEGER NOT NULL DEFAULT 0")
+
+
+def _migration_token_refresh_locks(cursor):
+    # TokenRefreshLocks table (one Strava token refresh per user across all workers)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS TokenRefreshLocks (
+        user_id INTEGER PRIMARY KEY,
+        owner TEXT NOT NULL,
+        expires_at INTEGER NOT NULL
+    )
+    """)
+
+
+def _migration_drop_dailymileage_unique(cursor):
+    # activity_id is already the primary key, so UNIQUE(user_id, date, activity_id)
+    # only added a second index to maintain on every insert. SQLite can't drop a
+    # table constraint, so rebuild the table without it.
+    cursor.execute("""
+    CREATE TABLE DailyMileage_new (
+        user_id INTEGER,
+        activity_id INTEGER PRIMARY KEY,
+        date DATE,
+        distance REAL,
+        activity_title VARCHAR(100),
+        FOREIGN KEY (user_id) REFERENCES Users(id)
+    )
+    """)
+    cursor.execute("""
+    INSERT INTO DailyMileage_new (user_id, activity_id, date, distance, activity_title)
+    SELECT user_id, activity_id, date, distance, activity_title FROM DailyMileage
+    """)
+    cursor.execute("DROP TABLE DailyMileage")
+    cursor.execute("ALTER TABLE DailyMileage_new RENAME TO DailyMileage")
+
+
+def _migration_dailymileage_user_date_index(cursor):
+    # Serves "WHERE user_id = ? ORDER BY date DESC" without a table scan or sort
+    cursor.execute("""
+    CREATE INDEX IF NOT EXISTS idx_dailymileage_user_date
+        ON DailyMileage(user_id, date DESC, distance)
+    """)
+
+
+def _migration_syncjobs_user_index(cursor):
+    # Serves get_latest_sync_job, which /api/sync-status polls
+    cursor.execute("""
+    CREATE INDEX IF NOT EXISTS idx_syncjobs_user
+        ON SyncJobs(user_id, id)
+    """)
+
+
+def _migration_mileage_rollups(cursor):
+    # Per-user daily and Monday-start weekly totals, kept in step with
+    # DailyMileage by _refresh_rollups so the dashboard never sums raw history
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS DailyTotals (
+        user_id INTEGER NOT NULL,
+        date DATE NOT NULL,
+        distance REAL NOT NULL,
+        activity_count INTEGER NOT NULL,
+        PRIMARY KEY (user_id, date)
+    ) WITHOUT ROWID
+    """)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS WeeklyTotals (
+        user_id INTEGER NOT NULL,
+        week_start DATE NOT NULL,
+        distance REAL NOT NULL,
+        longest_run REAL NOT NULL,
+        activity_count INTEGER NOT NULL,
+        PRIMARY KEY (user_id, week_start)
+    ) WITHOUT ROWID
+    """)
+    cursor.execute("""
+    INSERT OR REPLACE INTO DailyTotals (user_id, date, distance, activity_count)
+    SELECT user_id, date, SUM(distance), COUNT(*)
+    FROM DailyMileage
+    GROUP BY user_id, date
+    """)
+    cursor.execute(f"""
+    INSERT OR REPLACE INTO WeeklyTotals (user_id, week_start, distance, longest_run, activity_count)
+    SELECT user_id, {_WEEK_START_SQL}, SUM(distance), MAX(distance), COUNT(*)
+    FROM DailyMileage
+    GROUP BY user_id, {_WEEK_START_SQL}
+    """)
+
+
+def _migration_dailymileage_keyset_index(cursor):
+    # Add activity_id so paging by (date, activity_id) reads the index in order
+    cursor.execute("DROP INDEX IF EXISTS idx_dailymileage_user_date")
+    cursor.execute("""
+    CREATE INDEX idx_dailymileage_user_date
+        ON DailyMileage(user_id, date DESC, activity_id DESC, distance)
+    """)
+
+
+def _migration_user_data_version(cursor):
+    # Bumped whenever anything the dashboard APIs return changes; the basis for their ETags
+    _add_column_if_missing(cursor, "Users", "data_version", "INTEGER NOT NULL DEFAULT 0")
+    _add_column_if_missing(cursor, "Users", "data_modified_at", "INTEGER NOT NULL DEFAULT 0")
+
+
+def _migration_activity_change_versions(cursor):
+    # Each activity records the user data_version it was written at, and deletions
+    # leave a tombstone, so clients can ask for just what changed since a version
+    _add_column_if_missing(cursor, "DailyMileage", "version", "INTEGER NOT NULL DEFAULT 0")
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS ActivityTombstones (
+        user_id INTEGER NOT NULL,
+        activity_id INTEGER NOT NULL,
+        version INTEGER NOT NULL,
+        PRIMARY KEY (user_id, activity_id)
+    ) WITHOUT ROWID
+    """)
+    cursor.execute("""
+    CREATE INDEX IF NOT EXISTS idx_dailymileage_user_version
+        ON DailyMileage(user_id, version)
+    """)
+    cursor.execute("""
+    CREATE INDEX IF NOT EXISTS idx_activitytombstones_user_version
+        ON ActivityTombstones(user_id, version)
+    """)
+
+
+def _migration_metrics(cursor):
+    # Every process adds its metric deltas here so /metrics sums all of them (see metrics.py)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS Metrics (
+        name TEXT NOT NULL,
+        labels TEXT NOT NULL,
+        series TEXT NOT NULL,
+        value REAL NOT NULL,
+        PRIMARY KEY (name, labels, series)
+    ) WITHOUT ROWID
+    """)
+
+
+def _migration_webhook_events(cursor):
+    # Strava push events, acknowledged by app.py and processed by sync_worker.py (see webhooks.py)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS WebhookEvents (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        object_type VARCHAR(10) NOT NULL,
+        object_id INTEGER NOT NULL,
+        aspect_type VARCHAR(10) NOT NULL,
+        owner_id INTEGER NOT NULL,
+        updates TEXT,
+        event_time INTEGER NOT NULL,
+        received_at INTEGER NOT NULL,
+        status VARCHAR(10) NOT NULL DEFAULT 'queued',
+        run_after INTEGER NOT NULL DEFAULT 0,
+        started_at INTEGER,
+        finished_at INTEGER,
+        error TEXT
+    )
+    """)
+    # Strava redelivers events it didn't see acknowledged; store each one once
+    cursor.execute("""
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_webhookevents_event
+        ON WebhookEvents(object_type, object_id, aspect_type, event_time)
+    """)
+    cursor.execute("""
+    CREATE INDEX IF NOT EXISTS idx_webhookevents_queued
+        ON WebhookEvents(run_after, id) WHERE status = 'queued'
+    """)
+
+
+def _migration_backfills(cursor):
+    # Full-history imports for newly connected athletes, checkpointed per page (see backfill.py)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS Backfills (
+        user_id INTEGER PRIMARY KEY,
+        status VARCHAR(10) NOT NULL DEFAULT 'queued',
+        before_time INTEGER NOT NULL,
+        next_page INTEGER NOT NULL DEFAULT 1,
+        pages_fetched INTEGER NOT NULL DEFAULT 0,
+        activities_imported INTEGER NOT NULL DEFAULT 0,
+        oldest_date TEXT,
+        run_after INTEGER NOT NULL DEFAULT 0,
+        created_at INTEGER NOT NULL,
+        started_at INTEGER,
+        updated_at INTEGER,
+        finished_at INTEGER,
+        error TEXT,
+        FOREIGN KEY (user_id) REFERENCES Users(id)
+    )
+    """)
+    cursor.execute("""
+    CREATE INDEX IF NOT EXISTS idx_backfills_queued
+        ON Backfills(run_after, updated_at) WHERE status = 'queued'
+    """)
+
+
+def _migration_activity_streams(cursor):
+    # Per-second Strava streams, packed by streams.py, and the activities still to fetch them for
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS ActivityStreams (
+        user_id INTEGER NOT NULL,
+        activity_id INTEGER NOT NULL,
+        stream_type VARCHAR(20) NOT NULL,
+        typecode CHAR(1) NOT NULL,
+        scale INTEGER NOT NULL,
+        count INTEGER NOT NULL,
+        data BLOB NOT NULL,
+        PRIMARY KEY (user_id, activity_id, stream_type)
+    )
+    """)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS StreamQueue (
+        user_id INTEGER NOT NULL,
+        activity_id INTEGER NOT NULL,
+        queued_at INTEGER NOT NULL,
+        run_after INTEGER NOT NULL DEFAULT 0,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, activity_id)
+    )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_streamqueue_due ON StreamQueue(run_after, queued_at)")
+
+
+def _migration_stream_versions(cursor):
+    # Streams are versioned on their own, so saving them leaves data_version (and the
+    # activity/summary ETags, response cache and delta sync) alone
+    _add_column_if_missing(cursor, "Users", "streams_version", "INTEGER NOT NULL DEFAULT 0")
+    _add_column_if_missing(cursor, "ActivityStreams", "version", "INTEGER NOT NULL DEFAULT 0")
+
+
+def _migration_token_generation(cursor):
+    # Single row, bumped whenever a user's Strava tokens are revoked, so every
+    # process knows to drop its cached tokens (see collector.get_cached_tokens)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS TokenGeneration (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        generation INTEGER NOT NULL DEFAULT 0
+    )
+    """)
+    cursor.execute("INSERT OR IGNORE INTO TokenGeneration (id, generation) VALUES (1, 0)")
+
+
+# Monday of the week containing DailyMileage.date (strftime('%w') is 0 for Sunday)
+_WEEK_START_SQL = "date(date, '-' || ((CAST(strftime('%w', date) AS INTEGER) + 6) % 7) || ' days')"
+
+
+MIGRATIONS = [
+    (1, "initial schema", _migration_initial_schema),
+    (2, "sync job queue", _migration_sync_jobs),
+    (3, "Strava rate limit budget", _migration_strava_rate_limit),
+    (4, "token refresh locks", _migration_token_refresh_locks),
+    (5, "drop redundant DailyMileage unique constraint", _migration_drop_dailymileage_unique),
+    (6, "DailyMileage (user_id, date DESC, distance) index", _migration_dailymileage_user_date_index),
+    (7, "SyncJobs (user_id, id) index", _migration_syncjobs_user_index),
+    (8, "daily and weekly mileage rollups", _migration_mileage_rollups),
+    (9, "DailyMileage (user_id, date, activity_id) index", _migration_dailymileage_keyset_index),
+    (10, "Users.data_version", _migration_user_data_version),
+    (11, "activity change versions and tombstones", _migration_activity_change_versions),
+    (12, "Metrics", _migration_metrics),
+    (13, "WebhookEvents", _migration_webhook_events),
+    (14, "Backfills", _migration_backfills),
+    (15, "ActivityStreams and StreamQueue", _migration_activity_streams),
+    (16, "stream versions", _migration_stream_versions),
+    (17, "TokenGeneration", _migration_token_generation),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+# Workers starting together queue up on the write lock while one of them migrates
+MIGRATION_BUSY_TIMEOUT_MS = 60000
+
+# DB files this process has already migrated
+_migrated = set()
+
+
+def _add_column_if_missing(cursor, table, column, definition):
+    columns = [row[1] for row in cursor.execute(f"PRAGMA table_info({table})")]
+    if column not in columns:
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+
+def get_schema_version(conn):
+    row = conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'SchemaMigrations'"
+    ).fetchone()
+    if row is None:
+        return 0
+    return conn.execute("SELECT COALESCE(MAX(version), 0) FROM SchemaMigrations").fetchone()[0]
+
+
+def migrate(conn):
+    """
+    Apply pending migrations on conn. Safe to call from every worker at once:
+    each migration runs in its own IMMEDIATE transaction and re-checks the
+    version after taking the write lock. Returns the number applied.
+    """
+    if conn.in_transaction:
         conn.commit()
+    conn.execute(f"PRAGMA busy_timeout = {MIGRATION_BUSY_TIMEOUT_MS}")
+    applied = 0
+    try:
+        for version, name, migration in MIGRATIONS:
+            if get_schema_version(conn) >= version:
+                continue
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute("""
+                CREATE TABLE IF NOT EXISTS SchemaMigrations (
+                    version INTEGER PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    applied_at INTEGER NOT NULL
+                )
+                """)
+                # Another worker may have applied it while we waited for the lock
+                if get_schema_version(conn) < version:
+                    migration(conn.cursor())
+                    conn.execute(
+                        "INSERT INTO SchemaMigrations (version, name, applied_at) VALUES (?, ?, ?)",
+                        (version, name, int(time.time()))
+                    )
+                    applied += 1
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+    finally:
+        conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}")
+    return applied
+
+
+def get_storage():
+    """The storage layout for DB_NAME and STORAGE_BACKEND (see storage.py)."""
+    return storage.get_storage(DB_NAME, STORAGE_BACKEND, STORAGE_SHARDS)
 
 
-def get_connection():
+def get_connection(path=None):
+    """Open a new, unpooled connection (to DB_NAME by default). The caller is responsible for closing it."""
+    path = path or DB_NAME
     try:
-        conn = sqlite3.connect(DB_NAME)
+        conn = sqlite3.connect(path, cached_statements=STATEMENT_CACHE_SIZE)
         conn.row_factory = sqlite3.Row
         return conn
     except Exception as e:
-        print(f"Unable to establish connection to {DB_NAME}")
+        print(f"Unable to establish connection to {path}")
+
+# CONNECTION POOLING
+
+_local = threading.local()
+
+
+def _configure_connection(conn):
+    for pragma in CONNECTION_PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+def _open_connection(path):
+    conn = _configure_connection(get_connection(path))
+    if path not in _migrated:
+        migrate(conn)
+        _migrated.add(path)
+    return conn
+
+
+def _get_pooled_connection(path=None):
+    """Return this thread's connection to `path` (the directory database by default), opening it on first use."""
+    layout = get_storage()
+    pooled = getattr(_local, 'pooled', None)
+    if pooled is not None:
+        pid, pooled_layout, conns = pooled
+        # DB_NAME changed (tests) or we were forked: never share a connection
+        if pid != os.getpid() or pooled_layout is not layout:
+            close_pooled_connection()
+            pooled = None
+    if pooled is None:
+        pooled = _local.pooled = (os.getpid(), layout, {})
+        _local.depth = {}
+    conns = pooled[2]
+    path = path or layout.directory
+    if path not in conns:
+        conns[path] = _open_connection(path)
+        _local.depth[path] = 0
+    return conns[path]
+
+
+def close_pooled_connection():
+    """Close this thread's pooled connections, if it has any."""
+    pooled = getattr(_local, 'pooled', None)
+    _local.pooled = None
+    _local.depth = {}
+    if pooled is not None and pooled[0] == os.getpid():
+        for conn in pooled[2].values():
+            conn.close()
+
+
+@contextmanager
+def _connection_to(path):
+    if not POOL_CONNECTIONS:
+        conn = _open_connection(path)
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        return
+
+    conn = _get_pooled_connection(path)
+    _local.depth[path] += 1
+    try:
+        yield conn
+        if _local.depth[path] == 1:
+            conn.commit()
+    except Exception:
+        if _local.depth[path] == 1:
+            conn.rollback()
+        raise
+    finally:
+        _local.depth[path] -= 1
+
+
+def db_connection(user_id=None):
+    """
+    Yield a connection to the file holding user_id's rows, or to the directory
+    database (usernames, queues, rate limits, metrics) when user_id is None, and
+    commit when the outermost block for that file exits, or roll back if it
+    raises. Nested blocks on the same file share the outer block's transaction.
+
+    With a single file every block is on the same connection, so nesting a
+    user's block inside a directory block makes one transaction. With shards they
+    are two: the inner (user) block commits first, so directory writes made
+    after it, like a checkpoint, are only committed once the user's rows are.
+    """
+    layout = get_storage()
+    return _connection_to(layout.directory if user_id is None else layout.shard_for(user_id))
+
+
+def _shard_connections():
+    """Yield a connection to each file holding user rows in turn, each in its own transaction."""
+    for path in get_storage().shards:
+        with _connection_to(path) as conn:
+            yield conn
+
+# Tables whose rows live in their user's shard, and the column holding the user
+# id. Everything else is in the directory database (Users is in both).
+USER_TABLES = {
+    'Users': 'id',
+    'Athletes': 'user_id',
+    'DailyMileage': 'user_id',
+    'ActivityTombstones': 'user_id',
+    'DailyTotals': 'user_id',
+    'WeeklyTotals': 'user_id',
+    'ActivityStreams': 'user_id',
+    'StreamQueue': 'user_id',
+    'TokenRefreshLocks': 'user_id',
+}
+
+
+def copy_to_shards():
+    """
+    Copy every user's rows from DB_NAME into their shard, to switch an existing
+    single-file database to STORAGE_BACKEND=sharded. Rows already copied are
+    skipped, so it can be rerun. Returns {table: rows copied}.
+    """
+    layout = get_storage()
+    init_db()
+    copied = dict.fromkeys(USER_TABLES, 0)
+    for index, path in enumerate(layout.shards):
+        if path == layout.directory:
+            continue
+        conn = get_connection(path)
+        try:
+            conn.execute("ATTACH DATABASE ? AS source", (layout.directory,))
+            for table, column in USER_TABLES.items():
+                columns = [row[1] for row in conn.execute(f"PRAGMA main.table_info({table})")]
+                # Password hashes stay in the directory only
+                selected = ["''" if name == 'password_hash' else name for name in columns]
+                copied[table] += conn.execute(
+                    f"""INSERT OR IGNORE INTO main.{table} ({', '.join(columns)})
+                        SELECT {', '.join(selected)} FROM source.{table} WHERE {column} % ? = ?""",
+                    (len(layout.shards), index)
+                ).rowcount
+            conn.commit()
+            conn.execute("DETACH DATABASE source")
+        finally:
+            conn.close()
+    return copied
+
+# GROUP COMMIT
+# During a bulk sync many threads each commit small writes (a page of
+# activities, a sync time, a refreshed token). While a write buffer is running
+# (see write_buffer()), those calls are queued instead and committed together
+# by one background thread, in one transaction per file, when WRITE_BUFFER_SIZE
+# writes are waiting or the oldest has waited WRITE_BUFFER_DELAY seconds. Each
+# caller still blocks until its write is committed, and buffered commits are
+# fsynced (synchronous=FULL), so a call that returns has reached the disk.
+
+WRITE_BUFFER_SIZE = 64
+WRITE_BUFFER_DELAY = 0.02
+WRITE_BUFFER_SYNCHRONOUS = "FULL"
+
+_write_buffer = None
+_write_buffer_lock = threading.Lock()
+
+
+class _WriteBuffer:
+    def __init__(self, max_writes, max_delay):
+        self.max_writes = max_writes
+        self.max_delay = max_delay
+        self.pid = os.getpid()
+        # (user_id, write, future); write is a callable doing one unbuffered write
+        self.pending = []
+        self.first_queued_at = None
+        self.stopping = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self._run, name="db-write-buffer", daemon=True)
+        self.thread.start()
+
+    def submit(self, user_id, write):
+        future = Future()
+        with self.condition:
+            if self.stopping:
+                raise RuntimeError("The write buffer is stopped")
+            if not self.pending:
+                self.first_queued_at = time.monotonic()
+            self.pending.append((user_id, write, future))
+            if len(self.pending) == 1 or len(self.pending) >= self.max_writes:
+                self.condition.notify()
+        return future
+
+    def stop(self):
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+        self.thread.join()
+
+    def _next_batch(self):
+        with self.condition:
+            while not self.pending and not self.stopping:
+                self.condition.wait()
+            while self.pending and len(self.pending) < self.max_writes and not self.stopping:
+                remaining = self.first_queued_at + self.max_delay - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            batch, self.pending = self.pending, []
+            return batch
+
+    def _run(self):
+        try:
+            while True:
+                batch = self._next_batch()
+                if not batch:
+                    return
+                self._flush(batch)
+        finally:
+            close_pooled_connection()
+
+    def _flush(self, batch):
+        layout = get_storage()
+        by_path = {}
+        for user_id, write, future in batch:
+            by_path.setdefault(layout.shard_for(user_id), []).append((write, future))
+        for path, writes in by_path.items():
+            try:
+                _get_pooled_connection(path).execute(f"PRAGMA synchronous = {WRITE_BUFFER_SYNCHRONOUS}")
+                with _connection_to(path):
+                    results = [write() for write, _ in writes]
+            except Exception:
+                # One bad write mustn't fail the rest: redo them one transaction each
+                for write, future in writes:
+                    try:
+                        future.set_result(write())
+                    except Exception as e:
+                        future.set_exception(e)
+                continue
+            metrics.inc('db_group_commits_total', {})
+            metrics.inc('db_group_commit_writes_total', {}, len(writes))
+            for (_, future), result in zip(writes, results):
+                future.set_result(result)
+
+
+def _in_transaction():
+    return any(getattr(_local, 'depth', {}).values())
+
+
+def _group_committed(fn):
+    """Send calls to the running write buffer and wait for their commit, unless made inside a transaction."""
+    @functools.wraps(fn)
+    def wrapper(user_id, *args, **kwargs):
+        buffer = _write_buffer
+        # A forked child has no flusher thread, and open transactions must see their own writes
+        if buffer is None or buffer.pid != os.getpid() or _in_transaction():
+            return fn(user_id, *args, **kwargs)
+        return buffer.submit(user_id, functools.partial(fn, user_id, *args, **kwargs)).result()
+    return wrapper
+
+
+def start_write_buffer(max_writes=None, max_delay=None):
+    """Start group-committing buffered writes in this process (see write_buffer())."""
+    global _write_buffer
+    with _write_buffer_lock:
+        if _write_buffer is None or _write_buffer.pid != os.getpid():
+            _write_buffer = _WriteBuffer(max_writes or WRITE_BUFFER_SIZE,
+                                         WRITE_BUFFER_DELAY if max_delay is None else max_delay)
+
+
+def stop_write_buffer():
+    """Commit everything still buffered and go back to committing each write on its own."""
+    global _write_buffer
+    with _write_buffer_lock:
+        buffer, _write_buffer = _write_buffer, None
+    if buffer is not None and buffer.pid == os.getpid():
+        buffer.stop()
+
+
+@contextmanager
+def write_buffer(max_writes=None, max_delay=None):
+    """
+    Group-commit create_activities, update_last_sync_time and update_user_tokens
+    calls made from any thread while the block runs (e.g. during sync-all).
+    """
+    start_write_buffer(max_writes, max_delay)
+    try:
+        yield
+    finally:
+        stop_write_buffer()
 
 # USER MANAGEMENT METHODS
 
+@_group_committed
 def update_last_sync_time(user_id):
     current_time = int(time.time())
-    conn = get_connection()
-    cursor = conn.cursor()
-    conn.execute(
-        "UPDATE Users SET last_sync_time = ? WHERE id = ?", 
-        (current_time, user_id)
-    )
-    conn.commit()
-    conn.close()
+    with db_connection(user_id) as conn:
+        conn.execute(
+            "UPDATE Users SET last_sync_time = ? WHERE id = ?", 
+            (current_time, user_id)
+        )
+
+def update_last_login_time(user_id):
+    with db_connection(user_id) as conn:
+        conn.execute(
+            "UPDATE Users SET last_login_time = ? WHERE id = ?",
+            (int(time.time()), user_id)
+        )
 
 def get_last_sync_time(user_id):
-    conn = get_connection()
-    try:
-        cursor = conn.cursor()
-        cursor.execute(
+    with db_connection(user_id) as conn:
+        row = conn.execute(
             "SELECT last_sync_time FROM Users WHERE id = ?", 
             (user_id,)
-        )
-        row = cursor.fetchone()
-        conn.close()
-        if row and row[0]:
-            return row[0]
-        else:
-            return None
-    finally:
-        conn.close()
+        ).fetchone()
+    if row and row[0]:
+        return row[0]
+    else:
+        return None
     
 def get_user_by_id(user_id):
     """Get user by ID. Returns row dict or None."""
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM Users WHERE id = ?", (user_id,))
-    row = cursor.fetchone()
-    conn.close()
+    with db_connection(user_id) as conn:
+        row = conn.execute("SELECT * FROM Users WHERE id = ?", (user_id,)).fetchone()
     return dict(row) if row else None
 
 
+def get_user_context(user_id):
+    """
+    Get everything a request needs about a user (Users joined with Athletes) in one query.
+    Returns dict or None. Tokens and the password hash are left out.
+    """
+    with db_connection(user_id) as conn:
+        row = conn.execute(
+            """SELECT u.id, u.username, u.last_sync_time, u.last_login_time,
+                      u.data_version, u.data_modified_at,
+                      u.strava_access_token IS NOT NULL AS has_strava,
+                      a.mileage_goal, a.long_run_goal
+               FROM Users u
+               LEFT JOIN Athletes a ON a.user_id = u.id
+               WHERE u.id = ?""",
+            (user_id,)
+        ).fetchone()
+    if not row:
+        return None
+    context = dict(row)
+    context['has_strava'] = bool(context['has_strava'])
+    return context
+
+
+def _next_data_version(conn, user_id):
+    """
+    The data_version _bump_data_version will set, to stamp rows written before it.
+    Raises ValueError if the user has no Users row on this connection's database,
+    rather than letting the NOT NULL version make INSERT OR IGNORE drop the rows.
+
+    Takes the write lock first if the caller hasn't written yet: otherwise another
+    writer could bump data_version between this read and the caller's first
+    write, and the rows would carry a version clients already hold.
+    """
+    if not conn.in_transaction:
+        conn.execute("BEGIN IMMEDIATE")
+    row = conn.execute("SELECT data_version FROM Users WHERE id = ?", (user_id,)).fetchone()
+    if row is None:
+        raise ValueError(f"User {user_id} does not exist")
+    return row[0] + 1
+
+
+def _bump_data_version(conn, user_id):
+    """Mark the user's activities/goals as changed, on the caller's connection and transaction."""
+    conn.execute(
+        "UPDATE Users SET data_version = data_version + 1, data_modified_at = ? WHERE id = ?",
+        (int(time.time()), user_id)
+    )
+
+
+def get_users_with_strava():
+    """Get every user who has connected Strava. Returns list of dicts with id and last_login_time."""
+    users = []
+    for conn in _shard_connections():
+        users.extend(dict(row) for row in conn.execute(
+            "SELECT id, last_login_time FROM Users WHERE strava_access_token IS NOT NULL"
+        ))
+    return sorted(users, key=lambda user: user['id'])
+
+
 def get_user_by_username(username):
-    """Get user by username. Returns row dict or None."""
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM Users WHERE username = ?", (username,))
-    row = cursor.fetchone()
-    conn.close()
+    """
+    Get user by username from the directory database. Returns row dict or None.
+    Only id, username, password_hash and strava_athlete_id are kept there when sharded.
+    """
+    with db_connection() as conn:
+        row = conn.execute("SELECT * FROM Users WHERE username = ?", (username,)).fetchone()
     return dict(row) if row else None
 
 
 def create_user(username, password):
     """Create a new user. Returns the new user's ID."""
-    # Hash the password using werkzeug's secure hashing
-    password_hash = generate_password_hash(password, method='pbkdf2:sha256')
-    conn = get_connection()
-    cursor = conn.cursor()
+    password_hash = passwords.hash_password(password)
     try:
-        cursor.execute(
-            "INSERT INTO Users (username, password_hash) VALUES (?, ?)",
-            (username, password_hash)
-        )
-        user_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
+        with db_connection() as conn:
+            cursor = conn.execute(
+                "INSERT INTO Users (username, password_hash) VALUES (?, ?)",
+                (username, password_hash)
+            )
+            user_id = cursor.lastrowid
+            # The user's own copy of the row, which holds their tokens and data version
+            # (a no-op with a single file, where it's the same row). Written inside the
+            # directory block, so a user whose shard row failed is never committed
+            with db_connection(user_id) as user_conn:
+                user_conn.execute(
+                    "INSERT OR IGNORE INTO Users (id, username, password_hash) VALUES (?, ?, '')",
+                    (user_id, username)
+                )
         return user_id
     except sqlite3.IntegrityError as e:
-        conn.close()
         # Handle race condition: two simultaneous requests could both pass existence check
         # The second INSERT will fail with IntegrityError due to UNIQUE constraint
         if 'UNIQUE constraint failed' in str(e) or 'username' in str(e).lower():
@@ -158,35 +913,98 @@ def create_user(username, password):
             raise
 
 
+def authenticate(username, password):
+    """
+    Look up a user and check their password in one query. Returns the user row dict or None.
+    A hash made with an older work factor is replaced with a current one.
+    """
+    user_row = get_user_by_username(username)
+    if not user_row or not passwords.check_password(user_row['password_hash'], password):
+        return None
+    if passwords.needs_rehash(user_row['password_hash']):
+        new_hash = passwords.hash_password(password)
+        with db_connection() as conn:
+            conn.execute(
+                "UPDATE Users SET password_hash = ? WHERE id = ? AND password_hash = ?",
+                (new_hash, user_row['id'], user_row['password_hash'])
+            )
+        user_row['password_hash'] = new_hash
+    return user_row
+
+
 def validate_password(username, password):
     """Login a user. Returns True/False."""
-    user_row = get_user_by_username(username)
-    if user_row and check_password_hash(user_row['password_hash'], password):
-        return True
-    else:
-        return False
+    return authenticate(username, password) is not None
     
 
+def get_user_by_strava_athlete_id(strava_athlete_id):
+    """Get the user connected to a Strava athlete (id, username, last_login_time). Returns row dict or None."""
+    with db_connection() as conn:
+        row = conn.execute("SELECT id FROM Users WHERE strava_athlete_id = ?", (strava_athlete_id,)).fetchone()
+    if row is None:
+        return None
+    # The directory only maps the athlete; logins are recorded in the user's shard
+    with db_connection(row['id']) as conn:
+        row = conn.execute("SELECT id, username, last_login_time FROM Users WHERE id = ?", (row['id'],)).fetchone()
+    return dict(row) if row else None
+
+
+def disconnect_strava(user_id):
+    """
+    Forget a user's Strava connection and the activities imported from it
+    (Strava requires this when an athlete deauthorizes the app). Deleted
+    activities leave tombstones for delta sync. Returns how many were deleted.
+    """
+    with db_connection() as directory, db_connection(user_id) as conn:
+        conn.execute(
+            """INSERT OR REPLACE INTO ActivityTombstones (user_id, activity_id, version)
+               SELECT m.user_id, m.activity_id, u.data_version + 1
+               FROM DailyMileage m JOIN Users u ON u.id = m.user_id
+               WHERE m.user_id = ?""",
+            (user_id,)
+        )
+        deleted = conn.execute("DELETE FROM DailyMileage WHERE user_id = ?", (user_id,)).rowcount
+        conn.execute("DELETE FROM DailyTotals WHERE user_id = ?", (user_id,))
+        conn.execute("DELETE FROM WeeklyTotals WHERE user_id = ?", (user_id,))
+        conn.execute("DELETE FROM ActivityStreams WHERE user_id = ?", (user_id,))
+        conn.execute("DELETE FROM StreamQueue WHERE user_id = ?", (user_id,))
+        conn.execute(
+            """UPDATE Users
+               SET strava_athlete_id = NULL, strava_access_token = NULL, strava_refresh_token = NULL,
+                   token_expiration = NULL, last_sync_time = 0
+               WHERE id = ?""",
+            (user_id,)
+        )
+        _bump_data_version(conn, user_id)
+        directory.execute("DELETE FROM Backfills WHERE user_id = ?", (user_id,))
+        directory.execute("UPDATE Users SET strava_athlete_id = NULL WHERE id = ?", (user_id,))
+        directory.execute("UPDATE TokenGeneration SET generation = generation + 1 WHERE id = 1")
+    return deleted
+
+
+def get_token_generation():
+    """How many times any user's Strava tokens have been revoked; cached tokens older than a change are dropped."""
+    with db_connection() as conn:
+        row = conn.execute("SELECT generation FROM TokenGeneration WHERE id = 1").fetchone()
+    return row[0] if row else 0
+
+
 def user_has_strava(user_id):
     """Check if user has Strava tokens. Returns True/False."""
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute(
-        "SELECT strava_access_token FROM Users WHERE id = ?",
-        [user_id]
-    )
-    row = cursor.fetchone()
-    conn.close()
+    with db_connection(user_id) as conn:
+        row = conn.execute(
+            "SELECT strava_access_token FROM Users WHERE id = ?",
+            [user_id]
+        ).fetchone()
     return row is not None and row[0] is not None
 
 
 def get_user_tokens(user_id):
-    conn = get_connection()
-    row = conn.execute(
-        "SELECT strava_access_token, strava_refresh_token, token_expiration FROM Users WHERE id = ?", 
-        (user_id,)
-    ).fetchone()
-    conn.close()
+    with db_connection(user_id) as conn:
+        row = conn.execute(
+            "SELECT strava_access_token, strava_refresh_token, token_expiration FROM Users WHERE id = ?", 
+            (user_id,)
+        ).fetchone()
     if row:
         return {
             'strava_access_token' : decrypt_token(row['strava_access_token']),
@@ -196,106 +1014,855 @@ def get_user_tokens(user_id):
     return row
 
 
+@_group_committed
 def update_user_tokens(user_id, access_token, refresh_token, expires_at):
+    with db_connection(user_id) as conn:
+        conn.execute(
+            """UPDATE Users 
+               SET strava_access_token = ?, 
+                   strava_refresh_token = ?, 
+                   token_expiration = ?
+               WHERE id = ?""",
+            (encrypt_token(access_token), encrypt_token(refresh_token), expires_at, user_id)
+        )
 
-    conn = get_connection()
-    conn.execute(
-        """UPDATE Users 
-           SET strava_access_token = ?, 
-               strava_refresh_token = ?, 
-               token_expiration = ?
-           WHERE id = ?""",
-        (encrypt_token(access_token), encrypt_token(refresh_token), expires_at, user_id)
-    )
-    conn.commit()
-    conn.close()
+
+def acquire_token_refresh_lock(user_id, owner, ttl):
+    """
+    Try to become the only process refreshing this user's Strava token.
+    The lock lapses after ttl seconds in case its owner dies. Returns True/False.
+    """
+    now = int(time.time())
+    with db_connection(user_id) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute(
+            "DELETE FROM TokenRefreshLocks WHERE user_id = ? AND expires_at <= ?",
+            (user_id, now)
+        )
+        conn.execute(
+            "INSERT OR IGNORE INTO TokenRefreshLocks (user_id, owner, expires_at) VALUES (?, ?, ?)",
+            (user_id, owner, now + ttl)
+        )
+        row = conn.execute(
+            "SELECT owner FROM TokenRefreshLocks WHERE user_id = ?", (user_id,)
+        ).fetchone()
+    return row is not None and row['owner'] == owner
+
+
+def release_token_refresh_lock(user_id, owner):
+    with db_connection(user_id) as conn:
+        conn.execute(
+            "DELETE FROM TokenRefreshLocks WHERE user_id = ? AND owner = ?",
+            (user_id, owner)
+        )
 
 
 def save_user_tokens_and_info(user_id, access_token, refresh_token, expires_at, strava_id):
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute(
-        """UPDATE Users 
-           SET strava_athlete_id = ?, 
-               strava_access_token = ?, 
-               strava_refresh_token = ?, 
-               token_expiration = ?
-           WHERE id = ?""",
-        (strava_id, encrypt_token(access_token), encrypt_token(refresh_token), expires_at, user_id)
-    )
+    with db_connection() as directory, db_connection(user_id) as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            """UPDATE Users 
+               SET strava_athlete_id = ?, 
+                   strava_access_token = ?, 
+                   strava_refresh_token = ?, 
+                   token_expiration = ?
+               WHERE id = ?""",
+            (strava_id, encrypt_token(access_token), encrypt_token(refresh_token), expires_at, user_id)
+        )
 
-    # Note: Athletes table only stores user_id, mileage_goal, and long_run_goal
-    # The athlete record should already exist from registration with goals
-    # We don't need to update it here - just ensure it exists
-    cursor.execute(
-        """INSERT OR IGNORE INTO Athletes (user_id, mileage_goal, long_run_goal)
-           VALUES (?, 0, 0)""",
-        (user_id,)
-    )
-    conn.commit()
-    conn.close()
+        # Note: Athletes table only stores user_id, mileage_goal, and long_run_goal
+        # The athlete record should already exist from registration with goals
+        # We don't need to update it here - just ensure it exists
+        cursor.execute(
+            """INSERT OR IGNORE INTO Athletes (user_id, mileage_goal, long_run_goal)
+               VALUES (?, 0, 0)""",
+            (user_id,)
+        )
+        _bump_data_version(conn, user_id)
+        # The directory maps athletes to users for webhook events
+        directory.execute("UPDATE Users SET strava_athlete_id = ? WHERE id = ?", (strava_id, user_id))
     print(f"Tokens and profile info saved for User ID: {user_id}")
 
 
-def create_activity(user_id, date, distance, activity_id):
+# New rows are stamped with the data_version _bump_data_version is about to set (_next_data_version)
+INSERT_ACTIVITY_SQL = """
+    INSERT OR IGNORE INTO DailyMileage (user_id, date, distance, activity_id, activity_title, version)
+    VALUES (?, ?, ?, ?, ?, ?)
+"""
+
+# Queues stream fetches for the rows INSERT_ACTIVITY_SQL just wrote (they carry the next version)
+QUEUE_NEW_STREAMS_SQL = """
+    INSERT OR IGNORE INTO StreamQueue (user_id, activity_id, queued_at)
+    SELECT user_id, activity_id, ?2 FROM DailyMileage
+    WHERE user_id = ?1 AND version = ?3
+"""
+
+def create_activity(user_id, date, distance, activity_id, activity_title=None):
     #will be called when an activity is grabbed by the collector (so info is just passed in)
-    conn = get_connection()
-    conn.execute(
-        "INSERT OR IGNORE INTO DailyMileage (user_id, date, distance, activity_id) VALUES (?, ?, ?, ?)", 
-        (user_id, date, distance, activity_id)
-    )
-    conn.commit()
-    conn.close()
+    with db_connection(user_id) as conn:
+        version = _next_data_version(conn, user_id)
+        cursor = conn.execute(INSERT_ACTIVITY_SQL, (user_id, date, distance, activity_id, activity_title, version))
+        if cursor.rowcount:
+            conn.execute(QUEUE_NEW_STREAMS_SQL, (user_id, int(time.time()), version))
+            _refresh_rollups(conn, user_id, [date])
+            _bump_data_version(conn, user_id)
+
+@_group_committed
+def create_activities(user_id, activities, queue_streams=True):
+    """
+    Insert many activities for one user in a single transaction.
+    Each activity is a dict with date, distance, activity_id and optionally activity_title.
+    New activities are queued for a stream fetch unless queue_streams is False.
+    Returns {'inserted': n, 'skipped': n}; activities already stored are skipped.
+    """
+    if not activities:
+        return {'inserted': 0, 'skipped': 0}
+    with db_connection(user_id) as conn:
+        version = _next_data_version(conn, user_id)
+        rows = [
+            (user_id, activity['date'], activity['distance'], activity['activity_id'],
+             activity.get('activity_title'), version)
+            for activity in activities
+        ]
+        cursor = conn.executemany(INSERT_ACTIVITY_SQL, rows)
+        inserted = cursor.rowcount
+        if inserted:
+            if queue_streams:
+                conn.execute(QUEUE_NEW_STREAMS_SQL, (user_id, int(time.time()), version))
+            _refresh_rollups(conn, user_id, [row[1] for row in rows])
+            _bump_data_version(conn, user_id)
+    return {'inserted': inserted, 'skipped': len(rows) - inserted}
+
+def delete_activity(user_id, activity_id):
+    """Delete one of a user's activities, leaving a tombstone for delta sync. Returns True if it existed."""
+    with db_connection(user_id) as conn:
+        row = conn.execute(
+            "SELECT date FROM DailyMileage WHERE user_id = ? AND activity_id = ?",
+            (user_id, activity_id)
+        ).fetchone()
+        if row is None:
+            return False
+        conn.execute("DELETE FROM DailyMileage WHERE user_id = ? AND activity_id = ?", (user_id, activity_id))
+        conn.execute("DELETE FROM ActivityStreams WHERE user_id = ? AND activity_id = ?", (user_id, activity_id))
+        conn.execute("DELETE FROM StreamQueue WHERE user_id = ? AND activity_id = ?", (user_id, activity_id))
+        conn.execute(
+            "INSERT OR REPLACE INTO ActivityTombstones (user_id, activity_id, version) VALUES (?, ?, ?)",
+            (user_id, activity_id, _next_data_version(conn, user_id))
+        )
+        _refresh_rollups(conn, user_id, [row['date']])
+        _bump_data_version(conn, user_id)
+    return True
+
+def save_activity(user_id, date, distance, activity_id, activity_title=None):
+    """
+    Insert an activity, or update it if it's already stored and changed (e.g. a Strava edit).
+    Returns 'inserted', 'updated' or 'unchanged'.
+    """
+    with db_connection(user_id) as conn:
+        row = conn.execute(
+            "SELECT date, distance, activity_title FROM DailyMileage WHERE user_id = ? AND activity_id = ?",
+            (user_id, activity_id)
+        ).fetchone()
+        if row is None:
+            cursor = conn.execute(
+                INSERT_ACTIVITY_SQL,
+                (user_id, date, distance, activity_id, activity_title, _next_data_version(conn, user_id))
+            )
+            if not cursor.rowcount:
+                # Stored under another user
+                return 'unchanged'
+            _queue_stream_fetch(conn, user_id, activity_id)
+            _refresh_rollups(conn, user_id, [date])
+            _bump_data_version(conn, user_id)
+            return 'inserted'
+
+        if (row['date'], row['distance'], row['activity_title']) == (date, distance, activity_title):
+            return 'unchanged'
+        conn.execute(
+            """UPDATE DailyMileage
+               SET date = ?, distance = ?, activity_title = ?, version = ?
+               WHERE user_id = ? AND activity_id = ?""",
+            (date, distance, activity_title, _next_data_version(conn, user_id), user_id, activity_id)
+        )
+        # An edit (e.g. cropping) can change the streams too
+        _queue_stream_fetch(conn, user_id, activity_id)
+        # The activity may have moved to another day, so refresh both
+        _refresh_rollups(conn, user_id, [row['date'], date])
+        _bump_data_version(conn, user_id)
+    return 'updated'
+
+def get_activity_changes(user_id, since=0):
+    """
+    Activities written and deleted after data version `since`.
+    Returns {'version': current version, 'activities': [...], 'deleted': [activity_id, ...]},
+    or None if the user doesn't exist. since=0 returns every activity and no deletions.
+    Apply `deleted` before `activities`: an activity deleted and then synced again is in both.
+    """
+    with db_connection(user_id) as conn:
+        row = conn.execute("SELECT data_version FROM Users WHERE id = ?", (user_id,)).fetchone()
+        if row is None:
+            return None
+        activities = conn.execute(
+            """SELECT activity_id, date, distance, activity_title
+               FROM DailyMileage
+               WHERE user_id = ? AND version > ?
+               ORDER BY version, activity_id""",
+            # Activities saved before change versions existed are at version 0
+            (user_id, since if since else -1)
+        ).fetchall()
+        deleted = []
+        if since:
+            deleted = conn.execute(
+                "SELECT activity_id FROM ActivityTombstones WHERE user_id = ? AND version > ? ORDER BY version",
+                (user_id, since)
+            ).fetchall()
+    return {
+        'version': row[0],
+        'activities': [dict(activity) for activity in activities],
+        'deleted': [tombstone[0] for tombstone in deleted],
+    }
 
 def create_athlete_with_goals(user_id, mileage_goal, long_run_goal):
     """Create an athlete record with goals. Returns None."""
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute(
-        "INSERT INTO Athletes (user_id, mileage_goal, long_run_goal) VALUES (?, ?, ?)",
-        (user_id, mileage_goal, long_run_goal)
-    )
-    conn.commit()
-    conn.close()
+    with db_connection(user_id) as conn:
+        conn.execute(
+            "INSERT INTO Athletes (user_id, mileage_goal, long_run_goal) VALUES (?, ?, ?)",
+            (user_id, mileage_goal, long_run_goal)
+        )
+        _bump_data_version(conn, user_id)
 
 def get_row_from_athletes_table(user_id):
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM Athletes WHERE user_id = ?", (user_id,))
-    row = cursor.fetchone()
-    conn.close()
+    with db_connection(user_id) as conn:
+        row = conn.execute("SELECT * FROM Athletes WHERE user_id = ?", (user_id,)).fetchone()
     return dict(row) if row else None
 
 
 def set_long_run_goal(username, long_run_goal):
-    user_row = get_row_from_athletes_table(username)
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute("UPDATE Athletes SET long_run_goal = ? WHERE user_id = ?", (long_run_goal, user_row['user_id']))
-    conn.commit()
-    conn.close()
+    with db_connection(username) as conn:
+        user_row = get_row_from_athletes_table(username)
+        conn.execute("UPDATE Athletes SET long_run_goal = ? WHERE user_id = ?", (long_run_goal, user_row['user_id']))
+        _bump_data_version(conn, user_row['user_id'])
 
 
 def set_mileage_goal(username, mileage_goal):
-    user_row = get_row_from_athletes_table(username)
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute("UPDATE Athletes SET mileage_goal = ? WHERE user_id = ?", (mileage_goal, user_row['user_id']))
-    conn.commit()
-    conn.close()
-
-
-def get_activities_for_user(user_id):
-    """Get all activities for a user. Returns list of dicts."""
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute(
-        """SELECT activity_id, date, distance, activity_title 
-           FROM DailyMileage 
-           WHERE user_id = ? 
-           ORDER BY date DESC""",
-        (user_id,)
-    )
-    rows = cursor.fetchall()
-    conn.close()
+    with db_connection(username) as conn:
+        user_row = get_row_from_athletes_table(username)
+        conn.execute("UPDATE Athletes SET mileage_goal = ? WHERE user_id = ?", (mileage_goal, user_row['user_id']))
+        _bump_data_version(conn, user_row['user_id'])
+
+
+def get_activities_for_user(user_id, date_from=None, date_to=None, before=None, limit=None):
+    """
+    Get a user's activities, newest first. Returns list of dicts.
+    date_from/date_to ('YYYY-MM-DD', inclusive) bound the dates; `before` is a
+    (date, activity_id) keyset cursor from the previous page's last row, and
+    `limit` caps the page size. With no arguments every activity is returned.
+    """
+    conditions = ["user_id = ?"]
+    params = [user_id]
+    if date_from:
+        conditions.append("date >= ?")
+        params.append(date_from)
+    if date_to:
+        conditions.append("date <= ?")
+        params.append(date_to)
+    if before:
+        conditions.append("(date, activity_id) < (?, ?)")
+        params.extend(before)
+    sql = f"""SELECT activity_id, date, distance, activity_title 
+              FROM DailyMileage 
+              WHERE {' AND '.join(conditions)} 
+              ORDER BY date DESC, activity_id DESC"""
+    if limit is not None:
+        sql += " LIMIT ?"
+        params.append(limit)
+
+    with db_connection(user_id) as conn:
+        rows = conn.execute(sql, params).fetchall()
     return [dict(row) for row in rows]
+
+
+# SYNC JOB QUEUE
+
+def enqueue_sync_job(user_id, priority='high', run_after=0):
+    """
+    Queue a Strava sync for a user, to run no earlier than run_after. Returns the job ID,
+    reusing an already queued/running job. 'low' priority jobs are claimed after 'high'
+    ones and deferred first when the Strava request budget runs low. A 'high' request
+    (the user is on the site) makes a job still waiting in the queue high priority and due now.
+    """
+    with db_connection() as conn:
+        conn.execute(
+            """INSERT OR IGNORE INTO SyncJobs (user_id, status, created_at, priority, run_after)
+               VALUES (?, 'queued', ?, ?, ?)""",
+            (user_id, int(time.time()), priority, run_after)
+        )
+        if priority == 'high':
+            conn.execute(
+                "UPDATE SyncJobs SET priority = 'high', run_after = 0 WHERE user_id = ? AND status = 'queued'",
+                (user_id,)
+            )
+        row = conn.execute(
+            "SELECT id FROM SyncJobs WHERE user_id = ? AND status IN ('queued', 'running')",
+            (user_id,)
+        ).fetchone()
+    return row['id']
+
+
+def claim_next_sync_job():
+    """Mark the oldest due job (high priority first) as running and return it as a dict, or None if none are due."""
+    with db_connection() as conn:
+        # Take the write lock up front so two workers can't claim the same job
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute(
+            """SELECT * FROM SyncJobs
+               WHERE status = 'queued' AND run_after <= ?
+               ORDER BY priority = 'high' DESC, id
+               LIMIT 1""",
+            (int(time.time()),)
+        ).fetchone()
+        if row is None:
+            return None
+        started_at = int(time.time())
+        conn.execute(
+            "UPDATE SyncJobs SET status = 'running', started_at = ? WHERE id = ?",
+            (started_at, row['id'])
+        )
+    job = dict(row)
+    job['status'] = 'running'
+    job['started_at'] = started_at
+    return job
+
+
+def finish_sync_job(job_id, activities_imported=0, error=None):
+    """Mark a running job as done, or failed if an error message is given."""
+    with db_connection() as conn:
+        conn.execute(
+            """UPDATE SyncJobs
+               SET status = ?, finished_at = ?, activities_imported = ?, error = ?
+               WHERE id = ?""",
+            ('failed' if error else 'done', int(time.time()), activities_imported, error, job_id)
+        )
+
+
+def defer_sync_job(job_id, run_after):
+    """Put a running job back in the queue, not to be claimed before run_after (Unix time)."""
+    with db_connection() as conn:
+        conn.execute(
+            "UPDATE SyncJobs SET status = 'queued', started_at = NULL, run_after = ? WHERE id = ?",
+            (run_after, job_id)
+        )
+
+
+def requeue_stale_sync_jobs(max_age):
+    """Put jobs left running for more than max_age seconds (e.g. by a crashed worker) back in the queue."""
+    with db_connection() as conn:
+        cursor = conn.execute(
+            "UPDATE SyncJobs SET status = 'queued', started_at = NULL WHERE status = 'running' AND started_at < ?",
+            (int(time.time()) - max_age,)
+        )
+        return cursor.rowcount
+
+
+def get_latest_sync_job(user_id):
+    """Get the user's most recent sync job. Returns row dict or None."""
+    with db_connection() as conn:
+        row = conn.execute(
+            "SELECT * FROM SyncJobs WHERE user_id = ? ORDER BY id DESC LIMIT 1",
+            (user_id,)
+        ).fetchone()
+    return dict(row) if row else None
+
+
+# BACKFILLS
+
+def enqueue_backfill(user_id, restart=False):
+    """
+    Queue a full-history import for a user, covering activities started before now.
+    A failed backfill is requeued from its checkpoint; restart=True starts over.
+    Returns the backfill as a dict.
+    """
+    now = int(time.time())
+    with db_connection() as conn:
+        if restart:
+            conn.execute("DELETE FROM Backfills WHERE user_id = ?", (user_id,))
+        conn.execute(
+            """INSERT INTO Backfills (user_id, status, before_time, created_at) VALUES (?, 'queued', ?, ?)
+               ON CONFLICT (user_id) DO UPDATE SET status = 'queued', run_after = 0, error = NULL
+               WHERE status = 'failed'""",
+            (user_id, now, now)
+        )
+        row = conn.execute("SELECT * FROM Backfills WHERE user_id = ?", (user_id,)).fetchone()
+    return dict(row)
+
+
+def claim_next_backfill():
+    """
+    Mark the queued backfill that advanced least recently as running and return it
+    as a dict, or None if there is none due.
+    """
+    with db_connection() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute(
+            """SELECT * FROM Backfills
+               WHERE status = 'queued' AND run_after <= ?
+               ORDER BY COALESCE(updated_at, 0), user_id
+               LIMIT 1""",
+            (int(time.time()),)
+        ).fetchone()
+        if row is None:
+            return None
+        started_at = int(time.time())
+        conn.execute(
+            "UPDATE Backfills SET status = 'running', started_at = ? WHERE user_id = ?",
+            (started_at, row['user_id'])
+        )
+    backfill = dict(row)
+    backfill['status'] = 'running'
+    backfill['started_at'] = started_at
+    return backfill
+
+
+def save_backfill_page(user_id, activities, next_page):
+    """
+    Save one page of a backfill and move its checkpoint to next_page in the same
+    transaction, so a crash never loses or repeats progress. Returns create_activities' counts.
+    When sharded the activities commit first, so a crash in between can only repeat
+    the page, whose activities are then skipped as already stored.
+    """
+    oldest_date = min((activity['date'] for activity in activities), default=None)
+    with db_connection() as conn:
+        # Streams are only fetched for new activities; a whole history would use up the Strava budget
+        result = create_activities(user_id, activities, queue_streams=False)
+        conn.execute(
+            """UPDATE Backfills
+               SET next_page = ?, pages_fetched = pages_fetched + 1,
+                   activities_imported = activities_imported + ?,
+                   oldest_date = COALESCE(MIN(oldest_date, ?), oldest_date, ?), updated_at = ?
+               WHERE user_id = ?""",
+            (next_page, result['inserted'], oldest_date, oldest_date, int(time.time()), user_id)
+        )
+    return result
+
+
+def release_backfill(user_id, run_after=0):
+    """Put a running backfill back in the queue, not to be claimed before run_after (Unix time)."""
+    with db_connection() as conn:
+        conn.execute(
+            "UPDATE Backfills SET status = 'queued', started_at = NULL, run_after = ? WHERE user_id = ?",
+            (run_after, user_id)
+        )
+
+
+def finish_backfill(user_id, error=None):
+    """Mark a backfill as done, or failed (keeping its checkpoint) if an error message is given."""
+    with db_connection() as conn:
+        conn.execute(
+            "UPDATE Backfills SET status = ?, finished_at = ?, error = ? WHERE user_id = ?",
+            ('failed' if error else 'done', int(time.time()), error, user_id)
+        )
+
+
+def requeue_stale_backfills(max_age):
+    """Put backfills left running for more than max_age seconds back in the queue."""
+    with db_connection() as conn:
+        cursor = conn.execute(
+            "UPDATE Backfills SET status = 'queued', started_at = NULL WHERE status = 'running' AND started_at < ?",
+            (int(time.time()) - max_age,)
+        )
+        return cursor.rowcount
+
+
+def get_backfill(user_id):
+    """Get a user's backfill. Returns row dict or None."""
+    with db_connection() as conn:
+        row = conn.execute("SELECT * FROM Backfills WHERE user_id = ?", (user_id,)).fetchone()
+    return dict(row) if row else None
+
+
+# ACTIVITY STREAMS
+# Stored packed and compressed by streams.py; these helpers only move rows.
+
+def _queue_stream_fetch(conn, user_id, activity_id):
+    conn.execute(
+        """INSERT INTO StreamQueue (user_id, activity_id, queued_at) VALUES (?, ?, ?)
+           ON CONFLICT (user_id, activity_id) DO UPDATE SET run_after = 0, attempts = 0""",
+        (user_id, activity_id, int(time.time()))
+    )
+
+
+# Shard to look in first on the next claim, so one shard's backlog doesn't starve the rest
+_next_stream_shard = 0
+
+
+def claim_next_stream_fetch(lease_seconds):
+    """
+    Take the oldest due stream fetch and hide it from other workers for lease_seconds
+    (after which it is due again, so a crashed worker's fetches are retried).
+    Each shard keeps its own queue; they take turns. Returns a dict with user_id,
+    activity_id and attempts, or None.
+    """
+    global _next_stream_shard
+    now = int(time.time())
+    shards = get_storage().shards
+    for offset in range(len(shards)):
+        index = (_next_stream_shard + offset) % len(shards)
+        with _connection_to(shards[index]) as conn:
+            due = "SELECT user_id, activity_id, attempts FROM StreamQueue WHERE run_after <= ? ORDER BY run_after, queued_at LIMIT 1"
+            # Only take the write lock on shards with something to claim
+            if conn.execute(due, (now,)).fetchone() is None:
+                continue
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(due, (now,)).fetchone()
+            if row is None:
+                continue
+            conn.execute(
+                "UPDATE StreamQueue SET run_after = ? WHERE user_id = ? AND activity_id = ?",
+                (now + lease_seconds, row['user_id'], row['activity_id'])
+            )
+        _next_stream_shard = index + 1
+        return dict(row)
+    return None
+
+
+def defer_stream_fetch(user_id, activity_id, run_after):
+    """Don't try a stream fetch again before run_after (Unix time); doesn't count as a failure."""
+    with db_connection(user_id) as conn:
+        conn.execute(
+            "UPDATE StreamQueue SET run_after = ? WHERE user_id = ? AND activity_id = ?",
+            (run_after, user_id, activity_id)
+        )
+
+
+def retry_stream_fetch(user_id, activity_id, run_after, max_attempts):
+    """Try a stream fetch again at run_after, or give up on it after max_attempts failures."""
+    with db_connection(user_id) as conn:
+        conn.execute(
+            """UPDATE StreamQueue SET attempts = attempts + 1, run_after = ?
+               WHERE user_id = ? AND activity_id = ?""",
+            (run_after, user_id, activity_id)
+        )
+        conn.execute(
+            "DELETE FROM StreamQueue WHERE user_id = ? AND activity_id = ? AND attempts >= ?",
+            (user_id, activity_id, max_attempts)
+        )
+
+
+def save_activity_streams(user_id, activity_id, streams):
+    """
+    Replace an activity's streams and take it off the queue, in one transaction.
+    Each stream is a dict with stream_type, typecode, scale, count and data (see streams.pack).
+    Returns False (saving nothing) if the activity has been deleted meanwhile.
+    """
+    with db_connection(user_id) as conn:
+        conn.execute("DELETE FROM StreamQueue WHERE user_id = ? AND activity_id = ?", (user_id, activity_id))
+        exists = conn.execute(
+            "SELECT 1 FROM DailyMileage WHERE user_id = ? AND activity_id = ?", (user_id, activity_id)
+        ).fetchone()
+        if not exists:
+            return False
+        conn.execute("DELETE FROM ActivityStreams WHERE user_id = ? AND activity_id = ?", (user_id, activity_id))
+        if not streams:
+            return True
+        # Stamped with a new per-user streams version, which /streams ETags are built from
+        conn.execute("UPDATE Users SET streams_version = streams_version + 1 WHERE id = ?", (user_id,))
+        version = conn.execute("SELECT streams_version FROM Users WHERE id = ?", (user_id,)).fetchone()[0]
+        conn.executemany(
+            """INSERT INTO ActivityStreams (user_id, activity_id, stream_type, typecode, scale, count, data, version)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+            [(user_id, activity_id, stream['stream_type'], stream['typecode'], stream['scale'],
+              stream['count'], stream['data'], version) for stream in streams]
+        )
+    return True
+
+
+def get_streams_version(user_id, activity_id):
+    """The version an activity's streams were last saved at, or None if none are stored."""
+    with db_connection(user_id) as conn:
+        row = conn.execute(
+            "SELECT MAX(version) FROM ActivityStreams WHERE user_id = ? AND activity_id = ?",
+            (user_id, activity_id)
+        ).fetchone()
+    return row[0]
+
+
+def get_activity_streams(user_id, activity_id, stream_types=None):
+    """
+    A user's stored streams for one activity, optionally only some types.
+    Returns {stream_type: row dict}; empty if none are stored.
+    """
+    sql = "SELECT stream_type, typecode, scale, count, data FROM ActivityStreams WHERE user_id = ? AND activity_id = ?"
+    params = [user_id, activity_id]
+    if stream_types:
+        sql += f" AND stream_type IN ({', '.join('?' for _ in stream_types)})"
+        params.extend(stream_types)
+    with db_connection(user_id) as conn:
+        rows = conn.execute(sql, params).fetchall()
+    return {row['stream_type']: dict(row) for row in rows}
+
+
+# STRAVA WEBHOOK EVENTS
+
+def enqueue_webhook_event(event):
+    """
+    Store a Strava push event for the worker. `event` is Strava's JSON body.
+    Returns True if it was new, False for a redelivery of an event already stored.
+    """
+    with db_connection() as conn:
+        cursor = conn.execute(
+            """INSERT OR IGNORE INTO WebhookEvents
+               (object_type, object_id, aspect_type, owner_id, updates, event_time, received_at)
+               VALUES (?, ?, ?, ?, ?, ?, ?)""",
+            (event['object_type'], event['object_id'], event['aspect_type'], event['owner_id'],
+             json.dumps(event.get('updates') or {}), event['event_time'], int(time.time()))
+        )
+    return cursor.rowcount == 1
+
+
+def claim_next_webhook_event():
+    """Mark the oldest queued event as running and return it as a dict (updates decoded), or None."""
+    with db_connection() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute(
+            """SELECT * FROM WebhookEvents
+               WHERE status = 'queued' AND run_after <= ?
+               ORDER BY id
+               LIMIT 1""",
+            (int(time.time()),)
+        ).fetchone()
+        if row is None:
+            return None
+        started_at = int(time.time())
+        conn.execute(
+            "UPDATE WebhookEvents SET status = 'running', started_at = ? WHERE id = ?",
+            (started_at, row['id'])
+        )
+    event = dict(row)
+    event['updates'] = json.loads(event['updates'] or '{}')
+    event['status'] = 'running'
+    event['started_at'] = started_at
+    return event
+
+
+def finish_webhook_event(event_id, error=None):
+    """Mark a running event as done, or failed if an error message is given."""
+    with db_connection() as conn:
+        conn.execute(
+            "UPDATE WebhookEvents SET status = ?, finished_at = ?, error = ? WHERE id = ?",
+            ('failed' if error else 'done', int(time.time()), error, event_id)
+        )
+
+
+def defer_webhook_event(event_id, run_after):
+    """Put a running event back in the queue, not to be claimed before run_after (Unix time)."""
+    with db_connection() as conn:
+        conn.execute(
+            "UPDATE WebhookEvents SET status = 'queued', started_at = NULL, run_after = ? WHERE id = ?",
+            (run_after, event_id)
+        )
+
+
+def requeue_stale_webhook_events(max_age):
+    """Put events left running for more than max_age seconds back in the queue."""
+    with db_connection() as conn:
+        cursor = conn.execute(
+            """UPDATE WebhookEvents SET status = 'queued', started_at = NULL
+               WHERE status = 'running' AND started_at < ?""",
+            (int(time.time()) - max_age,)
+        )
+        return cursor.rowcount
+
+
+# STRAVA RATE LIMIT BUDGET
+# Strava's limits are app-wide, so every gunicorn worker and sync process
+# draws from this one row. Windows follow Strava: 15 minute windows start on
+# the quarter hour and the daily window resets at midnight UTC.
+
+DEFAULT_SHORT_LIMIT = 100
+DEFAULT_DAILY_LIMIT = 1000
+SHORT_WINDOW_SECONDS = 900
+DAY_SECONDS = 86400
+
+
+def _ensure_rate_limit_row(conn):
+    conn.execute(
+        "INSERT OR IGNORE INTO StravaRateLimit (id, short_limit, daily_limit) VALUES (1, ?, ?)",
+        (DEFAULT_SHORT_LIMIT, DEFAULT_DAILY_LIMIT)
+    )
+
+
+def _current_usage(row, now):
+    """Usage for the current windows, treating counts from an older window as zero."""
+    window_start = now - now % SHORT_WINDOW_SECONDS
+    day = now // DAY_SECONDS
+    short_usage = row['short_usage'] if row['window_start'] == window_start else 0
+    daily_usage = row['daily_usage'] if row['day'] == day else 0
+    return window_start, day, short_usage, daily_usage
+
+
+def reserve_strava_requests(count=1, reserve_fraction=0.0):
+    """
+    Take `count` requests from the shared Strava budget, leaving `reserve_fraction`
+    of each window untouched (so low-priority work can't starve interactive calls).
+    Returns {'granted': bool, 'retry_at': Unix time budget frees up, or None}.
+    """
+    now = int(time.time())
+    with db_connection() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        _ensure_rate_limit_row(conn)
+        row = conn.execute("SELECT * FROM StravaRateLimit WHERE id = 1").fetchone()
+        window_start, day, short_usage, daily_usage = _current_usage(row, now)
+
+        if daily_usage + count > row['daily_limit'] * (1 - reserve_fraction):
+            return {'granted': False, 'retry_at': (day + 1) * DAY_SECONDS}
+        if short_usage + count > row['short_limit'] * (1 - reserve_fraction):
+            return {'granted': False, 'retry_at': window_start + SHORT_WINDOW_SECONDS}
+
+        conn.execute(
+            """UPDATE StravaRateLimit
+               SET short_usage = ?, window_start = ?, daily_usage = ?, day = ?
+               WHERE id = 1""",
+            (short_usage + count, window_start, daily_usage + count, day)
+        )
+    return {'granted': True, 'retry_at': None}
+
+
+def record_strava_rate_limit(rate_limit):
+    """
+    Update the shared budget from a parsed Strava rate-limit header (see strava_http.parse_rate_limit).
+    Strava's counts are authoritative, but reservations made since that response are kept.
+    """
+    now = int(time.time())
+    with db_connection() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        _ensure_rate_limit_row(conn)
+        row = conn.execute("SELECT * FROM StravaRateLimit WHERE id = 1").fetchone()
+        window_start, day, short_usage, daily_usage = _current_usage(row, now)
+        conn.execute(
+            """UPDATE StravaRateLimit
+               SET short_limit = ?, short_usage = ?, window_start = ?,
+                   daily_limit = ?, daily_usage = ?, day = ?
+               WHERE id = 1""",
+            (rate_limit['short_limit'], max(short_usage, rate_limit['short_usage']), window_start,
+             rate_limit['daily_limit'], max(daily_usage, rate_limit['daily_usage']), day)
+        )
+
+
+def get_strava_rate_limit():
+    """Get the shared Strava budget for the current windows. Returns a dict."""
+    now = int(time.time())
+    with db_connection() as conn:
+        _ensure_rate_limit_row(conn)
+        row = conn.execute("SELECT * FROM StravaRateLimit WHERE id = 1").fetchone()
+    window_start, day, short_usage, daily_usage = _current_usage(row, now)
+    return {
+        'short_limit': row['short_limit'],
+        'short_usage': short_usage,
+        'short_remaining': max(0, row['short_limit'] - short_usage),
+        'daily_limit': row['daily_limit'],
+        'daily_usage': daily_usage,
+        'daily_remaining': max(0, row['daily_limit'] - daily_usage),
+    }
+
+
+# MILEAGE ROLLUPS
+
+def week_start_for(day):
+    """Monday of the week containing day (a date or 'YYYY-MM-DD' string). Returns a date."""
+    if isinstance(day, str):
+        day = datetime.date.fromisoformat(day)
+    return day - datetime.timedelta(days=day.weekday())
+
+
+def _refresh_rollups(conn, user_id, dates):
+    """
+    Recompute DailyTotals and WeeklyTotals for the days and weeks touched by `dates`.
+    Runs on the caller's connection so it commits with the activity writes.
+    """
+    days = sorted(set(dates))
+    weeks = sorted({week_start_for(day) for day in days})
+
+    conn.executemany(
+        "DELETE FROM DailyTotals WHERE user_id = ? AND date = ?",
+        [(user_id, day) for day in days]
+    )
+    conn.executemany(
+        """INSERT INTO DailyTotals (user_id, date, distance, activity_count)
+           SELECT user_id, date, SUM(distance), COUNT(*)
+           FROM DailyMileage
+           WHERE user_id = ? AND date = ?
+           GROUP BY user_id, date""",
+        [(user_id, day) for day in days]
+    )
+
+    week_ranges = [
+        (user_id, week.isoformat(), (week + datetime.timedelta(days=6)).isoformat())
+        for week in weeks
+    ]
+    conn.executemany(
+        "DELETE FROM WeeklyTotals WHERE user_id = ? AND week_start = ?",
+        [(user_id, week.isoformat()) for week in weeks]
+    )
+    conn.executemany(
+        """INSERT INTO WeeklyTotals (user_id, week_start, distance, longest_run, activity_count)
+           SELECT user_id, ?2, SUM(distance), MAX(distance), COUNT(*)
+           FROM DailyMileage
+           WHERE user_id = ?1 AND date BETWEEN ?2 AND ?3
+           GROUP BY user_id""",
+        week_ranges
+    )
+
+
+def get_weekly_summary(user_id, latest_week_start, weeks):
+    """
+    Totals for the `weeks` weeks ending with the week starting latest_week_start (a Monday),
+    newest first. Each week has total, longest_run, activity_count and per-day
+    mileage Monday..Sunday; weeks without runs are filled with zeros.
+    """
+    latest = week_start_for(latest_week_start)
+    earliest = latest - datetime.timedelta(weeks=weeks - 1)
+    last_day = latest + datetime.timedelta(days=6)
+
+    with db_connection(user_id) as conn:
+        week_rows = conn.execute(
+            """SELECT week_start, distance, longest_run, activity_count
+               FROM WeeklyTotals
+               WHERE user_id = ? AND week_start BETWEEN ? AND ?""",
+            (user_id, earliest.isoformat(), latest.isoformat())
+        ).fetchall()
+        day_rows = conn.execute(
+            """SELECT date, distance
+               FROM DailyTotals
+               WHERE user_id = ? AND date BETWEEN ? AND ?""",
+            (user_id, earliest.isoformat(), last_day.isoformat())
+        ).fetchall()
+
+    summaries = {}
+    for n in range(weeks):
+        week = latest - datetime.timedelta(weeks=n)
+        summaries[week.isoformat()] = {
+            'week_start': week.isoformat(),
+            'total': 0.0,
+            'longest_run': 0.0,
+            'activity_count': 0,
+            'daily_mileage': [0.0] * 7,
+        }
+    for row in week_rows:
+        summary = summaries[row['week_start']]
+        summary['total'] = row['distance']
+        summary['longest_run'] = row['longest_run']
+        summary['activity_count'] = row['activity_count']
+    for row in day_rows:
+        day = datetime.date.fromisoformat(row['date'])
+        summaries[week_start_for(day).isoformat()]['daily_mileage'][day.weekday()] = row['distance']
+    return list(summaries.values())
+
+
+# INSTRUMENTATION
+# Time every public helper above for /metrics. Connection plumbing and pure
+# helpers are left alone.
+
+metrics.instrument_module(globals(), skip={
+    'get_connection', 'close_pooled_connection', 'db_connection', 'get_storage', 'week_start_for',
+    'write_buffer',
+})
@@ -15,13 +15,16 @@ pip install -r requirements.txt
 echo "--- Dependencies Installed ---"
 deactivate
 
-# 4. Copy the service file and start the service
-echo "--- Copying Service File ---"
+# 4. Copy the service files and start the services
+echo "--- Copying Service Files ---"
 sudo cp ./stravaapp.service /etc/systemd/system/
+sudo cp ./stravasync.service /etc/systemd/system/
 echo "--- Reloading Systemd ---"
 sudo systemctl daemon-reload
-echo "--- Enabling Service ---"
+echo "--- Enabling Services ---"
 sudo systemctl enable stravaapp.service 
-echo "--- Starting Service ---"
+sudo systemctl enable stravasync.service
+echo "--- Starting Services ---"
 sudo systemctl start stravaapp.service
-echo "--- Service Started ---"
+sudo systemctl start stravasync.service
+echo "--- Services Started ---"
@@ -0,0 +1,173 @@
+"""
+Latency histograms and counters, exposed in Prometheus text format.
+
+Each process records observations in memory and every FLUSH_INTERVAL seconds
+adds them to the Metrics table in the app's database, so /metrics shows the
+totals of every gunicorn worker and the sync worker, including processes
+that have since exited.
+
+    metrics.observe('db_call_duration_seconds', {'function': 'get_user_context'}, 0.0004)
+    metrics.maybe_flush()   # cheap unless FLUSH_INTERVAL has passed
+    metrics.render()        # Prometheus text for everything recorded so far
+"""
+import functools
+import math
+import threading
+import time
+
+# Upper bounds (seconds) of the latency histogram buckets; +Inf is implied
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+HISTOGRAMS = {
+    'http_request_duration_seconds': "Flask request latency by route, method and status",
+    'db_call_duration_seconds': "database.py function latency",
+    'strava_request_duration_seconds': "Outbound Strava request latency by endpoint, method and status",
+}
+COUNTERS = {
+    'db_call_errors_total': "database.py calls that raised an exception",
+    'db_group_commits_total': "Transactions committed by database.py's write buffer",
+    'db_group_commit_writes_total': "Writes committed by database.py's write buffer",
+    'activity_cache_requests_total': "/api/activities responses looked up in activity_cache, by hit or miss",
+    'activity_cache_evictions_total': "Cached /api/activities responses dropped, for space (size) or by a newer data_version (stale)",
+}
+
+FLUSH_INTERVAL = 1.0
+
+# (name, labels, series) -> value added since the last flush. series is a
+# bucket's upper bound ("0.005", "+Inf"), "sum" or "count" for histograms,
+# and "total" for counters.
+_pending = {}
+_pending_lock = threading.Lock()
+_last_flush = time.monotonic()
+
+
+def _format_labels(labels):
+    parts = []
+    for key in sorted(labels):
+        value = str(labels[key]).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        parts.append(f'{key}="{value}"')
+    return ",".join(parts)
+
+
+def _add(name, labels, series, amount):
+    key = (name, labels, series)
+    _pending[key] = _pending.get(key, 0) + amount
+
+
+def observe(name, labels, seconds):
+    """Record one duration in histogram `name`."""
+    labels = _format_labels(labels)
+    # Buckets are stored per-bucket here and made cumulative by render()
+    upper = next((bound for bound in BUCKETS if seconds <= bound), math.inf)
+    with _pending_lock:
+        _add(name, labels, "+Inf" if upper == math.inf else repr(upper), 1)
+        _add(name, labels, "sum", seconds)
+        _add(name, labels, "count", 1)
+
+
+def inc(name, labels, amount=1):
+    """Add to counter `name`."""
+    labels = _format_labels(labels)
+    with _pending_lock:
+        _add(name, labels, "total", amount)
+
+
+def flush():
+    """Add everything recorded in this process since the last flush to the Metrics table."""
+    global _last_flush
+    import database
+
+    with _pending_lock:
+        rows = [(name, labels, series, value) for (name, labels, series), value in _pending.items()]
+        _pending.clear()
+        _last_flush = time.monotonic()
+    if not rows:
+        return
+
+    try:
+        # A connection of its own, so metric writes never land in a request's transaction
+        conn = database.get_connection()
+        try:
+            with conn:
+                conn.executemany(
+                    """INSERT INTO Metrics (name, labels, series, value) VALUES (?, ?, ?, ?)
+                       ON CONFLICT (name, labels, series) DO UPDATE SET value = value + excluded.value""",
+                    rows
+                )
+        finally:
+            conn.close()
+    except Exception as e:
+        print(f"Error flushing metrics: {e}")
+        # Put them back so the next flush retries
+        with _pending_lock:
+            for name, labels, series, value in rows:
+                _add(name, labels, series, value)
+
+
+def maybe_flush():
+    """flush() if FLUSH_INTERVAL has passed since the last one."""
+    if time.monotonic() - _last_flush >= FLUSH_INTERVAL:
+        flush()
+
+
+def render():
+    """Every process's metrics in Prometheus text exposition format."""
+    import database
+
+    flush()
+    with database.db_connection() as conn:
+        rows = conn.execute("SELECT name, labels, series, value FROM Metrics ORDER BY name, labels").fetchall()
+
+    series_by_metric = {}
+    for row in rows:
+        series_by_metric.setdefault(row['name'], {}).setdefault(row['labels'], {})[row['series']] = row['value']
+
+    lines = []
+    for name in sorted(set(HISTOGRAMS) | set(COUNTERS)):
+        is_histogram = name in HISTOGRAMS
+        lines.append(f"# HELP {name} {HISTOGRAMS.get(name) or COUNTERS.get(name)}")
+        lines.append(f"# TYPE {name} {'histogram' if is_histogram else 'counter'}")
+        for labels, values in series_by_metric.get(name, {}).items():
+            sep = "," if labels else ""
+            if not is_histogram:
+                lines.append(f"{name}{{{labels}}} {_number(values.get('total', 0))}")
+                continue
+            cumulative = 0
+            for bound in BUCKETS:
+                cumulative += values.get(repr(bound), 0)
+                lines.append(f'{name}_bucket{{{labels}{sep}le="{bound}"}} {_number(cumulative)}')
+            cumulative += values.get("+Inf", 0)
+            lines.append(f'{name}_bucket{{{labels}{sep}le="+Inf"}} {_number(cumulative)}')
+            lines.append(f"{name}_sum{{{labels}}} {values.get('sum', 0)!r}")
+            lines.append(f"{name}_count{{{labels}}} {_number(values.get('count', 0))}")
+    return "\n".join(lines) + "\n"
+
+
+def _number(value):
+    return str(int(value)) if float(value).is_integer() else repr(value)
+
+
+def timed_db_call(fn):
+    """Wrap a database.py function to record its latency (and errors) by function name."""
+    labels = {'function': fn.__name__}
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        except Exception:
+            inc('db_call_errors_total', labels)
+            raise
+        finally:
+            observe('db_call_duration_seconds', labels, time.perf_counter() - start)
+    return wrapper
+
+
+def instrument_module(namespace, skip=()):
+    """Replace each public function defined in a module (by its globals()) with a timed_db_call wrapper."""
+    module_name = namespace['__name__']
+    for name, value in list(namespace.items()):
+        if (callable(value) and getattr(value, '__module__', None) == module_name
+                and not name.startswith('_') and name not in skip and not isinstance(value, type)):
+            namespace[name] = timed_db_call(value)
@@ -0,0 +1,143 @@
+"""
+Password hashing off the request thread, and a failed-login throttle.
+
+PBKDF2 is deliberately slow, so hashes are computed in a small process pool
+(PASSWORD_HASH_WORKERS per app process, at lower CPU priority) instead of on a
+gunicorn worker's request thread. The work factor is PASSWORD_HASH_ITERATIONS;
+database.authenticate() upgrades a stored hash on the next successful login
+whenever it was made with different parameters.
+
+Failed logins are counted in memory per username and per client IP; once
+either passes its limit, login_blocked() refuses further attempts for the
+rest of the window without hashing anything.
+"""
+import multiprocessing
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dotenv import load_dotenv
+from werkzeug.security import generate_password_hash, check_password_hash
+
+load_dotenv()
+
+# Werkzeug's default for pbkdf2:sha256, so existing hashes don't all need upgrading
+HASH_ITERATIONS = int(os.getenv("PASSWORD_HASH_ITERATIONS", 600_000))
+# 0 hashes on the calling thread
+HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", 1))
+HASH_TIMEOUT = 30
+HASH_WORKER_NICENESS = 10
+
+# Failed logins allowed per username / per IP within FAILED_LOGIN_WINDOW seconds.
+# Counts are kept per app process, for at most FAILED_LOGIN_CACHE_SIZE keys.
+MAX_FAILED_LOGINS_PER_USERNAME = 5
+MAX_FAILED_LOGINS_PER_IP = 20
+FAILED_LOGIN_WINDOW = 900
+FAILED_LOGIN_CACHE_SIZE = 10_000
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+# ('username' | 'ip', value) -> (failures, window start)
+_failed_logins = OrderedDict()
+_failed_logins_lock = threading.Lock()
+
+
+def hash_method():
+    return f"pbkdf2:sha256:{HASH_ITERATIONS}"
+
+
+def _lower_priority():
+    # Hashing shouldn't compete with request handling for CPU
+    os.nice(HASH_WORKER_NICENESS)
+
+
+def _get_pool():
+    global _pool, _pool_pid
+    with _pool_lock:
+        # gunicorn forks workers after import, so each process starts its own pool
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ProcessPoolExecutor(
+                max_workers=HASH_WORKERS,
+                mp_context=multiprocessing.get_context("forkserver"),
+                initializer=_lower_priority,
+            )
+            _pool_pid = os.getpid()
+        return _pool
+
+
+def _run(fn, *args):
+    if HASH_WORKERS <= 0:
+        return fn(*args)
+    pool = _get_pool()
+    try:
+        return pool.submit(fn, *args).result(timeout=HASH_TIMEOUT)
+    except BrokenProcessPool:
+        # A hashing process died; start a fresh pool next time
+        global _pool
+        with _pool_lock:
+            if _pool is pool:
+                _pool = None
+        raise
+
+
+def hash_password(password):
+    """Hash a password with the current work factor."""
+    return _run(generate_password_hash, password, hash_method())
+
+
+def check_password(password_hash, password):
+    """True if `password` matches `password_hash`."""
+    return _run(check_password_hash, password_hash, password)
+
+
+def needs_rehash(password_hash):
+    """True if the hash was made with a different method or work factor than hash_method()."""
+    return password_hash.split("$", 1)[0] != hash_method()
+
+
+# FAILED LOGIN THROTTLE
+
+def _username_key(username):
+    # Exactly as database.authenticate looks it up: "Bob" and "bob" are different accounts
+    return ('username', username or '')
+
+
+def _failures(key, now):
+    entry = _failed_logins.get(key)
+    if entry is None or now - entry[1] >= FAILED_LOGIN_WINDOW:
+        return 0
+    return entry[0]
+
+
+def login_blocked(username, ip):
+    """True if this username or IP has used up its failed logins for the current window."""
+    now = time.monotonic()
+    with _failed_logins_lock:
+        return (_failures(_username_key(username), now) >= MAX_FAILED_LOGINS_PER_USERNAME
+                or _failures(('ip', ip), now) >= MAX_FAILED_LOGINS_PER_IP)
+
+
+def record_failed_login(username, ip):
+    now = time.monotonic()
+    with _failed_logins_lock:
+        for key in (_username_key(username), ('ip', ip)):
+            count = _failures(key, now)
+            start = _failed_logins[key][1] if count else now
+            _failed_logins[key] = (count + 1, start)
+            _failed_logins.move_to_end(key)
+        while len(_failed_logins) > FAILED_LOGIN_CACHE_SIZE:
+            _failed_logins.popitem(last=False)
+
+
+def clear_failed_logins(username=None):
+    """Forget failures for a username after it logs in, or everything. IP counts are kept,
+    so logging into one account doesn't reset guessing at others from the same address."""
+    with _failed_logins_lock:
+        if username is None:
+            _failed_logins.clear()
+        else:
+            _failed_logins.pop(_username_key(username), None)
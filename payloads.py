@@ -0,0 +1,80 @@
+"""
+Encodings for activity lists in API responses.
+
+The default "rows" format is a list of {activity_id, date, distance,
+activity_title} objects. The "columnar" format sends the same activities as
+parallel arrays, which repeats no keys and leaves out the (mostly null)
+titles:
+
+    {
+        "base_date": "2025-01-01",          # earliest date, or null when empty
+        "activity_id": [101, 102],
+        "day": [0, 14],                     # days after base_date
+        "distance": [5.0, 3.1],
+        "activity_title": [[1, "Long run"]] # [index, title] for titled activities only
+    }
+
+Responses are serialized with orjson when it is installed. Both encoders
+write non-ASCII text as raw UTF-8 (ensure_ascii is off), so a response has
+the same bytes, and so the same ETag, with or without orjson.
+"""
+import datetime
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+ACTIVITY_FORMATS = ('rows', 'columnar')
+
+
+def to_columnar(activities):
+    """Encode a list of activity dicts as parallel arrays (see module docstring)."""
+    dates = [datetime.date.fromisoformat(a['date']) for a in activities]
+    base_date = min(dates) if dates else None
+    return {
+        'base_date': base_date.isoformat() if base_date else None,
+        'activity_id': [a['activity_id'] for a in activities],
+        'day': [(date - base_date).days for date in dates],
+        'distance': [a['distance'] for a in activities],
+        'activity_title': [
+            [index, a['activity_title']] for index, a in enumerate(activities) if a.get('activity_title')
+        ],
+    }
+
+
+def from_columnar(payload):
+    """Decode to_columnar's output back into a list of activity dicts."""
+    titles = dict(payload['activity_title'])
+    base_date = datetime.date.fromisoformat(payload['base_date']) if payload['base_date'] else None
+    return [
+        {
+            'activity_id': activity_id,
+            'date': (base_date + datetime.timedelta(days=day)).isoformat(),
+            'distance': distance,
+            'activity_title': titles.get(index),
+        }
+        for index, (activity_id, day, distance)
+        in enumerate(zip(payload['activity_id'], payload['day'], payload['distance']))
+    ]
+
+
+def encode_activities(activities, fmt):
+    return to_columnar(activities) if fmt == 'columnar' else activities
+
+
+class JSONProvider(DefaultJSONProvider):
+    """Flask's JSON provider, but compact responses go through orjson when it's available."""
+
+    # orjson can't escape non-ASCII, so the fallback writes UTF-8 too
+    ensure_ascii = False
+
+    def dumps(self, obj, **kwargs):
+        if orjson is None or kwargs.get('indent') is not None:
+            return super().dumps(obj, **kwargs)
+        # Dates and other non-native types still go through Flask's default() for the same output
+        option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+        if kwargs.get('sort_keys', self.sort_keys):
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, default=self.default, option=option).decode()
@@ -1,5 +1,7 @@
-// --- Global variable to store our raw data from the API ---
-let allAthleteData = [];
+// --- Global state: weekly totals from /api/weekly-summary, keyed by week start (YYYY-MM-DD) ---
+const SUMMARY_WEEKS = 5; // current week + the 4 in the dropdown
+let weeklySummaries = {};
+let mileageGoal = 0;
 
 // --- Helper Functions (KEEP - No changes) ---
 
@@ -27,91 +29,23 @@ function formatDateForAPI(date) {
     return `${year}-${month}-${day}`;
 }
 
-// --- NEW HELPER ---
-// Gets the day name (e.g., "Monday") from a Date object
-function getDayName(date) {
-    // Note: getDay() returns 0 for Sunday, 1 for Monday, etc.
-    const days = ['Sunday', 'Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday'];
-    return days[date.getDay()];
-}
-
-// --- NEW "TRANSLATION" FUNCTION ---
-// Takes the raw data and processes it for a specific week
+// --- "TRANSLATION" FUNCTION ---
+// Looks up the server's totals for a week and shapes them for populateTable
 function processDataForWeek(weekStart) {
-    // The /data endpoint returns activities, which we've transformed into athletes.
-    // This UI is for one athlete. Try to find Tori, otherwise use the last athlete added.
-    let athlete = allAthleteData.find(a => 
-        (a.first_name && a.first_name.toLowerCase() === 'tori') || 
-        (a.first_name && a.last_name && `${a.first_name} ${a.last_name}`.toLowerCase().includes('tori'))
-    );
-    
-    // If Tori not found, use the last athlete (most recently added)
-    if (!athlete && allAthleteData.length > 0) {
-        athlete = allAthleteData[allAthleteData.length - 1];
-    }
-    
-    if (!athlete) {
-        // Return an empty structure if no data
-        return { goal: 0, daily_mileage: {}, total: 0, remaining: 0 };
-    }
-
-    const goal = athlete.mileage_goal || 0;
-    const weeklyRuns = {
-        'Monday': 0, 'Tuesday': 0, 'Wednesday': 0, 'Thursday': 0,
-        'Friday': 0, 'Saturday': 0, 'Sunday': 0
-    };
-    let total = 0;
-
-    // Calculate the end of the selected week (set to end of Sunday)
-    const weekEnd = new Date(weekStart);
-    weekEnd.setDate(weekEnd.getDate() + 6); // 6 days after Monday is Sunday
-    weekEnd.setHours(23, 59, 59, 999); // Set to end of Sunday
-    
-    // Set weekStart to beginning of Monday
-    const weekStartCopy = new Date(weekStart);
-    weekStartCopy.setHours(0, 0, 0, 0);
-
-    // Filter all the athlete's mileage for runs in this week
-    if (!athlete.mileage || !Array.isArray(athlete.mileage)) {
-        console.warn("Athlete mileage is not an array:", athlete);
-        return { goal: goal, daily_mileage: weeklyRuns, total: 0, remaining: goal };
-    }
-    
-    console.log(`Processing ${athlete.mileage.length} activities for week ${weekStartCopy.toISOString().split('T')[0]} to ${weekEnd.toISOString().split('T')[0]}`);
-    
-    athlete.mileage.forEach(run => {
-        if (!run.date) {
-            console.warn("Activity missing date:", run);
-            return;
-        }
-        // Parse the date - handle both date strings and ensure proper parsing
-        let runDate;
-        if (typeof run.date === 'string') {
-            // If it's already a date string, parse it
-            runDate = new Date(run.date + 'T00:00:00');
-        } else {
-            runDate = new Date(run.date);
-        }
-        runDate.setHours(0, 0, 0, 0);
-        
-        // Check if the run date is within the selected week
-        if (runDate >= weekStartCopy && runDate <= weekEnd) {
-            const dayName = getDayName(runDate);
-            const distance = parseFloat(run.distance) || 0;
-            weeklyRuns[dayName] += distance;
-            total += distance;
-            console.log(`Added ${distance} miles on ${dayName} (${run.date})`);
-        }
+    const days = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday'];
+    const week = weeklySummaries[formatDateForAPI(weekStart)];
+    const weeklyRuns = {};
+    days.forEach((day, index) => {
+        weeklyRuns[day] = week ? week.daily_mileage[index] : 0;
     });
-
-    const remaining = Math.max(0, goal - total);
+    const total = week ? week.total : 0;
 
     // Return the *exact* data structure that populateTable expects
     return {
-        goal: goal,
+        goal: mileageGoal,
         daily_mileage: weeklyRuns,
         total: total,
-        remaining: remaining
+        remaining: Math.max(0, mileageGoal - total)
     };
 }
         
@@ -198,34 +132,81 @@ function populateTable(data, weekStart) {
 }
 
 // --- NEW FUNCTION ---
-// Transforms flat list of activities into grouped athlete structure
-function transformActivitiesToAthletes(activities) {
-    if (!activities || activities.length === 0) {
-        return [];
+// Fetches the weekly totals for the dropdown's weeks and the goals from the API
+async function loadWeeklySummary() {
+    const end = formatDateForAPI(getWeekStart());
+    // Revalidate with the cached copy's ETag; the server answers 304 unless new runs or goals landed
+    const response = await fetch(`/api/weekly-summary?weeks=${SUMMARY_WEEKS}&end=${end}`, { cache: 'no-cache' });
+    if (!response.ok) {
+        throw new Error(`HTTP error! status: ${response.status}`);
     }
     
-    // Group activities by athlete_id
-    const activitiesByAthlete = {};
-    activities.forEach(activity => {
-        const athleteId = activity.athlete_id;
-        if (!activitiesByAthlete[athleteId]) {
-            activitiesByAthlete[athleteId] = [];
-        }
-        activitiesByAthlete[athleteId].push(activity);
-    });
-    
-    // Create athlete objects with their activities
-    const athletes = Object.keys(activitiesByAthlete).map(athleteId => {
-        return {
-            athlete_id: parseInt(athleteId),
-            mileage: activitiesByAthlete[athleteId],
-            mileage_goal: 0, // Default, will be updated if we fetch athlete info
-            first_name: null,
-            last_name: null
-        };
+    const data = await response.json(); // Get {weeks: [...], mileage_goal: number, long_run_goal: number}
+    weeklySummaries = {};
+    (data.weeks || []).forEach(week => {
+        weeklySummaries[week.week_start] = week;
     });
-    
-    return athletes;
+    mileageGoal = data.mileage_goal || 0;
+
+    console.log("Loaded weekly summary:", weeklySummaries);
+}
+
+// --- NEW FUNCTION ---
+// Strava syncs run in the background worker. While a sync is queued or
+// running, check on it every few seconds and redraw once new runs land.
+const SYNC_POLL_INTERVAL_MS = 3000;
+let syncWasPending = false;
+
+async function pollSyncStatus() {
+    try {
+        const response = await fetch('/api/sync-status');
+        if (!response.ok) {
+            return;
+        }
+        const sync = await response.json();
+        const backfillPending = showBackfillProgress(sync.backfill);
+
+        if (sync.status === 'queued' || sync.status === 'running') {
+            syncWasPending = true;
+            setTimeout(pollSyncStatus, SYNC_POLL_INTERVAL_MS);
+            return;
+        }
+        if (backfillPending) {
+            setTimeout(pollSyncStatus, SYNC_POLL_INTERVAL_MS);
+        }
+
+        // Only reload for a sync that finished while this page was open
+        if (syncWasPending && sync.status === 'done' && sync.activities_imported > 0) {
+            syncWasPending = false;
+            await loadWeeklySummary();
+            displaySelectedWeek();
+        }
+    } catch (error) {
+        console.error("Error in pollSyncStatus:", error);
+    }
+}
+
+// Newly connected athletes get their older history imported in the
+// background; show how far back it has got. Returns true while it's running.
+function showBackfillProgress(backfill) {
+    const status = document.getElementById('status');
+    if (!backfill || (backfill.status !== 'queued' && backfill.status !== 'running')) {
+        if (status.dataset.backfill) {
+            status.style.display = 'none';
+            delete status.dataset.backfill;
+        }
+        return false;
+    }
+
+    let text = `Importing your Strava history: ${backfill.activities_imported} runs so far`;
+    if (backfill.oldest_date) {
+        text += `, back to ${formatDate(new Date(backfill.oldest_date + 'T00:00:00'))}`;
+    }
+    status.dataset.backfill = 'true';
+    status.className = 'status loading';
+    status.style.display = 'block';
+    status.textContent = text + '...';
+    return true;
 }
 
 // --- REWRITTEN ---
@@ -240,38 +221,8 @@ async function initializePage() {
     status.textContent = 'Loading your activities...';
 
     try {
-        // 1. Fetch activities from /api/activities endpoint
-        const response = await fetch('/api/activities');
-        if (!response.ok) {
-            throw new Error(`HTTP error! status: ${response.status}`);
-        }
-        
-        const data = await response.json(); // Get {activities: [...], mileage_goal: number, long_run_goal: number}
-        const activities = data.activities || [];
-        const mileageGoal = data.mileage_goal || 0;
-        const longRunGoal = data.long_run_goal || 0;
-        
-        // 2. Transform activities into the athlete structure expected by processDataForWeek
-        // Since we're working with a single user, create one athlete object
-        const mileage = activities.map(activity => ({
-            date: activity.date,  // Already in YYYY-MM-DD format
-            distance: activity.distance  // Already in miles
-        }));
-        
-        // Create a single athlete object for the current user
-        allAthleteData = [{
-            mileage: mileage,
-            mileage_goal: mileageGoal,
-            long_run_goal: longRunGoal,
-            first_name: null,
-            last_name: null
-        }];
-        
-        // Debug: Log the transformed data
-        console.log("Loaded activities:", activities.length);
-        console.log("Mileage goal:", mileageGoal);
-        console.log("Long run goal:", longRunGoal);
-        console.log("Transformed athlete data:", allAthleteData);
+        // 1. Fetch the weekly totals
+        await loadWeeklySummary();
 
         // 2. Populate week dropdown (same as before)
         const currentWeekStart = getWeekStart();
@@ -293,6 +244,9 @@ async function initializePage() {
         // Hide loading status after successful load
         status.style.display = 'none';
 
+        // 5. Pick up any runs from a background sync that is still in progress
+        pollSyncStatus();
+
     } catch (error) {
         status.className = 'status error';
         status.style.display = 'block';
@@ -0,0 +1,106 @@
+"""
+Where database.py keeps its tables: one SQLite file, or one per shard.
+
+SQLite lets one connection write to a file at a time, so with everything in
+MileageTracker.db, syncs for different users queue up behind each other's
+transactions. The sharded layout gives each user's rows (their Users row with
+tokens, goals, activities, rollups, streams and stream queue) to one of
+STORAGE_SHARDS files chosen by user id, and keeps a small directory database
+at DB_NAME for what is shared: usernames and password hashes, the Strava
+athlete id lookup, the sync job, backfill and webhook queues, the rate-limit
+budget and metrics. Writes for users on different shards don't wait for
+each other.
+
+Every file gets the full schema, so either layout works with the same SQL;
+database.db_connection(user_id) picks the file.
+
+    layout = get_storage("MileageTracker.db", 'sharded', 4)
+    layout.shard_for(42)    # 'MileageTracker.shard2.db'
+    layout.paths()          # directory first, then the shards
+
+Usage:
+    python -m storage paths    # the files of the configured layout (e.g. for backups)
+    STORAGE_BACKEND=sharded python -m storage copy    # move a single-file database's users into shards
+"""
+import argparse
+import functools
+import os
+import sys
+from abc import ABC, abstractmethod
+
+BACKENDS = ('sqlite', 'sharded')
+
+
+class Storage(ABC):
+    """A layout: `directory` holds the shared tables, `shards` the per-user ones."""
+
+    def __init__(self, directory, shards):
+        self.directory = directory
+        self.shards = shards
+
+    @abstractmethod
+    def shard_for(self, user_id):
+        """The file holding a user's rows."""
+
+    def paths(self):
+        """Every file in the layout, directory first, each once."""
+        return list(dict.fromkeys([self.directory, *self.shards]))
+
+
+class SingleFileStorage(Storage):
+    """Everything in one file (the default)."""
+
+    def __init__(self, path):
+        super().__init__(path, [path])
+
+    def shard_for(self, user_id):
+        return self.directory
+
+
+class ShardedStorage(Storage):
+    """Per-user rows in `count` files next to the directory database, by user id modulo count."""
+
+    def __init__(self, path, count):
+        if count < 1:
+            raise ValueError("A sharded layout needs at least one shard")
+        root, ext = os.path.splitext(path)
+        super().__init__(path, [f"{root}.shard{i}{ext or '.db'}" for i in range(count)])
+
+    def shard_for(self, user_id):
+        return self.shards[int(user_id) % len(self.shards)]
+
+
+@functools.lru_cache(maxsize=16)
+def get_storage(path, backend='sqlite', shards=1):
+    """The layout for a directory database path. `backend` is 'sqlite' or 'sharded'."""
+    if backend == 'sqlite':
+        return SingleFileStorage(path)
+    if backend == 'sharded':
+        return ShardedStorage(path, shards)
+    raise ValueError(f"Unknown storage backend {backend!r} (expected one of {', '.join(BACKENDS)})")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m storage", description="Inspect or convert the database layout.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('paths', help="list the layout's database files")
+    commands.add_parser('copy', help="copy each user's rows from DB_NAME into their shard")
+    args = parser.parse_args(argv)
+
+    import database
+
+    layout = database.get_storage()
+    if args.command == 'paths':
+        for path in layout.paths():
+            print(path)
+        return 0
+    if database.STORAGE_BACKEND != 'sharded':
+        print("Set STORAGE_BACKEND=sharded (and STORAGE_SHARDS) to copy users into shards")
+        return 1
+    for table, rows in database.copy_to_shards().items():
+        print(f"{table}: {rows} rows copied")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
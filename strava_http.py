@@ -0,0 +1,155 @@
+"""
+Shared HTTP client for calls to Strava.
+
+Every request goes through one pooled requests.Session, so repeat calls reuse
+the same TCP/TLS connection. Requests get explicit connect/read timeouts and
+are retried with jittered exponential backoff on 429 and 5xx responses.
+Strava's rate-limit headers are parsed on every response.
+"""
+import os
+import random
+import re
+import threading
+import time
+from urllib.parse import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+import metrics
+
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 30
+
+MAX_RETRIES = 3
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+POOL_SIZE = 10
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+# Rate limit reported by the most recent Strava response, see parse_rate_limit
+last_rate_limit = None
+
+
+def get_session():
+    """Return the shared session, creating it on first use (and again after a fork)."""
+    global _session, _session_pid
+    with _session_lock:
+        if _session is None or _session_pid != os.getpid():
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _session = session
+            _session_pid = os.getpid()
+        return _session
+
+
+def set_pool_size(size):
+    """Keep up to `size` connections per host open; takes effect for the next session."""
+    global POOL_SIZE, _session
+    with _session_lock:
+        POOL_SIZE = size
+        _session = None
+
+
+def parse_rate_limit(headers):
+    """
+    Parse Strava's X-RateLimit-Limit / X-RateLimit-Usage headers.
+    Both hold "<15 minute>,<daily>" values. Returns a dict, or None if the
+    headers are missing or malformed.
+    """
+    limit = headers.get("X-RateLimit-Limit")
+    usage = headers.get("X-RateLimit-Usage")
+    if not limit or not usage:
+        return None
+    try:
+        short_limit, daily_limit = (int(n) for n in limit.split(","))
+        short_usage, daily_usage = (int(n) for n in usage.split(","))
+    except ValueError:
+        return None
+    return {
+        'short_limit': short_limit,
+        'short_usage': short_usage,
+        'short_remaining': max(0, short_limit - short_usage),
+        'daily_limit': daily_limit,
+        'daily_usage': daily_usage,
+        'daily_remaining': max(0, daily_limit - daily_usage),
+    }
+
+
+def endpoint_label(url):
+    """The URL's path with numeric IDs replaced, e.g. /api/v3/activities/{id}, for metric labels."""
+    return re.sub(r"/\d+(?=/|$)", "/{id}", urlparse(url).path) or "/"
+
+
+def backoff_delay(attempt):
+    """Full-jitter exponential backoff: a random delay up to BACKOFF_BASE * 2^attempt."""
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * (2 ** attempt)))
+
+
+def _retry_after(response):
+    try:
+        return min(BACKOFF_MAX, float(response.headers.get("Retry-After")))
+    except (TypeError, ValueError):
+        return None
+
+
+def request(method, url, **kwargs):
+    """
+    Send a request through the shared session, retrying 429/5xx responses and
+    connection failures. The returned response has a `rate_limit` attribute
+    (see parse_rate_limit). Callers still decide what to do with error statuses.
+    """
+    global last_rate_limit
+    kwargs.setdefault("timeout", (CONNECT_TIMEOUT, READ_TIMEOUT))
+    # A read timeout may mean the server acted on the request, so only retry it when that's safe
+    retry_read_timeouts = method.upper() == "GET"
+
+    labels = {'endpoint': endpoint_label(url), 'method': method.upper()}
+
+    attempt = 0
+    while True:
+        start = time.perf_counter()
+        try:
+            response = get_session().request(method, url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            metrics.observe('strava_request_duration_seconds', {**labels, 'status': type(e).__name__},
+                            time.perf_counter() - start)
+            retryable = not isinstance(e, requests.ReadTimeout) or retry_read_timeouts
+            if not retryable or attempt >= MAX_RETRIES:
+                raise
+            time.sleep(backoff_delay(attempt))
+            attempt += 1
+            continue
+
+        metrics.observe('strava_request_duration_seconds', {**labels, 'status': str(response.status_code)},
+                        time.perf_counter() - start)
+
+        response.rate_limit = parse_rate_limit(response.headers)
+        if response.rate_limit:
+            last_rate_limit = response.rate_limit
+
+        if response.status_code not in RETRY_STATUSES or attempt >= MAX_RETRIES:
+            return response
+
+        # Out of budget for this window: retrying now would only burn more requests
+        if response.status_code == 429 and response.rate_limit and (
+            response.rate_limit['short_remaining'] == 0 or response.rate_limit['daily_remaining'] == 0
+        ):
+            return response
+
+        delay = _retry_after(response)
+        time.sleep(delay if delay is not None else backoff_delay(attempt))
+        attempt += 1
+
+
+def get(url, **kwargs):
+    return request("GET", url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request("POST", url, **kwargs)
@@ -0,0 +1,155 @@
+"""
+Per-second activity streams (pace, heart rate, elevation) in packed binary columns.
+
+Strava returns each stream as a JSON list of numbers, one per recorded
+second; stored that way it is 5-8 bytes a sample. Here each stream is
+quantized to integers (value * its scale), delta-encoded so consecutive
+samples become small numbers, packed into the narrowest array typecode that
+fits and zlib-compressed, which leaves a small fraction of that. One row of
+ActivityStreams holds one stream of one activity.
+
+New activities are queued in StreamQueue when they are saved; sync_worker.py
+fetches a few per loop (one Strava request each, at low priority).
+
+    stream = pack('heartrate', [141, 142, 142, 145])
+    values = decode(stream['typecode'], stream['data'])   # array('i', [141, 142, 142, 145])
+    downsample(values, stream['scale'], 2)                 # [141.5, 143.5]
+"""
+import sys
+import time
+import zlib
+from array import array
+from itertools import accumulate
+import database
+import collector
+
+# Strava stream type -> scale; values are stored as round(value * scale)
+STREAM_SCALES = {
+    'time': 1,              # seconds since the start
+    'distance': 10,         # meters
+    'altitude': 10,         # meters
+    'velocity_smooth': 100, # meters per second
+    'heartrate': 1,         # beats per minute
+    'cadence': 1,           # steps per minute (one foot)
+    'grade_smooth': 10,     # percent
+}
+STREAM_TYPES = tuple(STREAM_SCALES)
+
+# Narrowest first; the delta-encoded samples use the first that fits them all
+TYPECODES = ('b', 'h', 'i')
+COMPRESSION_LEVEL = 6
+
+# Queue handling in sync_worker.py: fetches per loop, how long a claimed
+# fetch is hidden from other workers, and retries before giving up
+FETCHES_PER_RUN = 20
+LEASE_SECONDS = 600
+RETRY_SECONDS = 900
+MAX_ATTEMPTS = 5
+
+
+def _fits(typecode, low, high):
+    bits = array(typecode).itemsize * 8
+    return -(1 << (bits - 1)) <= low and high < (1 << (bits - 1))
+
+
+def encode(values, scale):
+    """
+    Quantize, delta-encode and compress one stream. Missing samples (None) repeat
+    the previous value. Returns (typecode, count, compressed bytes).
+    """
+    quantized = []
+    last = 0
+    for value in values:
+        if value is not None:
+            last = round(value * scale)
+        quantized.append(last)
+    deltas = [b - a for a, b in zip([0] + quantized, quantized)]
+
+    low, high = min(deltas, default=0), max(deltas, default=0)
+    typecode = next((code for code in TYPECODES if _fits(code, low, high)), None)
+    if typecode is None:
+        raise ValueError(f"Stream values out of range for scale {scale}")
+    packed = array(typecode, deltas)
+    # Stored little-endian whatever the platform
+    if sys.byteorder == 'big':
+        packed.byteswap()
+    return typecode, len(packed), zlib.compress(packed, COMPRESSION_LEVEL)
+
+
+def decode(typecode, data):
+    """Decompress one stream into an array('i') of its quantized values (divide by its scale for units)."""
+    raw = zlib.decompress(data)
+    if sys.byteorder == 'big':
+        deltas = array(typecode, raw)
+        deltas.byteswap()
+    else:
+        # A typed view of the decompressed buffer, without copying it
+        deltas = memoryview(raw).cast(typecode)
+    return array('i', accumulate(deltas))
+
+
+def pack(stream_type, values):
+    """A stream as the row dict database.save_activity_streams expects."""
+    scale = STREAM_SCALES[stream_type]
+    typecode, count, data = encode(values, scale)
+    return {'stream_type': stream_type, 'typecode': typecode, 'scale': scale, 'count': count, 'data': data}
+
+
+def downsample(values, scale, points):
+    """Average quantized `values` into at most `points` evenly sized buckets, in real units."""
+    count = len(values)
+    if count <= points:
+        return [round(value / scale, 3) for value in values]
+    view = memoryview(values)
+    series = []
+    for bucket in range(points):
+        start, end = bucket * count // points, (bucket + 1) * count // points
+        series.append(round(sum(view[start:end]) / (end - start) / scale, 3))
+    return series
+
+
+def load_series(user_id, activity_id, stream_types=None, points=500):
+    """A user's stored streams for an activity, downsampled for charting. Returns {stream_type: [values]}."""
+    rows = database.get_activity_streams(user_id, activity_id, stream_types)
+    return {
+        stream_type: downsample(decode(row['typecode'], row['data']), row['scale'], points)
+        for stream_type, row in rows.items()
+    }
+
+
+# FETCHING
+
+def fetch_and_save_streams(user_id, activity_id):
+    """
+    Fetch an activity's streams from Strava and store them packed. Returns how many were saved.
+    Raises collector.RateLimitDeferred if the Strava budget is too low.
+    """
+    token = collector.get_valid_access_token(user_id)
+    if token is None:
+        raise RuntimeError(f"No Strava tokens for User {user_id}")
+    # None if the activity was deleted or made private; saving nothing takes it off the queue
+    fetched = collector.fetch_activity_streams(token, activity_id, STREAM_TYPES) or {}
+    packed = [pack(stream_type, values) for stream_type, values in fetched.items() if stream_type in STREAM_SCALES]
+    database.save_activity_streams(user_id, activity_id, packed)
+    return len(packed)
+
+
+def run_pending_stream_fetches(limit=FETCHES_PER_RUN):
+    """Fetch streams for up to `limit` queued activities. Returns how many were attempted."""
+    count = 0
+    while count < limit:
+        item = database.claim_next_stream_fetch(LEASE_SECONDS)
+        if item is None:
+            break
+        count += 1
+        try:
+            fetch_and_save_streams(item['user_id'], item['activity_id'])
+        except collector.RateLimitDeferred as e:
+            # Everything else queued would be refused too
+            database.defer_stream_fetch(item['user_id'], item['activity_id'], e.retry_at)
+            break
+        except Exception as e:
+            print(f"Stream fetch for activity {item['activity_id']} failed: {e}")
+            database.retry_stream_fetch(item['user_id'], item['activity_id'],
+                                        int(time.time()) + RETRY_SECONDS, MAX_ATTEMPTS)
+    return count
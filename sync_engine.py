@@ -0,0 +1,134 @@
+"""
+Concurrent Strava sync for every connected user.
+
+Each user's sync is the same collector.fetch_and_save_user_data used by the
+sync worker (token refresh, paginated fetch, one write per page); this module
+runs many of them at once on asyncio with a bound on how many are in flight.
+Their writes are group-committed by database.write_buffer(), so a commit (and
+its fsync) is shared by every sync that wrote in the meantime. A sync deferred
+because the Strava budget ran low is queued as a SyncJobs job (at its
+priority) for sync_worker.py to finish once the budget resets.
+
+Usage:
+    python -m collector sync-all [--concurrency 32] [--strava-url URL] [--json]
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+import database
+import collector
+import metrics
+import strava_http
+
+
+async def sync_user(user, semaphore, per_page):
+    """Sync one user once a concurrency slot is free. Returns a result dict."""
+    async with semaphore:
+        start = time.perf_counter()
+        priority = collector.priority_for_last_login(user.get('last_login_time'))
+        result = {'user_id': user['id'], 'priority': priority, 'imported': 0, 'status': 'ok', 'error': None}
+        try:
+            imported = await asyncio.to_thread(
+                collector.fetch_and_save_user_data, user['id'], per_page, priority
+            )
+            if imported is None:
+                result['status'] = 'failed'
+            else:
+                result['imported'] = imported
+                await asyncio.to_thread(database.update_last_sync_time, user['id'])
+        except collector.RateLimitDeferred as e:
+            # Rather than wait for the next sync-all, the sync worker picks it up when the budget allows
+            await asyncio.to_thread(database.enqueue_sync_job, user['id'], priority, e.retry_at)
+            result['status'] = 'deferred'
+            result['error'] = str(e)
+        except Exception as e:
+            result['status'] = 'failed'
+            result['error'] = str(e)
+        result['seconds'] = time.perf_counter() - start
+        return result
+
+
+async def sync_all(users, concurrency=8, per_page=collector.ACTIVITIES_PER_PAGE):
+    """Sync every user in `users` with at most `concurrency` syncs in flight. Returns a report dict."""
+    loop = asyncio.get_running_loop()
+    # Each sync blocks a thread on HTTP/SQLite, so give the loop enough of them
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    loop.set_default_executor(executor)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    start = time.perf_counter()
+    # Concurrent syncs share commits (database.write_buffer); at most `concurrency`
+    # writes can be waiting at once, so a full group never waits out the delay
+    with database.write_buffer(max_writes=concurrency):
+        results = await asyncio.gather(*(sync_user(user, semaphore, per_page) for user in users))
+    elapsed = time.perf_counter() - start
+    executor.shutdown(wait=False)
+
+    return {
+        'users': results,
+        'totals': summarize(results, elapsed, concurrency),
+    }
+
+
+def summarize(results, elapsed, concurrency):
+    timings = sorted(r['seconds'] for r in results)
+    return {
+        'users': len(results),
+        'ok': sum(1 for r in results if r['status'] == 'ok'),
+        'failed': sum(1 for r in results if r['status'] == 'failed'),
+        'deferred': sum(1 for r in results if r['status'] == 'deferred'),
+        'activities_imported': sum(r['imported'] for r in results),
+        'concurrency': concurrency,
+        'seconds': elapsed,
+        'users_per_second': len(results) / elapsed if elapsed else 0.0,
+        'p50_user_seconds': timings[len(timings) // 2] if timings else 0.0,
+        'max_user_seconds': timings[-1] if timings else 0.0,
+    }
+
+
+def print_report(report):
+    print(f"{'user':>8} {'priority':>8} {'status':>9} {'imported':>9} {'seconds':>8}")
+    for r in report['users']:
+        print(f"{r['user_id']:>8} {r['priority']:>8} {r['status']:>9} {r['imported']:>9} {r['seconds']:>8.3f}")
+    t = report['totals']
+    print(f"\n{t['users']} users in {t['seconds']:.2f}s ({t['users_per_second']:.1f} users/s, "
+          f"concurrency {t['concurrency']}): {t['ok']} ok, {t['failed']} failed, {t['deferred']} deferred, "
+          f"{t['activities_imported']} activities imported")
+    if t['deferred']:
+        print("Deferred syncs are queued for sync_worker.py to run once the Strava budget resets")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m collector", description="Strava sync commands.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    sync_all_parser = commands.add_parser('sync-all', help="sync every user who has connected Strava")
+    sync_all_parser.add_argument('--concurrency', type=int, default=8)
+    sync_all_parser.add_argument('--per-page', type=int, default=collector.ACTIVITIES_PER_PAGE)
+    sync_all_parser.add_argument('--strava-url', help="base URL of a (fake) Strava API to sync from")
+    sync_all_parser.add_argument('--json', action='store_true', help="print the report as JSON")
+    args = parser.parse_args(argv)
+
+    if args.strava_url:
+        collector.use_strava_base_url(args.strava_url)
+    strava_http.set_pool_size(args.concurrency)
+
+    database.init_db()
+    users = database.get_users_with_strava()
+    # Keep the collector's progress prints out of the JSON on stdout
+    quiet = contextlib.redirect_stdout(sys.stderr) if args.json else contextlib.nullcontext()
+    with quiet:
+        report = asyncio.run(sync_all(users, args.concurrency, args.per_page))
+    metrics.flush()
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == "__main__":
+    main()
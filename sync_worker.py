@@ -0,0 +1,93 @@
+"""
+Background Strava sync worker.
+
+The web app only queues sync jobs (database.enqueue_sync_job); this process
+claims them one at a time and runs the Strava fetch, so slow Strava responses
+never tie up a gunicorn worker. It also applies queued Strava webhook events
+(see webhooks.py), fetches per-second streams for new activities (see
+streams.py) and, when there is nothing more urgent, advances full-history
+backfills a few pages at a time (see backfill.py).
+
+Usage:
+    python sync_worker.py [--poll-interval 2] [--once]
+"""
+import argparse
+import time
+import backfill
+import database
+import collector
+import metrics
+import streams
+import webhooks
+
+# A job still marked running after this long belongs to a worker that died
+STALE_JOB_SECONDS = 600
+
+
+def run_job(job):
+    """Sync one user and record the outcome on the job."""
+    user_id = job['user_id']
+    try:
+        imported = collector.fetch_and_save_user_data(user_id, priority=job.get('priority', 'high'))
+    except collector.RateLimitDeferred as e:
+        print(f"Deferring sync job {job['id']} until {e.retry_at}: Strava budget is low")
+        database.defer_sync_job(job['id'], e.retry_at)
+        return
+
+    if imported is None:
+        database.finish_sync_job(job['id'], error="Strava sync failed")
+        return
+
+    database.update_last_sync_time(user_id)
+    database.finish_sync_job(job['id'], activities_imported=imported)
+
+
+def run_pending_jobs():
+    """Run queued jobs until the queue is empty. Returns how many ran."""
+    count = 0
+    job = database.claim_next_sync_job()
+    while job is not None:
+        try:
+            run_job(job)
+        except Exception as e:
+            print(f"Sync job {job['id']} failed: {e}")
+            database.finish_sync_job(job['id'], error=str(e))
+        count += 1
+        metrics.maybe_flush()
+        job = database.claim_next_sync_job()
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run queued Strava sync jobs.")
+    parser.add_argument('--poll-interval', type=float, default=2.0,
+                        help="seconds to wait between checks of an empty queue")
+    parser.add_argument('--once', action='store_true',
+                        help="drain the queue once and exit")
+    args = parser.parse_args()
+
+    database.init_db()
+
+    while True:
+        requeued = database.requeue_stale_sync_jobs(STALE_JOB_SECONDS)
+        requeued += database.requeue_stale_webhook_events(STALE_JOB_SECONDS)
+        requeued += database.requeue_stale_backfills(STALE_JOB_SECONDS)
+        if requeued:
+            print(f"Requeued {requeued} stale sync jobs, webhook events and backfills")
+        # Webhook events first: each is one quick request for an activity the athlete just saved
+        webhooks.run_pending_events()
+        run_pending_jobs()
+        fetched = streams.run_pending_stream_fetches()
+        # Then one slice of a backfill, so new events and syncs never wait behind a long history
+        backfilled = backfill.run_pending_backfills()
+        metrics.flush()
+        # Skip the poll sleep while streams or backfills are still queued
+        busy = backfilled or fetched == streams.FETCHES_PER_RUN
+        if args.once and not busy:
+            break
+        if not busy:
+            time.sleep(args.poll_interval)
+
+
+if __name__ == "__main__":
+    main()
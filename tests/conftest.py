@@ -13,3 +13,78 @@ root_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 if root_dir not in sys.path:
     sys.path.insert(0, root_dir)
 
+
+import math
+import pytest
+import metrics
+
+
+@pytest.fixture(autouse=True)
+def no_background_metric_flushes():
+    """Only flush metrics when a test asks to, and start every test with none pending."""
+    metrics._pending.clear()
+    original = metrics.FLUSH_INTERVAL
+    metrics.FLUSH_INTERVAL = math.inf
+    yield
+    metrics.FLUSH_INTERVAL = original
+    metrics._pending.clear()
+
+
+@pytest.fixture(autouse=True)
+def no_failed_logins():
+    """Start every test without failed logins counted against it."""
+    import passwords
+    passwords.clear_failed_logins()
+    yield
+    passwords.clear_failed_logins()
+
+
+@pytest.fixture(autouse=True)
+def single_file_storage():
+    """Run against one database file whatever STORAGE_BACKEND says; test_storage.py opts into shards."""
+    import database
+    original = database.STORAGE_BACKEND
+    database.STORAGE_BACKEND = 'sqlite'
+    yield
+    database.STORAGE_BACKEND = original
+
+
+@pytest.fixture(autouse=True)
+def empty_activity_cache():
+    """Start every test with no cached /api/activities responses (user ids and versions repeat across tests)."""
+    import activity_cache
+    activity_cache.invalidate()
+    activity_cache.reset_stats()
+    yield
+    activity_cache.invalidate()
+
+
+# Opt-in fixtures for tests that run the collector against a real database and a fake Strava
+
+@pytest.fixture
+def test_db(tmp_path):
+    """A fresh database file for the test."""
+    import database
+    from unittest.mock import patch
+    with patch.object(database, 'DB_NAME', str(tmp_path / "test_app.db")):
+        database.init_db()
+        yield
+        database.close_pooled_connection()
+
+
+@pytest.fixture
+def unlimited_strava_budget():
+    """Grant every Strava request without touching the shared budget."""
+    from unittest.mock import patch
+    with patch('database.reserve_strava_requests', return_value={'granted': True, 'retry_at': None}), \
+         patch('database.record_strava_rate_limit'):
+        yield
+
+
+@pytest.fixture
+def empty_token_cache():
+    """Start and end the test with no access tokens cached in this process."""
+    import collector
+    collector.clear_token_cache()
+    yield
+    collector.clear_token_cache()
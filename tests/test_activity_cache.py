@@ -0,0 +1,78 @@
+import sys
+import os
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import activity_cache
+
+
+def test_hit_only_at_the_cached_version():
+    """
+    UNIT TEST: A response is served for the same user, params and data_version, and dropped once the version moves on.
+    """
+    activity_cache.put(1, 5, ('all', 'rows'), b'{"v": 5}')
+
+    assert activity_cache.get(1, 5, ('all', 'rows')) == b'{"v": 5}'
+    assert activity_cache.get(1, 5, ('all', 'columnar')) is None
+    assert activity_cache.get(2, 5, ('all', 'rows')) is None
+    assert activity_cache.get(1, 6, ('all', 'rows')) is None
+    assert activity_cache.get(1, 5, ('all', 'rows')) is None
+
+    stats = activity_cache.stats()
+    assert (stats['hits'], stats['misses'], stats['invalidations'], stats['entries']) == (1, 4, 1, 0)
+
+def test_newer_version_drops_every_response_of_the_user():
+    """
+    UNIT TEST: Caching at a newer version replaces all of the user's older responses, and older ones never replace newer.
+    """
+    activity_cache.put(1, 5, ('all', 'rows'), b'a')
+    activity_cache.put(1, 5, ('all', 'columnar'), b'b')
+    activity_cache.put(1, 6, ('all', 'rows'), b'c')
+    activity_cache.put(1, 5, ('all', 'columnar'), b'stale')
+
+    assert activity_cache.get(1, 6, ('all', 'rows')) == b'c'
+    assert activity_cache.get(1, 6, ('all', 'columnar')) is None
+    assert activity_cache.stats()['entries'] == 1
+
+def test_least_recently_used_evicted_by_entries():
+    """
+    UNIT TEST: Past MAX_ENTRIES responses, the least recently used user's are evicted first.
+    """
+    with patch.object(activity_cache, 'MAX_ENTRIES', 2):
+        activity_cache.put(1, 1, ('all', 'rows'), b'one')
+        activity_cache.put(2, 1, ('all', 'rows'), b'two')
+        activity_cache.get(1, 1, ('all', 'rows'))
+        activity_cache.put(3, 1, ('all', 'rows'), b'three')
+
+    assert activity_cache.get(2, 1, ('all', 'rows')) is None
+    assert activity_cache.get(1, 1, ('all', 'rows')) == b'one'
+    assert activity_cache.get(3, 1, ('all', 'rows')) == b'three'
+    assert activity_cache.stats()['evictions'] == 1
+
+def test_evicted_by_bytes_and_oversized_not_cached():
+    """
+    UNIT TEST: The cache stays under MAX_BYTES, and a response bigger than that is not cached at all.
+    """
+    with patch.object(activity_cache, 'MAX_BYTES', 10):
+        activity_cache.put(1, 1, ('all', 'rows'), b'x' * 6)
+        activity_cache.put(2, 1, ('all', 'rows'), b'y' * 6)
+        activity_cache.put(3, 1, ('all', 'rows'), b'z' * 11)
+
+        stats = activity_cache.stats()
+    assert (stats['users'], stats['bytes'], stats['evictions']) == (1, 6, 1)
+    assert activity_cache.get(2, 1, ('all', 'rows')) == b'y' * 6
+
+def test_stats_recorded_as_metrics():
+    """
+    UNIT TEST: Hits, misses and evictions are counted in the shared metrics.
+    """
+    with patch('metrics.inc') as mock_inc:
+        activity_cache.get(1, 1, ('all', 'rows'))
+        activity_cache.put(1, 1, ('all', 'rows'), b'one')
+        activity_cache.get(1, 1, ('all', 'rows'))
+        activity_cache.put(1, 2, ('all', 'rows'), b'two')
+
+    mock_inc.assert_any_call('activity_cache_requests_total', {'result': 'miss'}, 1)
+    mock_inc.assert_any_call('activity_cache_requests_total', {'result': 'hit'}, 1)
+    mock_inc.assert_any_call('activity_cache_evictions_total', {'reason': 'stale'}, 1)
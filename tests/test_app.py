@@ -1,12 +1,27 @@
 import sys
 import os
+import datetime
 import pytest
+from contextlib import contextmanager
 from unittest.mock import patch, MagicMock
 
 # 1. SETUP PATH
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-from app import app, User
+from app import app, User, MAX_WEEKLY_SUMMARY_WEEKS
+import activity_cache
+import database
+import payloads
+import streams
+
+def _user_context(**overrides):
+    """A fake database.get_user_context row for a logged-in user."""
+    context = {
+        'id': 1, 'username': 'runner', 'last_sync_time': 0, 'last_login_time': 0,
+        'has_strava': False, 'mileage_goal': None, 'long_run_goal': None
+    }
+    context.update(overrides)
+    return context
 
 @pytest.fixture
 def client():
@@ -19,42 +34,35 @@ def client():
 
 def test_dashboard_triggers_sync_if_expired(client):
     """
-    UNIT TEST: If sync time is old, verify collector is called.
+    UNIT TEST: If sync time is old, verify a background sync job is queued.
     """
     with client.session_transaction() as sess:
         sess['_user_id'] = '1'
         sess['_fresh'] = True
 
-    with patch('database.get_user_by_id') as mock_db_get:
+    with patch('database.get_user_context') as mock_db_get:
         
-        mock_db_get.return_value = {
-            'id': 1, 
-            'username': 'runner', 
-            'last_sync_time': 0,
-            'password_hash': 'ignore'
-        }
+        mock_db_get.return_value = _user_context(last_sync_time=0, has_strava=True)
 
         with patch('collector.fetch_and_save_user_data') as mock_collector, \
-             patch('database.update_last_sync_time') as mock_db_update, \
-             patch('database.user_has_strava', return_value=True):
+             patch('database.enqueue_sync_job') as mock_enqueue:
             
             response = client.get('/')
 
             assert response.status_code == 200
             
-            mock_collector.assert_called_once()
+            # The sync runs in sync_worker.py, not during the request
+            mock_collector.assert_not_called()
             
-            mock_db_update.assert_called_once_with(1)
+            mock_enqueue.assert_called_once_with(1)
 
 def test_login_failure_redirects_to_login(client):
     """
     UNIT TEST: Invalid login should redirect back to /login.
     """
-    with patch('database.get_user_by_username') as mock_get, \
-         patch('database.validate_password') as mock_val:
+    with patch('database.authenticate') as mock_auth:
         
-        mock_get.return_value = {'id': 1, 'username': 'test'}
-        mock_val.return_value = False
+        mock_auth.return_value = None
 
         response = client.post('/login', data={'username': 'test', 'password': 'wrong'}, follow_redirects=False)
         
@@ -65,19 +73,35 @@ def test_login_success_redirects_to_dashboard(client):
     """
     UNIT TEST: Valid credentials should redirect to the dashboard.
     """
-    with patch('database.get_user_by_username') as mock_get, \
-         patch('database.validate_password') as mock_val:
+    with patch('database.authenticate') as mock_auth, \
+         patch('database.update_last_login_time') as mock_login_time:
         
-        mock_get.return_value = {
+        mock_auth.return_value = {
             'id': 1, 'username': 'runner', 'last_sync_time': 0, 'password_hash': 'h'
         }
-        mock_val.return_value = True
 
         response = client.post('/login', data={'username': 'runner', 'password': 'correct'}, follow_redirects=False)
 
         # Should redirect (302) to the dashboard ('/')
         assert response.status_code == 302
         assert response.location == '/' or 'http://localhost/' in response.location
+        mock_login_time.assert_called_once_with(1)
+
+def test_login_locked_out_after_repeated_failures(client):
+    """
+    UNIT TEST: Once a username has too many failed logins, further attempts
+    are refused without checking the password.
+    """
+    with patch('database.authenticate', return_value=None) as mock_auth:
+        for _ in range(5):
+            client.post('/login', data={'username': 'runner', 'password': 'guess'})
+        assert mock_auth.call_count == 5
+
+        response = client.post('/login', data={'username': 'runner', 'password': 'correct'})
+
+    assert response.status_code == 302
+    assert '/login' in response.location
+    assert mock_auth.call_count == 5
 
 def test_register_creates_user_and_goals(client):
     """
@@ -85,9 +109,10 @@ def test_register_creates_user_and_goals(client):
     """
     with patch('database.create_user', return_value=55) as mock_create, \
          patch('database.create_athlete_with_goals') as mock_goals, \
-         patch('database.get_user_by_id') as mock_get_id:
+         patch('database.get_user_context') as mock_get_id, \
+         patch('database.update_last_login_time'):
         
-        mock_get_id.return_value = {'id': 55, 'username': 'new_user', 'last_sync_time': 0}
+        mock_get_id.return_value = _user_context(id=55, username='new_user')
 
         response = client.post('/register', data={
             'username': 'new_user',
@@ -109,15 +134,12 @@ def test_api_returns_correct_json_structure(client):
         sess['_user_id'] = '1'
         sess['_fresh'] = True
 
-    with patch('database.get_user_by_id') as mock_db_get:
-        mock_db_get.return_value = {'id': 1, 'username': 'runner', 'last_sync_time': 0}
+    with patch('database.get_user_context') as mock_db_get:
+        mock_db_get.return_value = _user_context(has_strava=True, mileage_goal=50.0, long_run_goal=15.0)
 
         fake_activities = [{'activity_id': 101, 'distance': 5.0, 'date': '2023-01-01'}]
-        fake_athlete = {'mileage_goal': 50.0, 'long_run_goal': 15.0}
 
-        with patch('database.get_activities_for_user', return_value=fake_activities), \
-             patch('database.get_row_from_athletes_table', return_value=fake_athlete), \
-             patch('database.user_has_strava', return_value=True):
+        with patch('database.get_activities_for_user', return_value=fake_activities):
 
             response = client.get('/api/activities')
             
@@ -128,4 +150,494 @@ def test_api_returns_correct_json_structure(client):
             assert data['activities'][0]['distance'] == 5.0
             assert data['has_strava'] is True
 
-    
\ No newline at end of file
+def test_dashboard_skips_sync_if_recent(client):
+    """
+    UNIT TEST: If the last sync was recent, no sync job is queued.
+    """
+    import time
+    with client.session_transaction() as sess:
+        sess['_user_id'] = '1'
+        sess['_fresh'] = True
+
+    with patch('database.get_user_context') as mock_db_get:
+        mock_db_get.return_value = _user_context(last_sync_time=int(time.time()), has_strava=True)
+
+        with patch('database.enqueue_sync_job') as mock_enqueue:
+
+            response = client.get('/')
+
+            assert response.status_code == 200
+            mock_enqueue.assert_not_called()
+
+def test_sync_status_reports_latest_job(client):
+    """
+    UNIT TEST: /api/sync-status returns the state of the user's latest sync job.
+    """
+    with client.session_transaction() as sess:
+        sess['_user_id'] = '1'
+        sess['_fresh'] = True
+
+    fake_job = {'id': 7, 'user_id': 1, 'status': 'done', 'activities_imported': 3,
+                'finished_at': 1700000000, 'error': None}
+
+    with patch('database.get_user_context') as mock_db_get, \
+         patch('database.get_latest_sync_job', return_value=fake_job), \
+         patch('database.get_backfill', return_value=None):
+        mock_db_get.return_value = _user_context(last_sync_time=1700000000)
+
+        response = client.get('/api/sync-status')
+
+        assert response.status_code == 200
+        data = response.get_json()
+        assert data['status'] == 'done'
+        assert data['activities_imported'] == 3
+
+def test_sync_status_idle_without_jobs(client):
+    """
+    UNIT TEST: /api/sync-status reports idle when no sync has been queued.
+    """
+    with client.session_transaction() as sess:
+        sess['_user_id'] = '1'
+        sess['_fresh'] = True
+
+    with patch('database.get_user_context') as mock_db_get, \
+         patch('database.get_latest_sync_job', return_value=None), \
+         patch('database.get_backfill', return_value=None):
+        mock_db_get.return_value = _user_context()
+
+        response = client.get('/api/sync-status')
+
+        assert response.get_json()['status'] == 'idle'
+
+def test_weekly_summary_returns_requested_weeks(client):
+    """
+    UNIT TEST: /api/weekly-summary returns the database's weeks with the user's goals.
+    """
+    with patch('database.get_user_context', return_value=_user_context()), \
+         patch('database.get_weekly_summary', return_value=[{'week_start': '2025-01-06', 'total': 8.0}]) as mock_summary:
+
+        with client.session_transaction() as sess:
+            sess['_user_id'] = '1'
+            sess['_fresh'] = True
+
+        response = client.get('/api/weekly-summary?weeks=3&end=2025-01-08')
+
+    assert response.status_code == 200
+    mock_summary.assert_called_once_with(1, datetime.date(2025, 1, 8), 3)
+    assert response.get_json()['weeks'] == [{'week_start': '2025-01-06', 'total': 8.0}]
+    assert 'mileage_goal' in response.get_json()
+
+def test_weekly_summary_caps_weeks(client):
+    """
+    UNIT TEST: /api/weekly-summary never returns more than MAX_WEEKLY_SUMMARY_WEEKS weeks.
+    """
+    with patch('database.get_user_context', return_value=_user_context()), \
+         patch('database.get_weekly_summary', return_value=[]) as mock_summary:
+
+        with client.session_transaction() as sess:
+            sess['_user_id'] = '1'
+            sess['_fresh'] = True
+
+        client.get('/api/weekly-summary?weeks=1000&end=2025-01-08')
+        response = client.get('/api/weekly-summary?end=not-a-date')
+
+    assert mock_summary.call_args[0][2] == MAX_WEEKLY_SUMMARY_WEEKS
+    assert response.status_code == 400
+
+# QUERY COUNTS
+# These run against a real (temporary) database and count the SQL statements
+# each route sends, so extra per-request lookups show up as test failures.
+
+@pytest.fixture
+def db_client(client, tmp_path):
+    with patch.object(database, 'DB_NAME', str(tmp_path / "test_app.db")):
+        database.init_db()
+        user_id = database.create_user('runner', 'password123')
+        database.create_athlete_with_goals(user_id, 30.0, 10.0)
+        database.update_user_tokens(user_id, 'access', 'refresh', 9999999999)
+        database.update_last_sync_time(user_id)
+        database.create_activity(user_id, '2025-01-01', 5.0, 101)
+        yield client
+        database.close_pooled_connection()
+
+@contextmanager
+def count_queries():
+    """Collect the SELECT/INSERT/UPDATE/DELETE statements run on this thread's connection."""
+    statements = []
+    conn = database._get_pooled_connection()
+    conn.set_trace_callback(statements.append)
+    try:
+        yield statements
+    finally:
+        conn.set_trace_callback(None)
+        statements[:] = [sql for sql in statements
+                         if sql.lstrip().split(None, 1)[0].upper() in ('SELECT', 'INSERT', 'UPDATE', 'DELETE')]
+
+def _log_in(client):
+    with client.session_transaction() as sess:
+        sess['_user_id'] = '1'
+        sess['_fresh'] = True
+
+def test_api_activities_query_count(db_client):
+    """
+    QUERY COUNT: /api/activities loads the user context once, then the activities.
+    """
+    _log_in(db_client)
+    with count_queries() as queries:
+        response = db_client.get('/api/activities')
+
+    assert response.status_code == 200
+    assert response.get_json()['mileage_goal'] == 30.0
+    assert response.get_json()['has_strava'] is True
+    assert len(queries) == 2
+
+def test_dashboard_query_count(db_client):
+    """
+    QUERY COUNT: The dashboard needs only the user context when no sync is due.
+    """
+    _log_in(db_client)
+    with count_queries() as queries:
+        response = db_client.get('/')
+
+    assert response.status_code == 200
+    assert len(queries) == 1
+
+def test_sync_status_query_count(db_client):
+    """
+    QUERY COUNT: /api/sync-status loads the user context, the latest job and the backfill.
+    """
+    _log_in(db_client)
+    with count_queries() as queries:
+        response = db_client.get('/api/sync-status')
+
+    assert response.status_code == 200
+    assert len(queries) == 3
+
+def test_sync_status_reports_backfill_progress(db_client):
+    """
+    INTEGRATION TEST: A running backfill's progress is included in /api/sync-status.
+    """
+    database.enqueue_backfill(1)
+    database.claim_next_backfill()
+    database.save_backfill_page(1, [{'date': '2021-03-04', 'distance': 3.0, 'activity_id': 900}], 2)
+    _log_in(db_client)
+
+    backfill = db_client.get('/api/sync-status').get_json()['backfill']
+
+    assert backfill['status'] == 'running'
+    assert backfill['activities_imported'] == 1
+    assert backfill['oldest_date'] == '2021-03-04'
+
+def test_strava_callback_queues_sync_and_backfill(db_client):
+    """
+    UNIT TEST: Connecting Strava queues the 30-day sync and a full-history backfill.
+    """
+    _log_in(db_client)
+    with patch('collector.authorize_and_save_user'), \
+         patch('database.enqueue_sync_job') as mock_sync, \
+         patch('database.enqueue_backfill') as mock_backfill:
+        response = db_client.get('/strava/callback?code=abc')
+
+    assert response.status_code == 302
+    mock_sync.assert_called_once_with(1)
+    mock_backfill.assert_called_once_with(1)
+
+def test_weekly_summary_query_count(db_client):
+    """
+    QUERY COUNT: /api/weekly-summary reads the weekly and daily rollups, never the activities.
+    """
+    _log_in(db_client)
+    with count_queries() as queries:
+        response = db_client.get('/api/weekly-summary?weeks=52&end=2025-01-01')
+
+    assert response.status_code == 200
+    assert response.get_json()['weeks'][0]['total'] == 5.0
+    assert len(queries) == 3
+    assert not any('DailyMileage' in sql for sql in queries)
+
+def test_api_activities_pages_with_cursor(db_client):
+    """
+    INTEGRATION TEST: Following next_cursor walks every activity in range exactly once.
+    """
+    database.create_activities(1, [
+        {'date': '2025-01-02', 'distance': 3.0, 'activity_id': 102},
+        {'date': '2025-01-02', 'distance': 4.0, 'activity_id': 103},
+    ])
+    _log_in(db_client)
+
+    seen = []
+    url = '/api/activities?from=2025-01-01&to=2025-01-31&limit=2'
+    page = db_client.get(url).get_json()
+    seen += [a['activity_id'] for a in page['activities']]
+    while page['next_cursor']:
+        page = db_client.get(f"{url}&cursor={page['next_cursor']}").get_json()
+        seen += [a['activity_id'] for a in page['activities']]
+
+    assert seen == [103, 102, 101]
+
+def test_api_activities_defaults_to_recent_weeks(db_client):
+    """
+    INTEGRATION TEST: Without from=, old activities are left out unless all=true is asked for.
+    """
+    _log_in(db_client)
+
+    recent = db_client.get('/api/activities').get_json()
+    everything = db_client.get('/api/activities?all=true').get_json()
+    bad_cursor = db_client.get('/api/activities?cursor=nope')
+
+    assert recent['activities'] == []
+    assert [a['activity_id'] for a in everything['activities']] == [101]
+    assert bad_cursor.status_code == 400
+
+def test_api_activities_not_modified_with_one_query(db_client):
+    """
+    QUERY COUNT: A request with the current ETag gets a 304 from the user context alone.
+    """
+    _log_in(db_client)
+    first = db_client.get('/api/activities?all=true')
+    etag = first.headers['ETag']
+
+    with count_queries() as queries:
+        response = db_client.get('/api/activities?all=true', headers={'If-None-Match': etag})
+
+    assert response.status_code == 304
+    assert response.headers['ETag'] == etag
+    assert len(queries) == 1
+    assert not any('DailyMileage' in sql for sql in queries)
+
+def test_etag_changes_when_data_changes(db_client):
+    """
+    INTEGRATION TEST: New activities and goal changes invalidate the ETag; other params get their own.
+    """
+    _log_in(db_client)
+    etag = db_client.get('/api/weekly-summary?end=2025-01-01').headers['ETag']
+    assert db_client.get('/api/weekly-summary?end=2025-01-08').headers['ETag'] != etag
+
+    database.create_activity(1, '2025-01-02', 4.0, 102)
+    response = db_client.get('/api/weekly-summary?end=2025-01-01', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.get_json()['weeks'][0]['total'] == 9.0
+
+    etag = response.headers['ETag']
+    database.set_mileage_goal(1, 40.0)
+    response = db_client.get('/api/weekly-summary?end=2025-01-01', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.get_json()['mileage_goal'] == 40.0
+
+def test_api_activities_repeat_served_from_cache(db_client):
+    """
+    QUERY COUNT: Asking again without the ETag returns the cached response after only the user context query.
+    """
+    _log_in(db_client)
+    first = db_client.get('/api/activities?all=true')
+
+    with count_queries() as queries:
+        second = db_client.get('/api/activities?all=true')
+
+    assert second.status_code == 200
+    assert second.get_data() == first.get_data()
+    assert second.headers['ETag'] == first.headers['ETag']
+    assert len(queries) == 1
+    assert activity_cache.stats()['hits'] == 1
+
+def test_api_activities_cache_follows_writes(db_client):
+    """
+    INTEGRATION TEST: New activities, synced pages and goal changes from any process are never served stale.
+    """
+    _log_in(db_client)
+    assert [a['activity_id'] for a in db_client.get('/api/activities?all=true').get_json()['activities']] == [101]
+
+    database.create_activity(1, '2025-01-02', 4.0, 102)
+    assert [a['activity_id'] for a in db_client.get('/api/activities?all=true').get_json()['activities']] == [102, 101]
+
+    database.create_activities(1, [{'date': '2025-01-03', 'distance': 6.0, 'activity_id': 103}])
+    assert len(db_client.get('/api/activities?all=true').get_json()['activities']) == 3
+
+    database.set_mileage_goal(1, 40.0)
+    assert db_client.get('/api/activities?all=true').get_json()['mileage_goal'] == 40.0
+
+    stats = activity_cache.stats()
+    assert (stats['hits'], stats['misses'], stats['invalidations']) == (0, 4, 3)
+
+def test_activity_changes_returns_delta(db_client):
+    """
+    INTEGRATION TEST: A client holding a version gets only newer activities and deletions.
+    """
+    _log_in(db_client)
+    snapshot = db_client.get('/api/activities/changes').get_json()
+    assert snapshot['full'] is True
+    assert [a['activity_id'] for a in snapshot['activities']] == [101]
+
+    database.create_activity(1, '2025-01-02', 4.0, 102)
+    database.delete_activity(1, 101)
+    delta = db_client.get(f"/api/activities/changes?since={snapshot['version']}").get_json()
+
+    assert delta['full'] is False
+    assert [a['activity_id'] for a in delta['activities']] == [102]
+    assert delta['deleted'] == [101]
+
+def test_activity_changes_up_to_date_query_count(db_client):
+    """
+    QUERY COUNT: A client that is already up to date costs only the user context query.
+    """
+    _log_in(db_client)
+    version = db_client.get('/api/activities/changes').get_json()['version']
+
+    with count_queries() as queries:
+        response = db_client.get(f'/api/activities/changes?since={version}')
+
+    assert response.get_json() == {'version': version, 'full': False, 'format': 'rows', 'activities': [], 'deleted': []}
+    assert len(queries) == 1
+
+def test_activity_changes_resets_unknown_version(db_client):
+    """
+    INTEGRATION TEST: A version newer than the server's gets a full snapshot instead.
+    """
+    _log_in(db_client)
+    response = db_client.get('/api/activities/changes?since=999999').get_json()
+    assert response['full'] is True
+    assert len(response['activities']) == 1
+
+def test_api_activities_columnar_format(db_client):
+    """
+    INTEGRATION TEST: format=columnar returns the same activities as parallel arrays.
+    """
+    _log_in(db_client)
+    rows = db_client.get('/api/activities?all=true').get_json()
+    columnar = db_client.get('/api/activities?all=true&format=columnar').get_json()
+
+    assert columnar['format'] == 'columnar'
+    assert columnar['activities']['base_date'] == '2025-01-01'
+    assert payloads.from_columnar(columnar['activities']) == rows['activities']
+    assert db_client.get('/api/activities?format=xml').status_code == 400
+
+def test_metrics_reports_route_latency(db_client):
+    """
+    INTEGRATION TEST: /metrics shows latency histograms for the routes and database calls just served.
+    """
+    _log_in(db_client)
+    db_client.get('/api/sync-status')
+    response = db_client.get('/metrics')
+
+    text = response.get_data(as_text=True)
+    assert response.status_code == 200
+    assert response.content_type.startswith('text/plain')
+    assert 'http_request_duration_seconds_count{method="GET",route="/api/sync-status",status="200"} 1' in text
+    assert 'db_call_duration_seconds_count{function="get_latest_sync_job"} 1' in text
+
+def test_metrics_token_required_when_set(db_client):
+    """
+    UNIT TEST: With METRICS_TOKEN set, /metrics needs it as a bearer token.
+    """
+    with patch('app.METRICS_TOKEN', 'secret'):
+        assert db_client.get('/metrics').status_code == 401
+        assert db_client.get('/metrics', headers={'Authorization': 'Bearer secret'}).status_code == 200
+
+def test_login_query_count(db_client):
+    """
+    QUERY COUNT: Logging in looks the user up once and records the login time.
+    """
+    with count_queries() as queries:
+        response = db_client.post('/login', data={'username': 'runner', 'password': 'password123'})
+
+    assert response.status_code == 302
+    assert [sql.split(None, 1)[0].upper() for sql in queries] == ['SELECT', 'UPDATE']
+
+def test_dashboard_backs_off_polling_with_webhooks(client):
+    """
+    UNIT TEST: With a push subscription, a sync an hour old is recent enough.
+    """
+    import time
+    _log_in(client)
+    with patch('database.get_user_context', return_value=_user_context(last_sync_time=int(time.time()) - 3600, has_strava=True)), \
+         patch('database.enqueue_sync_job') as mock_enqueue:
+        with patch('webhooks.SUBSCRIPTION_ID', '5'):
+            client.get('/')
+        mock_enqueue.assert_not_called()
+
+        client.get('/')
+        mock_enqueue.assert_called_once_with(1)
+
+def test_strava_webhook_verification(client):
+    """
+    UNIT TEST: The subscription handshake echoes the challenge only for our verify token.
+    """
+    params = {'hub.mode': 'subscribe', 'hub.verify_token': 'secret', 'hub.challenge': 'abc123'}
+    with patch('webhooks.VERIFY_TOKEN', 'secret'):
+        response = client.get('/strava/webhook', query_string=params)
+        assert response.status_code == 200
+        assert response.get_json() == {'hub.challenge': 'abc123'}
+
+        response = client.get('/strava/webhook', query_string={**params, 'hub.verify_token': 'wrong'})
+        assert response.status_code == 403
+
+def test_strava_webhook_acknowledges_without_calling_strava(db_client):
+    """
+    INTEGRATION TEST: A pushed event is stored for the worker and acknowledged
+    straight away, once, however often Strava redelivers it.
+    """
+    event = {'object_type': 'activity', 'object_id': 202, 'aspect_type': 'create', 'owner_id': 9,
+             'subscription_id': 1, 'event_time': 1700000000, 'updates': {}}
+
+    with patch('collector.fetch_activity') as mock_fetch, \
+         patch('webhooks.SUBSCRIPTION_ID', '1'):
+        for _ in range(2):
+            response = db_client.post('/strava/webhook', json=event)
+            assert response.status_code == 200
+        assert db_client.post('/strava/webhook', data='not json').status_code == 400
+
+    mock_fetch.assert_not_called()
+    assert database.claim_next_webhook_event()['object_id'] == 202
+    assert database.claim_next_webhook_event() is None
+
+def test_activity_streams_downsampled_and_cached(db_client):
+    """
+    INTEGRATION TEST: Stored streams come back downsampled in real units, with a 304 until the
+    streams (not the rest of the user's data) change.
+    """
+    _log_in(db_client)
+    assert db_client.get('/api/activities/101/streams').status_code == 404
+
+    database.save_activity_streams(1, 101, [
+        streams.pack('velocity_smooth', [3.0, 3.2, 3.4, 3.6]),
+        streams.pack('heartrate', [140, 142, 150, 152]),
+    ])
+    response = db_client.get('/api/activities/101/streams?points=2&types=velocity_smooth,heartrate')
+    assert response.status_code == 200
+    assert response.get_json() == {
+        'activity_id': 101,
+        'series': {'velocity_smooth': [3.1, 3.5], 'heartrate': [141, 151]},
+    }
+
+    etag = response.headers['ETag']
+    with count_queries() as queries:
+        response = db_client.get('/api/activities/101/streams?points=2&types=velocity_smooth,heartrate',
+                                 headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert len(queries) == 2
+
+    version = database.get_user_context(1)['data_version']
+    database.create_activity(1, '2025-01-03', 5.0, 102)
+    response = db_client.get('/api/activities/101/streams?points=2&types=velocity_smooth,heartrate',
+                             headers={'If-None-Match': etag})
+    assert response.status_code == 304
+
+    database.save_activity_streams(1, 101, [
+        streams.pack('velocity_smooth', [3.0, 3.0, 3.0, 3.0]),
+        streams.pack('heartrate', [150, 150, 150, 150]),
+    ])
+    assert database.get_user_context(1)['data_version'] == version + 1
+    response = db_client.get('/api/activities/101/streams?points=2&types=velocity_smooth,heartrate',
+                             headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.get_json()['series'] == {'velocity_smooth': [3.0, 3.0], 'heartrate': [150, 150]}
+
+def test_activity_streams_rejects_bad_params(db_client):
+    """
+    UNIT TEST: Out-of-range points and unknown stream types are a 400.
+    """
+    _log_in(db_client)
+
+    assert db_client.get('/api/activities/101/streams?points=1').status_code == 400
+    assert db_client.get('/api/activities/101/streams?points=5000').status_code == 400
+    assert db_client.get('/api/activities/101/streams?types=heartrate,power').status_code == 400
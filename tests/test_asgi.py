@@ -0,0 +1,148 @@
+import sys
+import os
+import asyncio
+import threading
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import asgi
+from app import app as flask_app
+from flask.sessions import SecureCookieSessionInterface
+
+
+def _user_context():
+    return {
+        'id': 1, 'username': 'runner', 'last_sync_time': 0, 'last_login_time': 0,
+        'has_strava': False, 'mileage_goal': None, 'long_run_goal': None
+    }
+
+
+@pytest.fixture(autouse=True)
+def secret_key():
+    flask_app.config['SECRET_KEY'] = 'test_key'
+    yield
+
+
+def _session_cookie():
+    serializer = SecureCookieSessionInterface().get_signing_serializer(flask_app)
+    return serializer.dumps({'_user_id': '1', '_fresh': True})
+
+
+def _scope(path, method='GET', query=b'', headers=()):
+    return {
+        'type': 'http', 'http_version': '1.1', 'method': method, 'scheme': 'http',
+        'path': path, 'raw_path': path.encode(), 'root_path': '', 'query_string': query,
+        'headers': [(name.encode(), value.encode()) for name, value in headers],
+        'server': ('testserver', 80), 'client': ('127.0.0.1', 5000),
+    }
+
+
+async def _request(scope, body=b''):
+    """Run one request through asgi.app. Returns (status, headers dict, body)."""
+    sent = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': body, 'more_body': False}
+
+    async def send(message):
+        sent.append(message)
+
+    await asgi.app(scope, receive, send)
+    headers = {name.decode(): value.decode() for name, value in sent[0]['headers']}
+    return sent[0]['status'], headers, sent[1]['body']
+
+
+def test_serves_flask_routes():
+    """
+    UNIT TEST: A page comes back from the Flask app with its status, headers and body.
+    """
+    status, headers, body = asyncio.run(_request(_scope('/login')))
+
+    assert status == 200
+    assert headers['content-type'].startswith('text/html')
+    assert body == flask_app.test_client().get('/login').data
+
+def test_form_posts_and_cookies_reach_the_view():
+    """
+    UNIT TEST: Request bodies, content type, query strings and cookies are passed to Flask as WSGI expects.
+    """
+    form = b'username=runner&password=secret'
+    with patch('database.authenticate', return_value={'id': 1, 'username': 'runner'}) as mock_auth, \
+         patch('database.update_last_login_time'):
+        status, headers, _ = asyncio.run(_request(_scope('/login', 'POST', headers=[
+            ('content-type', 'application/x-www-form-urlencoded'),
+            ('content-length', str(len(form))),
+        ]), form))
+
+    assert status == 302
+    mock_auth.assert_called_once_with('runner', 'secret')
+    assert 'session=' in headers['set-cookie']
+
+    environ = asgi.build_environ(_scope('/api/activities', query=b'all=true', headers=[
+        ('cookie', 'a=1'), ('cookie', 'b=2'), ('accept', 'text/html'), ('accept', 'application/json'),
+    ]), b'')
+    assert environ['QUERY_STRING'] == 'all=true'
+    assert environ['HTTP_COOKIE'] == 'a=1; b=2'
+    assert environ['HTTP_ACCEPT'] == 'text/html,application/json'
+
+def test_strava_bound_views_use_their_own_pool():
+    """
+    UNIT TEST: Only views in STRAVA_BOUND_ENDPOINTS run on the Strava pool; unknown paths use the request pool.
+    """
+    assert asgi.pool_for('GET', '/strava/callback') is asgi._strava_pool
+    assert asgi.pool_for('GET', '/api/activities') is asgi._request_pool
+    assert asgi.pool_for('GET', '/no/such/page') is asgi._request_pool
+
+def test_slow_strava_call_does_not_hold_up_other_requests():
+    """
+    INTEGRATION TEST: While a callback waits on Strava, other requests are still served, even with one request thread.
+    """
+    strava_waiting = threading.Event()
+    strava_responds = threading.Event()
+
+    def slow_exchange(code, user_id):
+        strava_waiting.set()
+        assert strava_responds.wait(10)
+
+    async def scenario():
+        cookie = [('cookie', f"session={_session_cookie()}")]
+        callback = asyncio.create_task(_request(_scope('/strava/callback', query=b'code=abc', headers=cookie)))
+        await asyncio.to_thread(strava_waiting.wait, 10)
+        page = await _request(_scope('/login'))
+        assert not callback.done()
+        strava_responds.set()
+        return page, await callback
+
+    with patch('database.get_user_context', return_value=_user_context()), \
+         patch('collector.authorize_and_save_user', side_effect=slow_exchange), \
+         patch('database.enqueue_sync_job'), \
+         patch('database.enqueue_backfill'), \
+         patch.object(asgi, '_request_pool', ThreadPoolExecutor(max_workers=1)):
+        page, callback = asyncio.run(scenario())
+
+    assert page[0] == 200
+    assert callback[0] == 302
+    assert callback[1]['location'].endswith('/')
+
+def test_lifespan_acknowledged_and_other_scopes_ignored():
+    """
+    UNIT TEST: Startup and shutdown are acknowledged (uvicorn sends them by default), and other scope types return without a response.
+    """
+    messages = [{'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    with patch.object(asgi, '_request_pool', ThreadPoolExecutor(max_workers=1)), \
+         patch.object(asgi, '_strava_pool', ThreadPoolExecutor(max_workers=1)):
+        asyncio.run(asgi.app({'type': 'lifespan'}, receive, send))
+        asyncio.run(asgi.app({'type': 'websocket', 'path': '/'}, receive, send))
+
+    assert [message['type'] for message in sent] == ['lifespan.startup.complete', 'lifespan.shutdown.complete']
@@ -0,0 +1,108 @@
+import sys
+import os
+import time
+import pytest
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import backfill
+import collector
+import database
+from bench.fake_strava import FakeStravaServer
+
+
+pytestmark = pytest.mark.usefixtures('unlimited_strava_budget', 'empty_token_cache')
+
+
+@pytest.fixture
+def fake_strava(test_db):
+    """A connected user with 12 activities on a fake Strava, fetched 5 per page."""
+    server = FakeStravaServer(activities_per_user=12).start()
+    with patch.object(collector, 'ACTIVITIES_URL', server.url + "/api/v3/athlete/activities"), \
+         patch.object(backfill, 'PER_PAGE', 5):
+        user_id = database.create_user('runner', 'password')
+        database.update_user_tokens(user_id, f"token-{user_id}", f"refresh-{user_id}", int(time.time()) + 3600)
+        yield server
+    server.stop()
+
+
+def _run_all(max_pages):
+    slices = 0
+    while backfill.run_pending_backfills(max_pages):
+        slices += 1
+    return slices
+
+
+def test_backfill_imports_whole_history_in_slices(fake_strava):
+    """
+    INTEGRATION TEST: A backfill walks every page, a slice at a time, and records its progress.
+    """
+    database.enqueue_backfill(1)
+
+    assert _run_all(max_pages=2) == 2
+
+    state = database.get_backfill(1)
+    assert state['status'] == 'done'
+    assert (state['pages_fetched'], state['activities_imported']) == (3, 12)
+    assert state['oldest_date'] == min(a['date'] for a in database.get_activities_for_user(1))
+    assert len(database.get_activities_for_user(1)) == 12
+    assert fake_strava.requests['activities'] == 3
+
+def test_backfill_resumes_from_checkpoint_after_crash(fake_strava):
+    """
+    INTEGRATION TEST: A backfill that dies mid-slice resumes at the page after the last one saved.
+    """
+    database.enqueue_backfill(1)
+    real_fetch = collector.fetch_activity_page
+    pages_requested = []
+
+    def crash_on_second_page(token, after, page, per_page, priority, before=None):
+        pages_requested.append(page)
+        if page == 2 and pages_requested.count(2) == 1:
+            raise ConnectionError("worker killed")
+        return real_fetch(token, after, page, per_page, priority, before=before)
+
+    with patch('collector.fetch_activity_page', side_effect=crash_on_second_page):
+        backfill.run_pending_backfills()
+        state = database.get_backfill(1)
+        assert (state['status'], state['next_page']) == ('failed', 2)
+
+        database.enqueue_backfill(1)
+        _run_all(max_pages=5)
+
+    assert pages_requested == [1, 2, 2, 3]
+    assert database.get_backfill(1)['status'] == 'done'
+    assert len(database.get_activities_for_user(1)) == 12
+
+def test_backfill_requests_only_activities_before_it_started(fake_strava):
+    """
+    UNIT TEST: Every page is bounded by the time the backfill was queued, using the backfill budget.
+    """
+    queued = database.enqueue_backfill(1)
+    with patch('collector.fetch_activity_page', return_value=[]) as mock_fetch:
+        backfill.run_pending_backfills()
+
+    mock_fetch.assert_called_once_with(f"token-1", None, 1, 5, 'backfill', before=queued['before_time'])
+    assert database.get_backfill(1)['status'] == 'done'
+
+def test_backfill_pauses_when_budget_exhausted(fake_strava):
+    """
+    UNIT TEST: Running out of budget puts the backfill back in the queue until the window resets.
+    """
+    database.enqueue_backfill(1)
+    with patch('database.reserve_strava_requests', return_value={'granted': False, 'retry_at': 4000000000}):
+        assert backfill.run_pending_backfills()
+
+    state = database.get_backfill(1)
+    assert (state['status'], state['run_after'], state['next_page']) == ('queued', 4000000000, 1)
+    assert database.claim_next_backfill() is None
+
+def test_backfill_calls_keep_reserve_for_other_work():
+    """
+    UNIT TEST: Backfill requests must leave BACKFILL_RESERVE of the window free.
+    """
+    with patch('database.reserve_strava_requests', return_value={'granted': True, 'retry_at': None}) as mock_reserve:
+        collector.strava_call(lambda url: object(), "https://example.com", 'backfill')
+
+    mock_reserve.assert_called_once_with(1, collector.BACKFILL_RESERVE)
@@ -18,6 +18,16 @@ def mock_env_vars():
     with patch.dict(os.environ, fake_env):
         yield
 
+pytestmark = pytest.mark.usefixtures('unlimited_strava_budget', 'empty_token_cache')
+
+@pytest.fixture(autouse=True)
+def uncontended_token_rows():
+    """Token refresh locks are always free, and no tokens have been revoked."""
+    with patch('database.acquire_token_refresh_lock', return_value=True), \
+         patch('database.release_token_refresh_lock'), \
+         patch('database.get_token_generation', return_value=0):
+        yield
+
 def test_fetch_converts_meters_to_miles_correctly():
     user_id = 1
     
@@ -29,13 +39,14 @@ def test_fetch_converts_meters_to_miles_correctly():
     }]
 
     #patching for test
-    with patch('requests.get') as mock_get, \
+    with patch('strava_http.get') as mock_get, \
          patch('collector.get_valid_access_token') as mock_token, \
          patch('database.get_last_sync_time') as mock_sync_time, \
-         patch('database.create_activity') as mock_db_save:
+         patch('database.create_activities') as mock_db_save:
          
         mock_token.return_value = "fake_token"
         mock_sync_time.return_value = None
+        mock_db_save.return_value = {'inserted': 1, 'skipped': 0}
         
         # Setup fake network response
         mock_response = MagicMock()
@@ -45,12 +56,12 @@ def test_fetch_converts_meters_to_miles_correctly():
 
         collector.fetch_and_save_user_data(user_id)
 
-        mock_db_save.assert_called_with(
-            user_id=1,
-            date='2023-10-27',
-            distance=1.0, 
-            activity_id=101
-        )
+        mock_db_save.assert_called_once_with(1, [{
+            'date': '2023-10-27',
+            'distance': 1.0, 
+            'activity_id': 101,
+            'activity_title': 'Test Run'
+        }])
 
 
 def test_authorize_and_save_user_parses_response():
@@ -130,4 +141,280 @@ def test_get_valid_access_token_returns_existing_if_valid():
         result = collector.get_valid_access_token(user_id)
 
         mock_refresh_func.assert_not_called()
-        assert result == "valid_token"
\ No newline at end of file
+        assert result == "valid_token"
+
+def _fake_pages(total, per_page):
+    """Build a strava_http.get side effect that serves `total` activities in pages."""
+    activities = [{
+        'id': n,
+        'distance': 1609.34,
+        'start_date_local': '2023-10-27T08:00:00Z',
+    } for n in range(total)]
+
+    def fake_get(url, headers=None, params=None):
+        start = (params['page'] - 1) * params['per_page']
+        response = MagicMock()
+        response.status_code = 200
+        response.json.return_value = activities[start:start + params['per_page']]
+        return response
+
+    return fake_get
+
+def test_iter_activity_pages_stops_on_short_page():
+    """
+    UNIT TEST: Pages are requested until Strava returns fewer than per_page.
+    """
+    with patch('strava_http.get', side_effect=_fake_pages(5, 2)) as mock_get:
+        pages = list(collector.iter_activity_pages("fake_token", 0, per_page=2))
+
+    assert [len(page) for page in pages] == [2, 2, 1]
+    assert mock_get.call_count == 3
+
+def test_iter_activity_pages_stops_on_empty_page():
+    """
+    UNIT TEST: When the last page is full, one more (empty) page ends the loop.
+    """
+    with patch('strava_http.get', side_effect=_fake_pages(4, 2)) as mock_get:
+        pages = list(collector.iter_activity_pages("fake_token", 0, per_page=2))
+
+    assert [len(page) for page in pages] == [2, 2]
+    assert mock_get.call_count == 3
+
+def test_iter_activity_pages_caps_per_page():
+    """
+    UNIT TEST: per_page is capped at Strava's maximum of 200.
+    """
+    with patch('strava_http.get', side_effect=_fake_pages(1, 200)) as mock_get:
+        list(collector.iter_activity_pages("fake_token", 0, per_page=500))
+
+    assert mock_get.call_args.kwargs['params']['per_page'] == 200
+
+def test_iter_activity_pages_closes_prefetch_connections():
+    """
+    UNIT TEST: The prefetch thread's pooled database connections are closed on that thread, even if the caller stops early.
+    """
+    import threading
+    for consume in (list, next):
+        closed_on = []
+        closed = threading.Event()
+
+        def close():
+            closed_on.append(threading.current_thread())
+            closed.set()
+
+        with patch('strava_http.get', side_effect=_fake_pages(5, 2)), \
+             patch('database.close_pooled_connection', side_effect=close):
+            pages = collector.iter_activity_pages("fake_token", 0, per_page=2)
+            consume(pages)
+            pages.close()
+            assert closed.wait(5)
+
+        assert len(closed_on) == 1
+        assert closed_on[0] is not threading.current_thread()
+
+def test_fetch_activity_page_without_after_lists_newest_first():
+    """
+    UNIT TEST: `after` is only sent when given, since Strava lists activities oldest first when it is.
+    """
+    with patch('strava_http.get', side_effect=_fake_pages(1, 2)) as mock_get:
+        collector.fetch_activity_page("fake_token", None, 1, 2, 'backfill', before=1700000000)
+        collector.fetch_activity_page("fake_token", 1600000000, 1, 2)
+
+    assert mock_get.call_args_list[0].kwargs['params'] == {'page': 1, 'per_page': 2, 'before': 1700000000}
+    assert mock_get.call_args_list[1].kwargs['params']['after'] == 1600000000
+
+def test_fetch_saves_every_page():
+    """
+    UNIT TEST: Each page is written to the database as it arrives.
+    """
+    with patch('strava_http.get', side_effect=_fake_pages(5, 2)), \
+         patch('collector.get_valid_access_token', return_value="fake_token"), \
+         patch('database.get_last_sync_time', return_value=None), \
+         patch('database.create_activities') as mock_db_save:
+
+        mock_db_save.return_value = {'inserted': 0, 'skipped': 0}
+
+        collector.fetch_and_save_user_data(1, per_page=2)
+
+        assert mock_db_save.call_count == 3
+        saved_ids = [row['activity_id'] for call in mock_db_save.call_args_list for row in call.args[1]]
+        assert saved_ids == [0, 1, 2, 3, 4]
+
+def test_strava_call_defers_without_budget():
+    """
+    UNIT TEST: No request is sent when the shared budget is exhausted.
+    """
+    send = MagicMock()
+    with patch('database.reserve_strava_requests', return_value={'granted': False, 'retry_at': 1234}):
+        with pytest.raises(collector.RateLimitDeferred) as excinfo:
+            collector.strava_call(send, "https://example.test")
+
+    send.assert_not_called()
+    assert excinfo.value.retry_at == 1234
+
+def test_strava_call_low_priority_keeps_reserve():
+    """
+    UNIT TEST: Low-priority calls leave part of the budget for interactive ones.
+    """
+    send = MagicMock()
+    send.return_value.rate_limit = None
+    with patch('database.reserve_strava_requests', return_value={'granted': True, 'retry_at': None}) as mock_reserve:
+        collector.strava_call(send, "https://example.test", priority='low')
+
+    mock_reserve.assert_called_once_with(1, collector.LOW_PRIORITY_RESERVE)
+
+def test_strava_call_records_rate_limit_headers():
+    """
+    UNIT TEST: Rate-limit headers from Strava are fed back into the shared budget.
+    """
+    rate_limit = {'short_limit': 100, 'short_usage': 5, 'daily_limit': 1000, 'daily_usage': 50}
+    send = MagicMock()
+    send.return_value.rate_limit = rate_limit
+    with patch('database.record_strava_rate_limit') as mock_record:
+        collector.strava_call(send, "https://example.test")
+
+    mock_record.assert_called_once_with(rate_limit)
+
+def test_fetch_propagates_rate_limit_deferral():
+    """
+    UNIT TEST: Running out of budget mid-sync is reported to the caller, not swallowed.
+    """
+    with patch('collector.get_valid_access_token', return_value="fake_token"), \
+         patch('database.get_last_sync_time', return_value=None), \
+         patch('database.reserve_strava_requests', return_value={'granted': False, 'retry_at': 99}):
+
+        with pytest.raises(collector.RateLimitDeferred):
+            collector.fetch_and_save_user_data(1, priority='low')
+
+def test_priority_for_last_login():
+    """
+    UNIT TEST: Users who haven't logged in recently get low-priority syncs.
+    """
+    import time
+    assert collector.priority_for_last_login(0) == 'low'
+    assert collector.priority_for_last_login(None) == 'low'
+    assert collector.priority_for_last_login(int(time.time())) == 'high'
+
+def _valid_tokens(access_token='valid_token'):
+    import time
+    return {
+        'strava_access_token': access_token,
+        'strava_refresh_token': 'valid_refresh',
+        'token_expiration': int(time.time()) + 3600
+    }
+
+def test_get_valid_access_token_uses_cache():
+    """
+    UNIT TEST: Repeat lookups are served from the in-process token cache.
+    """
+    with patch('database.get_user_tokens', return_value=_valid_tokens()) as mock_get_tokens:
+        assert collector.get_valid_access_token(1) == 'valid_token'
+        assert collector.get_valid_access_token(1) == 'valid_token'
+
+        mock_get_tokens.assert_called_once_with(1)
+
+def test_token_cache_dropped_after_disconnect_elsewhere():
+    """
+    UNIT TEST: Once another process revokes tokens, cached ones are re-read at the next generation check,
+    and cache hits in between don't query the database.
+    """
+    with patch('database.get_user_tokens', return_value=_valid_tokens()) as mock_get_tokens, \
+         patch('database.get_token_generation', return_value=0) as mock_generation:
+        collector.get_valid_access_token(1)
+        collector.get_valid_access_token(1)
+        assert (mock_get_tokens.call_count, mock_generation.call_count) == (1, 1)
+
+        mock_generation.return_value = 1
+        with patch.object(collector, 'TOKEN_GENERATION_INTERVAL', 0):
+            collector.get_valid_access_token(1)
+        assert mock_get_tokens.call_count == 2
+
+def test_token_cache_expires_after_ttl():
+    """
+    UNIT TEST: Cached tokens are re-read from the database after TOKEN_CACHE_TTL.
+    """
+    with patch('database.get_user_tokens', return_value=_valid_tokens()) as mock_get_tokens, \
+         patch.object(collector, 'TOKEN_CACHE_TTL', 0):
+        collector.get_valid_access_token(1)
+        collector.get_valid_access_token(1)
+
+        assert mock_get_tokens.call_count == 2
+
+def test_token_cache_evicts_least_recently_used():
+    """
+    UNIT TEST: The cache holds at most TOKEN_CACHE_SIZE users.
+    """
+    with patch('database.get_user_tokens', return_value=_valid_tokens()) as mock_get_tokens, \
+         patch.object(collector, 'TOKEN_CACHE_SIZE', 2):
+        collector.get_valid_access_token(1)
+        collector.get_valid_access_token(2)
+        collector.get_valid_access_token(1)
+        collector.get_valid_access_token(3)  # evicts user 2
+        collector.get_valid_access_token(1)
+        collector.get_valid_access_token(2)
+
+        assert [call.args[0] for call in mock_get_tokens.call_args_list] == [1, 2, 3, 2]
+
+def test_refresh_is_single_flight_across_threads():
+    """
+    UNIT TEST: Concurrent requests for an expiring token trigger one refresh.
+    """
+    import threading
+    import time
+    stored = {'tokens': {
+        'strava_access_token': 'old_token',
+        'strava_refresh_token': 'valid_refresh',
+        'token_expiration': 1000
+    }}
+
+    def fake_refresh(user_id, refresh_token):
+        time.sleep(0.05)
+        stored['tokens'] = _valid_tokens('brand_new_token')
+        return 'brand_new_token'
+
+    results = []
+    with patch('database.get_user_tokens', side_effect=lambda user_id: stored['tokens']), \
+         patch('collector.refresh_access_token', side_effect=fake_refresh) as mock_refresh:
+        threads = [threading.Thread(target=lambda: results.append(collector.get_valid_access_token(1)))
+                   for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        mock_refresh.assert_called_once_with(1, 'valid_refresh')
+        assert results == ['brand_new_token'] * 8
+
+def test_refresh_waits_for_other_worker():
+    """
+    UNIT TEST: If another worker holds the refresh lock, use the token it saves.
+    """
+    expired = {
+        'strava_access_token': 'old_token',
+        'strava_refresh_token': 'valid_refresh',
+        'token_expiration': 1000
+    }
+
+    with patch('database.get_user_tokens', side_effect=[expired, _valid_tokens('their_token')]), \
+         patch('database.acquire_token_refresh_lock', return_value=False), \
+         patch('collector.refresh_access_token') as mock_refresh, \
+         patch.object(collector, 'REFRESH_WAIT_INTERVAL', 0):
+
+        assert collector.get_valid_access_token(1) == 'their_token'
+        mock_refresh.assert_not_called()
+
+def test_refresh_access_token_updates_cache():
+    """
+    UNIT TEST: A refreshed token is cached so the next lookup skips the database.
+    """
+    response = MagicMock()
+    response.json.return_value = {'access_token': 'new', 'refresh_token': 'new_refresh', 'expires_at': 9999999999}
+    response.rate_limit = None
+
+    with patch('strava_http.post', return_value=response), \
+         patch('database.update_user_tokens'), \
+         patch('database.get_user_tokens') as mock_get_tokens:
+        collector.refresh_access_token(1, 'old_refresh')
+
+        assert collector.get_valid_access_token(1) == 'new'
+        mock_get_tokens.assert_not_called()
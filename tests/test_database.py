@@ -130,6 +130,20 @@ def test_validate_password():
     assert database.validate_password('testuser', 'testpassword') is True
     assert database.validate_password('testuser', 'wrongpassword') is False
 
+def test_authenticate_upgrades_old_hash():
+    """Test that a hash made with an older work factor is replaced on successful login only."""
+    import passwords
+    with patch.object(passwords, 'HASH_ITERATIONS', 1000):
+        database.create_user('testuser', 'testpassword')
+
+    with patch.object(passwords, 'HASH_ITERATIONS', 2000):
+        assert database.authenticate('testuser', 'wrongpassword') is None
+        assert database.get_user_by_username('testuser')['password_hash'].startswith('pbkdf2:sha256:1000$')
+
+        assert database.authenticate('testuser', 'testpassword') is not None
+        assert database.get_user_by_username('testuser')['password_hash'].startswith('pbkdf2:sha256:2000$')
+        assert database.validate_password('testuser', 'testpassword') is True
+
 def test_validate_password_for_nonexistent_user():
     """Test that the validate_password function returns False if the user does not exist."""
     assert database.validate_password('nonexistentuser', 'testpassword') is False
@@ -265,4 +279,666 @@ def test_get_activities_for_user_multiple_activities():
     assert activities[0]['distance'] == 20.0
     assert activities[1]['distance'] == 10.0
     assert activities[0]['activity_id'] == 1234567891
-    assert activities[1]['activity_id'] == 1234567890
\ No newline at end of file
+    assert activities[1]['activity_id'] == 1234567890
+
+def test_db_connection_reuses_connection_per_thread():
+    """Test that db_connection hands out the same pooled connection on repeated calls."""
+    with database.db_connection() as first:
+        pass
+    with database.db_connection() as second:
+        pass
+    assert first is second
+
+def test_db_connection_uses_wal_journal_mode():
+    """Test that pooled connections switch the database to WAL mode."""
+    with database.db_connection() as conn:
+        assert conn.execute("PRAGMA journal_mode").fetchone()[0] == 'wal'
+
+def test_db_connection_rolls_back_on_error():
+    """Test that an exception inside db_connection rolls back the whole block."""
+    database.create_user('testuser', 'testpassword')
+    with pytest.raises(RuntimeError):
+        with database.db_connection() as conn:
+            conn.execute("UPDATE Users SET last_sync_time = 99 WHERE id = 1")
+            raise RuntimeError("boom")
+    assert database.get_last_sync_time(1) is None
+
+def test_db_connection_nested_blocks_share_transaction():
+    """Test that nested db_connection blocks only commit when the outer block exits."""
+    database.create_user('testuser', 'testpassword')
+    with pytest.raises(RuntimeError):
+        with database.db_connection() as conn:
+            database.update_last_sync_time(1)
+            raise RuntimeError("boom")
+    assert database.get_last_sync_time(1) is None
+
+def test_db_connection_without_pooling_opens_new_connections():
+    """Test that POOL_CONNECTIONS = False falls back to connect-per-call."""
+    with patch.object(database, 'POOL_CONNECTIONS', False):
+        with database.db_connection() as first:
+            pass
+        with database.db_connection() as second:
+            pass
+    assert first is not second
+
+def test_create_activities_inserts_batch():
+    """Test that create_activities inserts every new activity and reports the count."""
+    database.create_user('testuser', 'testpassword')
+    result = database.create_activities(1, [
+        {'date': '2025-01-01', 'distance': 10.0, 'activity_id': 1},
+        {'date': '2025-01-02', 'distance': 5.0, 'activity_id': 2},
+    ])
+    assert result == {'inserted': 2, 'skipped': 0}
+    assert len(database.get_activities_for_user(1)) == 2
+
+def test_create_activities_skips_existing_activities():
+    """Test that create_activities skips activities that were already saved."""
+    database.create_user('testuser', 'testpassword')
+    database.create_activity(1, '2025-01-01', 10.0, 1)
+    result = database.create_activities(1, [
+        {'date': '2025-01-01', 'distance': 10.0, 'activity_id': 1},
+        {'date': '2025-01-02', 'distance': 5.0, 'activity_id': 2},
+    ])
+    assert result == {'inserted': 1, 'skipped': 1}
+    assert len(database.get_activities_for_user(1)) == 2
+
+def test_create_activities_with_no_activities():
+    """Test that create_activities handles an empty batch."""
+    assert database.create_activities(1, []) == {'inserted': 0, 'skipped': 0}
+
+def test_activities_for_missing_user_raise_instead_of_being_dropped():
+    """Test that writing activities for a user with no Users row raises and writes nothing."""
+    with pytest.raises(ValueError):
+        database.create_activities(42, [{'date': '2025-01-01', 'distance': 3.0, 'activity_id': 1}])
+    with pytest.raises(ValueError):
+        database.create_activity(42, '2025-01-01', 3.0, 2)
+    with pytest.raises(ValueError):
+        database.save_activity(42, '2025-01-01', 3.0, 3)
+
+    with database.db_connection() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM DailyMileage").fetchone()[0] == 0
+
+def test_activity_version_not_reused_by_a_racing_bump():
+    """Test that a data_version bump landing between reading the next version and writing the row can't hide the activity from delta sync."""
+    import threading
+    database.create_user('testuser', 'testpassword')
+    racer_version = []
+
+    def racing_bump():
+        # Another writer (a goal change, another worker's sync) on its own connection
+        with database.db_connection(1) as conn:
+            database._bump_data_version(conn, 1)
+            racer_version.append(conn.execute("SELECT data_version FROM Users WHERE id = 1").fetchone()[0])
+
+    racer = threading.Thread(target=racing_bump)
+    original = database._next_data_version
+
+    def next_version_then_race(conn, user_id):
+        version = original(conn, user_id)
+        racer.start()
+        racer.join(0.5)
+        return version
+
+    with patch.object(database, '_next_data_version', side_effect=next_version_then_race):
+        database.create_activity(1, '2025-01-01', 3.0, 101)
+    racer.join()
+
+    with database.db_connection() as conn:
+        activity_version = conn.execute("SELECT version FROM DailyMileage WHERE activity_id = 101").fetchone()[0]
+    assert activity_version != racer_version[0]
+    # A client holding the racer's version either saw the activity already or gets it in its next delta
+    changes = database.get_activity_changes(1, racer_version[0])
+    assert activity_version < racer_version[0] or [a['activity_id'] for a in changes['activities']] == [101]
+
+def _seed_activities():
+    database.create_user('testuser', 'testpassword')
+    database.create_activities(1, [
+        {'date': '2025-01-01', 'distance': 3.0, 'activity_id': 10},
+        {'date': '2025-01-02', 'distance': 4.0, 'activity_id': 11},
+        {'date': '2025-01-02', 'distance': 5.0, 'activity_id': 12},
+        {'date': '2025-01-03', 'distance': 6.0, 'activity_id': 13},
+    ])
+
+def test_get_activities_for_user_filters_dates():
+    """Test that date_from/date_to are inclusive bounds."""
+    _seed_activities()
+    activities = database.get_activities_for_user(1, date_from='2025-01-02', date_to='2025-01-02')
+    assert [a['activity_id'] for a in activities] == [12, 11]
+
+def test_get_activities_for_user_pages_with_cursor():
+    """Test that keyset pages cover every activity once, even when dates tie."""
+    _seed_activities()
+    first = database.get_activities_for_user(1, limit=2)
+    last = first[-1]
+    second = database.get_activities_for_user(1, before=(last['date'], last['activity_id']), limit=2)
+    assert [a['activity_id'] for a in first] == [13, 12]
+    assert [a['activity_id'] for a in second] == [11, 10]
+
+def test_data_version_bumped_by_new_activities_and_goals():
+    """Test that data_version changes with new activities and goals but not duplicate syncs."""
+    database.create_user('testuser', 'testpassword')
+    database.create_athlete_with_goals(1, 30.0, 10.0)
+    version = database.get_user_context(1)['data_version']
+
+    database.create_activities(1, [{'date': '2025-01-01', 'distance': 3.0, 'activity_id': 10}])
+    assert database.get_user_context(1)['data_version'] == version + 1
+    database.create_activities(1, [{'date': '2025-01-01', 'distance': 3.0, 'activity_id': 10}])
+    assert database.get_user_context(1)['data_version'] == version + 1
+
+    database.set_long_run_goal(1, 12.0)
+    context = database.get_user_context(1)
+    assert context['data_version'] == version + 2
+    assert context['data_modified_at'] > 0
+
+def test_get_activity_changes_since_version():
+    """Test that only activities written after `since` come back, and all of them for since=0."""
+    _seed_activities()
+    version = database.get_activity_changes(1)['version']
+    database.create_activity(1, '2025-01-04', 7.0, 14)
+
+    changes = database.get_activity_changes(1, version)
+    assert [a['activity_id'] for a in changes['activities']] == [14]
+    assert changes['deleted'] == []
+    assert changes['version'] == version + 1
+    assert len(database.get_activity_changes(1, 0)['activities']) == 5
+
+def test_delete_activity_leaves_tombstone():
+    """Test that deleting an activity updates the rollups and shows up as a deletion."""
+    _seed_activities()
+    version = database.get_activity_changes(1)['version']
+
+    assert database.delete_activity(1, 12) is True
+    assert database.delete_activity(1, 12) is False
+
+    changes = database.get_activity_changes(1, version)
+    assert changes['deleted'] == [12]
+    assert changes['activities'] == []
+    assert database.get_weekly_summary(1, '2024-12-30', 1)[0]['daily_mileage'][3] == 4.0
+
+def test_enqueue_sync_job_reuses_active_job():
+    """Test that enqueue_sync_job doesn't queue a second job while one is pending."""
+    database.create_user('testuser', 'testpassword')
+    first = database.enqueue_sync_job(1)
+    second = database.enqueue_sync_job(1)
+    assert first == second
+    assert database.get_latest_sync_job(1)['status'] == 'queued'
+
+def test_claim_next_sync_job_marks_job_running():
+    """Test that claim_next_sync_job hands out the oldest queued job once."""
+    database.create_user('testuser', 'testpassword')
+    job_id = database.enqueue_sync_job(1)
+    job = database.claim_next_sync_job()
+    assert job['id'] == job_id
+    assert job['status'] == 'running'
+    assert database.claim_next_sync_job() is None
+
+def test_finish_sync_job_records_outcome():
+    """Test that finish_sync_job stores the result and frees the user for a new job."""
+    database.create_user('testuser', 'testpassword')
+    job_id = database.enqueue_sync_job(1)
+    database.claim_next_sync_job()
+    database.finish_sync_job(job_id, activities_imported=4)
+    job = database.get_latest_sync_job(1)
+    assert job['status'] == 'done'
+    assert job['activities_imported'] == 4
+    assert database.enqueue_sync_job(1) != job_id
+
+def test_requeue_stale_sync_jobs():
+    """Test that jobs abandoned in the running state are queued again."""
+    database.create_user('testuser', 'testpassword')
+    database.enqueue_sync_job(1)
+    database.claim_next_sync_job()
+    assert database.requeue_stale_sync_jobs(600) == 0
+    assert database.requeue_stale_sync_jobs(-1) == 1
+    assert database.get_latest_sync_job(1)['status'] == 'queued'
+
+def test_defer_sync_job_hides_job_until_run_after():
+    """Test that a deferred job isn't claimed again before its run_after time."""
+    import time
+    database.create_user('testuser', 'testpassword')
+    job_id = database.enqueue_sync_job(1)
+    database.claim_next_sync_job()
+    database.defer_sync_job(job_id, int(time.time()) + 600)
+    assert database.claim_next_sync_job() is None
+    database.defer_sync_job(job_id, 0)
+    assert database.claim_next_sync_job()['id'] == job_id
+
+def test_claim_next_sync_job_prefers_high_priority():
+    """Test that high-priority jobs are claimed before older low-priority ones."""
+    database.create_user('inactive', 'testpassword')
+    database.create_user('active', 'testpassword')
+    database.enqueue_sync_job(1, priority='low')
+    high_id = database.enqueue_sync_job(2, priority='high')
+    assert database.claim_next_sync_job()['id'] == high_id
+
+def test_deferred_low_priority_job_waits_until_user_returns():
+    """Test that a low-priority job queued for later runs then, unless the user asks for a sync first."""
+    import time
+    database.create_user('testuser', 'testpassword')
+    job_id = database.enqueue_sync_job(1, priority='low', run_after=int(time.time()) + 600)
+    assert database.claim_next_sync_job() is None
+
+    assert database.enqueue_sync_job(1) == job_id
+    job = database.claim_next_sync_job()
+    assert (job['id'], job['priority']) == (job_id, 'high')
+
+def test_reserve_strava_requests_until_limit():
+    """Test that the shared Strava budget grants requests up to the 15 minute limit."""
+    database.record_strava_rate_limit({'short_limit': 3, 'short_usage': 1, 'daily_limit': 1000, 'daily_usage': 1})
+    assert database.reserve_strava_requests()['granted'] is True
+    assert database.reserve_strava_requests()['granted'] is True
+    denied = database.reserve_strava_requests()
+    assert denied['granted'] is False
+    assert denied['retry_at'] % database.SHORT_WINDOW_SECONDS == 0
+    assert database.get_strava_rate_limit()['short_remaining'] == 0
+
+def test_reserve_strava_requests_keeps_reserve():
+    """Test that a reserve fraction denies requests before the budget is fully used."""
+    database.record_strava_rate_limit({'short_limit': 10, 'short_usage': 6, 'daily_limit': 1000, 'daily_usage': 6})
+    assert database.reserve_strava_requests(1, 0.3)['granted'] is True
+    assert database.reserve_strava_requests(1, 0.3)['granted'] is False
+    assert database.reserve_strava_requests(1, 0.0)['granted'] is True
+
+def test_reserve_strava_requests_daily_limit():
+    """Test that the daily limit is enforced and retries after midnight UTC."""
+    database.record_strava_rate_limit({'short_limit': 100, 'short_usage': 0, 'daily_limit': 5, 'daily_usage': 5})
+    denied = database.reserve_strava_requests()
+    assert denied['granted'] is False
+    assert denied['retry_at'] % database.DAY_SECONDS == 0
+
+def test_record_strava_rate_limit_keeps_local_reservations():
+    """Test that stale header counts don't erase requests reserved since."""
+    database.record_strava_rate_limit({'short_limit': 100, 'short_usage': 10, 'daily_limit': 1000, 'daily_usage': 10})
+    for _ in range(5):
+        database.reserve_strava_requests()
+    database.record_strava_rate_limit({'short_limit': 100, 'short_usage': 12, 'daily_limit': 1000, 'daily_usage': 12})
+    assert database.get_strava_rate_limit()['short_usage'] == 15
+
+def test_update_last_login_time():
+    """Test that update_last_login_time records when the user logged in."""
+    database.create_user('testuser', 'testpassword')
+    assert database.get_user_by_id(1)['last_login_time'] == 0
+    database.update_last_login_time(1)
+    assert database.get_user_by_id(1)['last_login_time'] > 0
+
+def test_get_users_with_strava():
+    """Test that get_users_with_strava only returns users who connected Strava."""
+    database.create_user('connected', 'testpassword')
+    database.create_user('not_connected', 'testpassword')
+    database.update_user_tokens(1, 'testaccesstoken', 'testrefreshtoken', 1717986911)
+    users = database.get_users_with_strava()
+    assert [user['id'] for user in users] == [1]
+
+def test_token_refresh_lock_has_one_owner():
+    """Test that only one owner can hold a user's token refresh lock."""
+    assert database.acquire_token_refresh_lock(1, 'worker-a', 30) is True
+    assert database.acquire_token_refresh_lock(1, 'worker-b', 30) is False
+    assert database.acquire_token_refresh_lock(2, 'worker-b', 30) is True
+    database.release_token_refresh_lock(1, 'worker-a')
+    assert database.acquire_token_refresh_lock(1, 'worker-b', 30) is True
+
+def test_token_refresh_lock_lapses():
+    """Test that an expired refresh lock can be taken over."""
+    assert database.acquire_token_refresh_lock(1, 'worker-a', -1) is True
+    assert database.acquire_token_refresh_lock(1, 'worker-b', 30) is True
+
+def test_release_token_refresh_lock_ignores_other_owner():
+    """Test that releasing someone else's refresh lock does nothing."""
+    database.acquire_token_refresh_lock(1, 'worker-a', 30)
+    database.release_token_refresh_lock(1, 'worker-b')
+    assert database.acquire_token_refresh_lock(1, 'worker-b', 30) is False
+
+def test_get_user_context_joins_athlete_goals():
+    """Test that get_user_context returns user and athlete fields together."""
+    database.create_user('testuser', 'testpassword')
+    database.create_athlete_with_goals(1, 100.0, 10.0)
+    context = database.get_user_context(1)
+    assert context['username'] == 'testuser'
+    assert context['mileage_goal'] == 100.0
+    assert context['long_run_goal'] == 10.0
+    assert context['has_strava'] is False
+    assert 'password_hash' not in context
+
+def test_get_user_context_without_athlete_row():
+    """Test that get_user_context works before goals are set."""
+    database.create_user('testuser', 'testpassword')
+    database.update_user_tokens(1, 'testaccesstoken', 'testrefreshtoken', 1717986911)
+    context = database.get_user_context(1)
+    assert context['mileage_goal'] is None
+    assert context['has_strava'] is True
+
+def test_get_user_context_for_nonexistent_user():
+    """Test that get_user_context returns None for a nonexistent user."""
+    assert database.get_user_context(1) is None
+
+def test_authenticate():
+    """Test that authenticate returns the user row only for the right password."""
+    database.create_user('testuser', 'testpassword')
+    assert database.authenticate('testuser', 'testpassword')['id'] == 1
+    assert database.authenticate('testuser', 'wrongpassword') is None
+    assert database.authenticate('nonexistentuser', 'testpassword') is None
+
+def test_init_db_records_schema_version():
+    """Test that init_db brings a new database to the latest schema version."""
+    with database.db_connection() as conn:
+        assert database.get_schema_version(conn) == database.SCHEMA_VERSION
+        versions = [row[0] for row in conn.execute("SELECT version FROM SchemaMigrations ORDER BY version")]
+    assert versions == [version for version, _, _ in database.MIGRATIONS]
+
+def test_migrate_is_idempotent():
+    """Test that running migrations again applies nothing."""
+    with database.db_connection() as conn:
+        assert database.migrate(conn) == 0
+
+def test_migrate_upgrades_legacy_database(tmp_path):
+    """Test that a database created before migrations existed is upgraded in place."""
+    import sqlite3
+    legacy_db = str(tmp_path / "legacy.db")
+    with sqlite3.connect(legacy_db) as conn:
+        conn.execute("""CREATE TABLE Users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, username VARCHAR(50) UNIQUE NOT NULL,
+            password_hash VARCHAR(128) NOT NULL, strava_athlete_id INTEGER UNIQUE,
+            strava_access_token TEXT, strava_refresh_token TEXT, token_expiration INTEGER,
+            last_sync_time INTEGER DEFAULT 0)""")
+        conn.execute("""CREATE TABLE Athletes (
+            user_id INTEGER PRIMARY KEY, mileage_goal REAL, long_run_goal REAL)""")
+        conn.execute("""CREATE TABLE DailyMileage (
+            user_id INTEGER, activity_id INTEGER PRIMARY KEY, date DATE, distance REAL,
+            activity_title VARCHAR(100), UNIQUE(user_id, date, activity_id))""")
+        conn.execute("INSERT INTO Users (username, password_hash) VALUES ('old', 'x')")
+        conn.execute("INSERT INTO DailyMileage VALUES (1, 42, '2024-05-01', 6.2, NULL)")
+
+    with patch.object(database, 'DB_NAME', legacy_db):
+        database.init_db()
+        with database.db_connection() as conn:
+            assert database.get_schema_version(conn) == database.SCHEMA_VERSION
+            table_sql = conn.execute(
+                "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'DailyMileage'"
+            ).fetchone()[0]
+        assert 'UNIQUE' not in table_sql
+        assert database.get_activities_for_user(1) == [
+            {'activity_id': 42, 'date': '2024-05-01', 'distance': 6.2, 'activity_title': None}
+        ]
+        assert database.get_user_by_id(1)['last_login_time'] == 0
+        database.close_pooled_connection()
+
+def test_migrate_from_many_workers_at_once(tmp_path):
+    """Test that workers starting together apply each migration exactly once."""
+    import sqlite3
+    import threading
+    fresh_db = str(tmp_path / "fresh.db")
+    errors = []
+
+    def worker():
+        conn = sqlite3.connect(fresh_db)
+        try:
+            database.migrate(conn)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            conn.close()
+
+    with patch.object(database, 'DB_NAME', fresh_db):
+        threads = [threading.Thread(target=worker) for _ in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    assert errors == []
+    with sqlite3.connect(fresh_db) as conn:
+        count = conn.execute("SELECT COUNT(*) FROM SchemaMigrations").fetchone()[0]
+    assert count == len(database.MIGRATIONS)
+
+def _query_plan(sql, params):
+    with database.db_connection() as conn:
+        return " | ".join(row['detail'] for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params))
+
+def test_activities_query_uses_user_date_index():
+    """Test that the activities query is an index search with no table scan or sort."""
+    plan = _query_plan(
+        """SELECT activity_id, date, distance, activity_title 
+           FROM DailyMileage 
+           WHERE user_id = ? AND date >= ? AND (date, activity_id) < (?, ?)
+           ORDER BY date DESC, activity_id DESC
+           LIMIT ?""",
+        (1, '2025-01-01', '2025-02-01', 10, 50)
+    )
+    assert 'USING INDEX idx_dailymileage_user_date' in plan
+    assert 'TEMP B-TREE' not in plan
+    assert 'SCAN' not in plan
+
+def test_user_lookups_use_indexes():
+    """Test that per-request user lookups search by key instead of scanning Users."""
+    assert 'SEARCH' in _query_plan("SELECT * FROM Users WHERE username = ?", ('runner',))
+    plan = _query_plan(
+        """SELECT u.id FROM Users u LEFT JOIN Athletes a ON a.user_id = u.id WHERE u.id = ?""",
+        (1,)
+    )
+    assert 'SCAN' not in plan
+
+def test_latest_sync_job_query_uses_index():
+    """Test that the sync-status lookup uses the SyncJobs user index."""
+    plan = _query_plan("SELECT * FROM SyncJobs WHERE user_id = ? ORDER BY id DESC LIMIT 1", (1,))
+    assert 'USING INDEX idx_syncjobs_user' in plan
+    assert 'TEMP B-TREE' not in plan
+
+def test_week_start_for_is_monday():
+    """Test that weeks run Monday to Sunday."""
+    assert database.week_start_for('2025-01-06') == datetime.date(2025, 1, 6)
+    assert database.week_start_for('2025-01-12') == datetime.date(2025, 1, 6)
+    assert database.week_start_for(datetime.date(2025, 1, 13)) == datetime.date(2025, 1, 13)
+
+def test_create_activities_updates_rollups():
+    """Test that new activities show up in the daily and weekly totals."""
+    database.create_user('testuser', 'testpassword')
+    database.create_activities(1, [
+        {'date': '2025-01-06', 'distance': 5.0, 'activity_id': 1},
+        {'date': '2025-01-06', 'distance': 3.0, 'activity_id': 2},
+        {'date': '2025-01-12', 'distance': 10.0, 'activity_id': 3},
+        {'date': '2025-01-13', 'distance': 4.0, 'activity_id': 4},
+    ])
+    weeks = database.get_weekly_summary(1, '2025-01-13', 2)
+
+    assert [week['week_start'] for week in weeks] == ['2025-01-13', '2025-01-06']
+    assert weeks[0]['total'] == 4.0
+    assert weeks[0]['daily_mileage'] == [4.0, 0, 0, 0, 0, 0, 0]
+    assert weeks[1]['total'] == 18.0
+    assert weeks[1]['longest_run'] == 10.0
+    assert weeks[1]['activity_count'] == 3
+    assert weeks[1]['daily_mileage'] == [8.0, 0, 0, 0, 0, 0, 10.0]
+
+def test_rollups_do_not_double_count_duplicates():
+    """Test that re-syncing an activity doesn't change the totals."""
+    database.create_user('testuser', 'testpassword')
+    database.create_activity(1, '2025-01-07', 6.0, 1)
+    database.create_activity(1, '2025-01-07', 6.0, 1)
+    database.create_activities(1, [{'date': '2025-01-07', 'distance': 6.0, 'activity_id': 1}])
+
+    week = database.get_weekly_summary(1, '2025-01-06', 1)[0]
+    assert week['total'] == 6.0
+    assert week['activity_count'] == 1
+
+def test_weekly_summary_fills_empty_weeks():
+    """Test that weeks without runs come back as zeros."""
+    weeks = database.get_weekly_summary(1, '2025-01-08', 3)
+    assert [week['week_start'] for week in weeks] == ['2025-01-06', '2024-12-30', '2024-12-23']
+    assert all(week['total'] == 0 and week['daily_mileage'] == [0.0] * 7 for week in weeks)
+
+def test_migrate_backfills_rollups(tmp_path):
+    """Test that the rollup migration builds totals from activities already saved."""
+    import sqlite3
+    db = str(tmp_path / "backfill.db")
+    conn = sqlite3.connect(db)
+    try:
+        for version, name, fn in database.MIGRATIONS[:7]:
+            fn(conn.cursor())
+        conn.execute("INSERT INTO Users (username, password_hash) VALUES ('old', 'x')")
+        conn.executemany(
+            "INSERT INTO DailyMileage (user_id, activity_id, date, distance) VALUES (?, ?, ?, ?)",
+            [(1, 1, '2024-12-29', 4.0), (1, 2, '2024-12-30', 5.0), (1, 3, '2025-01-05', 7.0)]
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+    with patch.object(database, 'DB_NAME', db):
+        with database.db_connection() as conn:
+            database.migrate(conn)
+        weeks = database.get_weekly_summary(1, '2024-12-30', 2)
+        database.close_pooled_connection()
+
+    assert weeks[0]['total'] == 12.0
+    assert weeks[0]['daily_mileage'] == [5.0, 0, 0, 0, 0, 0, 7.0]
+    assert weeks[1]['total'] == 4.0
+    assert weeks[1]['daily_mileage'][6] == 4.0
+
+def test_save_activity_inserts_updates_and_skips_unchanged():
+    """Test that save_activity upserts one activity and only bumps the version on a change."""
+    database.create_user('testuser', 'testpassword')
+    assert database.save_activity(1, '2025-01-07', 5.0, 1, "Easy") == 'inserted'
+    version = database.get_user_context(1)['data_version']
+
+    assert database.save_activity(1, '2025-01-07', 5.0, 1, "Easy") == 'unchanged'
+    assert database.get_user_context(1)['data_version'] == version
+
+    assert database.save_activity(1, '2025-01-14', 6.0, 1, "Tempo") == 'updated'
+    assert database.get_weekly_summary(1, '2025-01-06', 1)[0]['total'] == 0
+    assert database.get_weekly_summary(1, '2025-01-13', 1)[0]['total'] == 6.0
+    assert database.get_activity_changes(1, version)['activities'][0]['activity_title'] == "Tempo"
+
+def test_enqueue_backfill_resumes_failed_and_keeps_done():
+    """Test that re-queueing resumes a failed backfill from its checkpoint, and only restart starts over."""
+    database.create_user('testuser', 'testpassword')
+    database.enqueue_backfill(1)
+    database.claim_next_backfill()
+    database.save_backfill_page(1, [{'date': '2020-05-01', 'distance': 4.0, 'activity_id': 1}], 2)
+    database.finish_backfill(1, error="boom")
+
+    state = database.enqueue_backfill(1)
+    assert (state['status'], state['next_page'], state['error']) == ('queued', 2, None)
+
+    database.claim_next_backfill()
+    database.finish_backfill(1)
+    assert database.enqueue_backfill(1)['status'] == 'done'
+
+    state = database.enqueue_backfill(1, restart=True)
+    assert (state['status'], state['next_page'], state['activities_imported']) == ('queued', 1, 0)
+
+def test_save_backfill_page_tracks_oldest_date():
+    """Test that the checkpoint keeps the oldest activity date seen across pages."""
+    database.create_user('testuser', 'testpassword')
+    database.enqueue_backfill(1)
+    database.save_backfill_page(1, [{'date': '2021-01-05', 'distance': 4.0, 'activity_id': 1},
+                                    {'date': '2020-12-30', 'distance': 4.0, 'activity_id': 2}], 2)
+    database.save_backfill_page(1, [], 3)
+
+    state = database.get_backfill(1)
+    assert (state['oldest_date'], state['pages_fetched'], state['next_page']) == ('2020-12-30', 2, 3)
+
+def test_new_activities_queued_for_streams_except_backfill():
+    """Test that synced activities are queued for a stream fetch and backfilled ones are not."""
+    database.create_user('testuser', 'testpassword')
+    database.create_activities(1, [{'date': '2025-01-07', 'distance': 5.0, 'activity_id': 1, 'activity_title': "Easy"}])
+    database.create_activities(1, [{'date': '2025-01-07', 'distance': 5.0, 'activity_id': 1}])
+    database.save_backfill_page(1, [{'date': '2020-05-01', 'distance': 4.0, 'activity_id': 2}], 2)
+
+    assert database.claim_next_stream_fetch(600) == {'user_id': 1, 'activity_id': 1, 'attempts': 0}
+    assert database.claim_next_stream_fetch(600) is None
+    titles = {a['activity_id']: a['activity_title'] for a in database.get_activities_for_user(1)}
+    assert titles == {1: "Easy", 2: None}
+
+def test_delete_activity_removes_streams():
+    """Test that deleting an activity deletes its stored and queued streams."""
+    database.create_user('testuser', 'testpassword')
+    database.create_activity(1, '2025-01-07', 5.0, 1)
+    assert database.save_activity_streams(1, 1, [{'stream_type': 'heartrate', 'typecode': 'b',
+                                                  'scale': 1, 'count': 1, 'data': b'x'}])
+    database.save_activity(1, '2025-01-07', 5.5, 1, "Cropped")
+
+    database.delete_activity(1, 1)
+
+    assert database.get_activity_streams(1, 1) == {}
+    assert database.claim_next_stream_fetch(600) is None
+
+def test_write_buffer_group_commits_concurrent_writes():
+    """Test that writes from several threads share one commit and are visible once each call returns."""
+    import threading
+    for n in range(1, 5):
+        database.create_user(f'runner{n}', 'password')
+
+    def sync(user_id):
+        database.create_activities(user_id, [{'date': '2025-01-07', 'distance': float(user_id), 'activity_id': user_id}])
+
+    with patch('metrics.inc') as mock_inc:
+        with database.write_buffer(max_writes=4, max_delay=5):
+            threads = [threading.Thread(target=sync, args=(n,)) for n in range(1, 5)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            assert [a['distance'] for a in database.get_activities_for_user(3)] == [3.0]
+
+    mock_inc.assert_any_call('db_group_commits_total', {})
+    mock_inc.assert_any_call('db_group_commit_writes_total', {}, 4)
+
+def test_write_buffer_failed_write_only_fails_its_caller():
+    """Test that a write raising inside a group commit fails its own call and the others still commit."""
+    import threading
+
+    @database._group_committed
+    def flaky_write(user_id):
+        with database.db_connection(user_id) as conn:
+            if user_id == 2:
+                raise ValueError("bad write")
+            conn.execute("UPDATE Users SET last_login_time = 123 WHERE id = ?", (user_id,))
+
+    for n in range(1, 4):
+        database.create_user(f'runner{n}', 'password')
+    errors = {}
+
+    def call(user_id):
+        try:
+            flaky_write(user_id)
+        except ValueError as e:
+            errors[user_id] = e
+
+    with database.write_buffer(max_writes=3, max_delay=5):
+        threads = [threading.Thread(target=call, args=(n,)) for n in range(1, 4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    assert list(errors) == [2]
+    assert [database.get_user_by_id(n)['last_login_time'] for n in (1, 3)] == [123, 123]
+
+def test_write_buffer_bypassed_inside_transaction():
+    """Test that a buffered write made inside an open transaction runs in it rather than waiting for the buffer."""
+    database.create_user('testuser', 'testpassword')
+
+    with database.write_buffer(max_writes=10, max_delay=5):
+        with database.db_connection(1) as conn:
+            database.update_last_sync_time(1)
+            assert conn.execute("SELECT last_sync_time FROM Users WHERE id = 1").fetchone()[0] is not None
+
+    assert database.get_last_sync_time(1) is not None
+
+def test_stop_write_buffer_commits_pending_writes():
+    """Test that stopping the buffer commits queued writes without waiting out the delay."""
+    import threading
+    import time
+    database.create_user('testuser', 'testpassword')
+
+    database.start_write_buffer(max_writes=10, max_delay=30)
+    buffer = database._write_buffer
+    writer = threading.Thread(target=database.update_user_tokens, args=(1, 'access', 'refresh', 9999999999))
+    writer.start()
+    while not buffer.pending:
+        time.sleep(0.01)
+    database.stop_write_buffer()
+    writer.join(timeout=5)
+
+    assert not writer.is_alive()
+    assert database.get_user_tokens(1)['strava_access_token'] == 'access'
+    assert database._write_buffer is None
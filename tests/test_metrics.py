@@ -0,0 +1,96 @@
+import sys
+import os
+import multiprocessing
+import pytest
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import database
+import metrics
+
+
+@pytest.fixture(autouse=True)
+def setup_test_db(tmp_path):
+    with patch.object(database, 'DB_NAME', str(tmp_path / "test_app.db")):
+        database.init_db()
+        yield
+        database.close_pooled_connection()
+
+
+def _lines(text, prefix):
+    return [line for line in text.splitlines() if line.startswith(prefix)]
+
+
+def test_render_histogram_buckets_are_cumulative():
+    """Test that a histogram renders cumulative buckets, sum and count."""
+    labels = {'route': '/api/activities', 'method': 'GET', 'status': '200'}
+    metrics.observe('http_request_duration_seconds', labels, 0.003)
+    metrics.observe('http_request_duration_seconds', labels, 0.2)
+    metrics.observe('http_request_duration_seconds', labels, 30)
+
+    text = metrics.render()
+    series = 'http_request_duration_seconds_bucket{method="GET",route="/api/activities",status="200",'
+    assert f'{series}le="0.001"}} 0' in text
+    assert f'{series}le="0.005"}} 1' in text
+    assert f'{series}le="0.25"}} 2' in text
+    assert f'{series}le="10.0"}} 2' in text
+    assert f'{series}le="+Inf"}} 3' in text
+    assert 'http_request_duration_seconds_count{method="GET",route="/api/activities",status="200"} 3' in text
+    assert '# TYPE http_request_duration_seconds histogram' in text
+
+
+def test_flushes_add_up():
+    """Test that each flush adds to the stored totals instead of replacing them."""
+    metrics.inc('db_call_errors_total', {'function': 'create_user'})
+    metrics.flush()
+    metrics.inc('db_call_errors_total', {'function': 'create_user'}, 2)
+
+    assert 'db_call_errors_total{function="create_user"} 3' in metrics.render()
+
+
+def _record_in_child(db_name):
+    with patch.object(database, 'DB_NAME', db_name):
+        metrics._pending.clear()
+        metrics.inc('db_call_errors_total', {'function': 'from_child'}, 5)
+        metrics.flush()
+
+
+def test_metrics_from_other_processes_are_included():
+    """Test that /metrics totals include what other worker processes recorded."""
+    metrics.inc('db_call_errors_total', {'function': 'from_child'}, 1)
+    metrics.flush()
+
+    child = multiprocessing.get_context('fork').Process(target=_record_in_child, args=(database.DB_NAME,))
+    child.start()
+    child.join(10)
+
+    assert child.exitcode == 0
+    assert 'db_call_errors_total{function="from_child"} 6' in metrics.render()
+
+
+def test_label_values_are_escaped():
+    """Test that quotes and backslashes in label values can't break the text format."""
+    metrics.inc('db_call_errors_total', {'function': 'a"b\\c'})
+    assert 'db_call_errors_total{function="a\\"b\\\\c"} 1' in metrics.render()
+
+
+def test_database_functions_are_timed():
+    """Test that database.py helpers record latency and errors by function name."""
+    database.create_user('runner', 'password123')
+    with pytest.raises(ValueError):
+        database.create_user('runner', 'password123')
+
+    text = metrics.render()
+    assert _lines(text, 'db_call_duration_seconds_count{function="create_user"} 2')
+    assert 'db_call_errors_total{function="create_user"} 1' in text
+    assert not _lines(text, 'db_call_duration_seconds_count{function="db_connection"}')
+
+
+def test_failed_flush_keeps_pending_metrics():
+    """Test that metrics aren't lost when the database can't be written."""
+    metrics.inc('db_call_errors_total', {'function': 'x'})
+    with patch.object(database, 'get_connection', side_effect=Exception("database is locked")):
+        metrics.flush()
+
+    assert 'db_call_errors_total{function="x"} 1' in metrics.render()
@@ -0,0 +1,76 @@
+import sys
+import os
+import pytest
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import passwords
+
+
+def test_hash_and_check_in_worker_process():
+    """Test that hashing round-trips through the process pool with the configured work factor."""
+    with patch.object(passwords, 'HASH_ITERATIONS', 1000):
+        password_hash = passwords.hash_password('secret')
+
+    assert password_hash.startswith('pbkdf2:sha256:1000$')
+    assert passwords.check_password(password_hash, 'secret') is True
+    assert passwords.check_password(password_hash, 'wrong') is False
+    assert passwords._pool is not None
+
+def test_hashes_inline_without_workers():
+    """Test that PASSWORD_HASH_WORKERS=0 hashes on the calling thread."""
+    with patch.object(passwords, 'HASH_WORKERS', 0), \
+         patch.object(passwords, 'HASH_ITERATIONS', 1000), \
+         patch.object(passwords, '_get_pool') as mock_pool:
+        assert passwords.check_password(passwords.hash_password('secret'), 'secret')
+    mock_pool.assert_not_called()
+
+def test_needs_rehash_when_work_factor_changes():
+    """Test that only hashes made with other parameters need upgrading."""
+    with patch.object(passwords, 'HASH_ITERATIONS', 1000):
+        assert not passwords.needs_rehash('pbkdf2:sha256:1000$salt$hash')
+        assert passwords.needs_rehash('pbkdf2:sha256:600000$salt$hash')
+        assert passwords.needs_rehash('scrypt:32768:8:1$salt$hash')
+
+def test_login_blocked_after_too_many_failures_for_username():
+    """Test that a username is locked out after MAX_FAILED_LOGINS_PER_USERNAME failures, from any IP."""
+    for n in range(passwords.MAX_FAILED_LOGINS_PER_USERNAME):
+        assert not passwords.login_blocked('runner', f'10.0.0.{n}')
+        passwords.record_failed_login('runner', f'10.0.0.{n}')
+
+    assert passwords.login_blocked('runner', '10.0.0.99')
+    assert not passwords.login_blocked('other', '10.0.0.99')
+
+def test_username_lockout_is_case_sensitive_like_login():
+    """Test that failures against "Runner" don't lock out "runner", since usernames are case-sensitive at login."""
+    for n in range(passwords.MAX_FAILED_LOGINS_PER_USERNAME):
+        passwords.record_failed_login('Runner', f'10.0.0.{n}')
+
+    assert passwords.login_blocked('Runner', '10.0.0.99')
+    assert not passwords.login_blocked('runner', '10.0.0.99')
+
+def test_login_blocked_after_too_many_failures_from_ip():
+    """Test that one IP guessing many usernames is locked out, and a success doesn't reset it."""
+    for n in range(passwords.MAX_FAILED_LOGINS_PER_IP):
+        passwords.record_failed_login(f'user{n}', '10.0.0.1')
+    passwords.clear_failed_logins('user0')
+
+    assert passwords.login_blocked('anyone', '10.0.0.1')
+    assert not passwords.login_blocked('anyone', '10.0.0.2')
+
+def test_failures_expire_after_window():
+    """Test that the lockout ends once FAILED_LOGIN_WINDOW has passed."""
+    with patch('time.monotonic', return_value=1000.0):
+        for _ in range(passwords.MAX_FAILED_LOGINS_PER_USERNAME):
+            passwords.record_failed_login('runner', '10.0.0.1')
+        assert passwords.login_blocked('runner', '10.0.0.1')
+    with patch('time.monotonic', return_value=1000.0 + passwords.FAILED_LOGIN_WINDOW):
+        assert not passwords.login_blocked('runner', '10.0.0.1')
+
+def test_failed_login_cache_is_bounded():
+    """Test that the oldest keys are evicted past FAILED_LOGIN_CACHE_SIZE."""
+    with patch.object(passwords, 'FAILED_LOGIN_CACHE_SIZE', 4):
+        for n in range(5):
+            passwords.record_failed_login(f'user{n}', f'10.0.0.{n}')
+    assert len(passwords._failed_logins) == 4
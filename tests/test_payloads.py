@@ -0,0 +1,74 @@
+import sys
+import os
+import datetime
+import pytest
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from flask import Flask
+from flask.json.provider import DefaultJSONProvider
+import payloads
+
+ACTIVITIES = [
+    {'activity_id': 103, 'date': '2025-01-15', 'distance': 6.2, 'activity_title': 'Long run'},
+    {'activity_id': 102, 'date': '2025-01-02', 'distance': 3.1, 'activity_title': None},
+    {'activity_id': 101, 'date': '2025-01-01', 'distance': 5.0, 'activity_title': None},
+]
+
+
+def test_to_columnar_uses_day_offsets_and_sparse_titles():
+    """Test that dates become offsets from the earliest date and only real titles are sent."""
+    columnar = payloads.to_columnar(ACTIVITIES)
+    assert columnar == {
+        'base_date': '2025-01-01',
+        'activity_id': [103, 102, 101],
+        'day': [14, 1, 0],
+        'distance': [6.2, 3.1, 5.0],
+        'activity_title': [[0, 'Long run']],
+    }
+
+
+def test_columnar_round_trip():
+    """Test that from_columnar restores the original rows."""
+    assert payloads.from_columnar(payloads.to_columnar(ACTIVITIES)) == ACTIVITIES
+
+
+def test_to_columnar_with_no_activities():
+    """Test that an empty list encodes to empty arrays."""
+    columnar = payloads.to_columnar([])
+    assert columnar['base_date'] is None
+    assert payloads.from_columnar(columnar) == []
+
+
+@pytest.mark.parametrize('body', [
+    {'activities': ACTIVITIES, 'next_cursor': None, 'has_strava': True},
+    {'when': datetime.date(2025, 1, 1), 'count': 3, 'b': 1, 'a': 2},
+    {'activities': [{'activity_id': 104, 'activity_title': 'Sortie à Montréal 🏃'}]},
+])
+def test_json_provider_matches_flask_output(body):
+    """Test that the orjson-backed provider produces exactly what Flask's encoder would with ensure_ascii off."""
+    app = Flask(__name__)
+    expected = DefaultJSONProvider(app).dumps(body, separators=(",", ":"), ensure_ascii=False)
+    assert payloads.JSONProvider(app).dumps(body, separators=(",", ":")) == expected
+    with patch.object(payloads, 'orjson', None):
+        assert payloads.JSONProvider(app).dumps(body, separators=(",", ":")) == expected
+
+
+def test_non_ascii_title_same_bytes_with_or_without_orjson():
+    """Test that a non-ASCII title is sent as raw UTF-8 whichever encoder runs, so the response bytes match."""
+    app = Flask(__name__)
+    app.json = payloads.JSONProvider(app)
+    body = {'activity_title': 'Café 5k'}
+    with app.app_context():
+        with_orjson = app.json.response(body).get_data()
+        with patch.object(payloads, 'orjson', None):
+            without_orjson = app.json.response(body).get_data()
+    assert with_orjson == without_orjson == '{"activity_title":"Café 5k"}\n'.encode()
+
+
+def test_json_provider_without_orjson():
+    """Test that the provider falls back to Flask's encoder when orjson isn't installed."""
+    app = Flask(__name__)
+    with patch.object(payloads, 'orjson', None):
+        assert payloads.JSONProvider(app).dumps({'b': 1, 'a': 2}) == '{"a": 2, "b": 1}'
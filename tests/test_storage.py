@@ -0,0 +1,165 @@
+import sys
+import os
+import sqlite3
+import time
+import pytest
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import database
+import storage
+
+SHARDS = 3
+
+
+@pytest.fixture
+def sharded_db(tmp_path):
+    with patch.object(database, 'DB_NAME', str(tmp_path / "test_app.db")), \
+         patch.object(database, 'STORAGE_BACKEND', 'sharded'), \
+         patch.object(database, 'STORAGE_SHARDS', SHARDS):
+        database.init_db()
+        yield database.get_storage()
+        database.close_pooled_connection()
+
+
+def _count(path, sql, params=()):
+    conn = database.get_connection(path)
+    try:
+        return conn.execute(sql, params).fetchone()[0]
+    finally:
+        conn.close()
+
+
+def test_layouts_route_users_to_files():
+    """Test that the single-file layout uses one file and the sharded one spreads users by id."""
+    single = storage.get_storage("data/app.db")
+    assert single.paths() == ["data/app.db"]
+    assert single.shard_for(7) == "data/app.db"
+
+    sharded = storage.get_storage("data/app.db", 'sharded', 4)
+    assert sharded.paths() == ["data/app.db"] + [f"data/app.shard{i}.db" for i in range(4)]
+    assert sharded.shard_for(7) == "data/app.shard3.db"
+    assert sharded.shard_for(8) == "data/app.shard0.db"
+
+    with pytest.raises(ValueError):
+        storage.get_storage("data/app.db", 'postgres')
+
+def test_layout_without_shard_for_cannot_be_created():
+    """Test that a Storage subclass missing shard_for fails when it is created, not on first use."""
+    class NoRouting(storage.Storage):
+        pass
+
+    with pytest.raises(TypeError):
+        NoRouting("data/app.db", ["data/app.db"])
+
+def test_users_rows_live_in_their_shard(sharded_db):
+    """Test that each user's activities are written to their own shard and read back from it."""
+    for n in range(1, SHARDS + 1):
+        user_id = database.create_user(f'runner{n}', 'password')
+        database.create_athlete_with_goals(user_id, 30.0, 10.0)
+        database.create_activity(user_id, '2025-01-01', float(n), user_id * 100)
+
+    for user_id in range(1, SHARDS + 1):
+        shard = sharded_db.shard_for(user_id)
+        assert _count(shard, "SELECT COUNT(*) FROM DailyMileage") == 1
+        assert _count(shard, "SELECT COUNT(*) FROM DailyMileage WHERE user_id = ?", (user_id,)) == 1
+        assert database.get_activities_for_user(user_id)[0]['distance'] == float(user_id)
+        assert database.get_user_context(user_id)['mileage_goal'] == 30.0
+        assert database.get_weekly_summary(user_id, '2024-12-30', 1)[0]['total'] == float(user_id)
+    assert _count(sharded_db.directory, "SELECT COUNT(*) FROM DailyMileage") == 0
+    assert _count(sharded_db.directory, "SELECT COUNT(*) FROM Users") == SHARDS
+
+def test_usernames_and_logins_use_the_directory(sharded_db):
+    """Test that usernames stay unique across shards and password hashes are only kept in the directory."""
+    user_id = database.create_user('runner', 'password')
+    with pytest.raises(ValueError):
+        database.create_user('runner', 'other')
+
+    assert database.authenticate('runner', 'password')['id'] == user_id
+    assert database.authenticate('runner', 'wrong') is None
+    assert _count(sharded_db.shard_for(user_id), "SELECT password_hash FROM Users WHERE id = ?", (user_id,)) == ''
+
+def test_user_not_created_when_shard_write_fails(sharded_db, tmp_path):
+    """Test that a failed write to the user's shard leaves no directory row behind, so the username stays free."""
+    corrupt = tmp_path / "corrupt.db"
+    corrupt.write_bytes(b"not a database" * 100)
+    with patch.object(sharded_db, 'shard_for', return_value=str(corrupt)):
+        with pytest.raises(sqlite3.DatabaseError):
+            database.create_user('runner', 'password')
+
+    assert database.get_user_by_username('runner') is None
+    user_id = database.create_user('runner', 'password')
+    assert database.get_user_context(user_id)['username'] == 'runner'
+
+def test_strava_connections_across_shards(sharded_db):
+    """Test that Strava users are listed from every shard and athlete lookups follow connects and disconnects."""
+    for n in range(1, 5):
+        database.create_user(f'runner{n}', 'password')
+    database.save_user_tokens_and_info(2, 'access', 'refresh', int(time.time()) + 3600, 20)
+    database.save_user_tokens_and_info(4, 'access', 'refresh', int(time.time()) + 3600, 40)
+    database.update_last_login_time(4)
+
+    assert [user['id'] for user in database.get_users_with_strava()] == [2, 4]
+    user = database.get_user_by_strava_athlete_id(40)
+    assert user['id'] == 4 and user['last_login_time'] > 0
+    assert database.get_user_tokens(4)['strava_access_token'] == 'access'
+
+    database.disconnect_strava(4)
+    assert database.get_user_by_strava_athlete_id(40) is None
+    assert [user['id'] for user in database.get_users_with_strava()] == [2]
+
+def test_backfill_page_commits_activities_before_checkpoint(sharded_db):
+    """Test that a backfill page lands in the user's shard and its checkpoint in the directory."""
+    user_id = database.create_user('runner', 'password')
+    database.enqueue_backfill(user_id)
+    database.save_backfill_page(user_id, [{'date': '2020-05-01', 'distance': 4.0, 'activity_id': 1}], 2)
+
+    assert database.get_backfill(user_id)['next_page'] == 2
+    assert _count(sharded_db.shard_for(user_id), "SELECT COUNT(*) FROM DailyMileage") == 1
+
+    with pytest.raises(RuntimeError):
+        with database.db_connection() as directory:
+            with database.db_connection(user_id) as conn:
+                database.create_activity(user_id, '2020-05-02', 5.0, 2)
+            raise RuntimeError("crashed before the checkpoint")
+    assert len(database.get_activities_for_user(user_id)) == 2
+
+def test_stream_fetches_claimed_from_every_shard(sharded_db):
+    """Test that stream fetches queued on different shards are all claimed, taking turns."""
+    for n in range(1, 4):
+        database.create_user(f'runner{n}', 'password')
+    database.create_activities(1, [{'date': '2025-01-01', 'distance': 3.0, 'activity_id': 10},
+                                   {'date': '2025-01-02', 'distance': 3.0, 'activity_id': 11}])
+    database.create_activity(2, '2025-01-01', 3.0, 20)
+    database.create_activity(3, '2025-01-01', 3.0, 30)
+
+    claimed = []
+    while (item := database.claim_next_stream_fetch(600)) is not None:
+        claimed.append(item['user_id'])
+    assert sorted(claimed) == [1, 1, 2, 3]
+    assert len(set(claimed[:3])) == 3
+
+def test_copy_to_shards_moves_single_file_database(tmp_path):
+    """Test that copy_to_shards makes an existing single-file database readable as a sharded one."""
+    db = str(tmp_path / "test_app.db")
+    with patch.object(database, 'DB_NAME', db):
+        database.init_db()
+        for n in range(1, 4):
+            database.create_user(f'runner{n}', 'password')
+            database.create_athlete_with_goals(n, 20.0 + n, 8.0)
+            database.create_activity(n, '2025-01-06', 5.0, n * 100)
+        database.save_user_tokens_and_info(2, 'access', 'refresh', 9999999999, 20)
+        database.close_pooled_connection()
+
+        with patch.object(database, 'STORAGE_BACKEND', 'sharded'), \
+             patch.object(database, 'STORAGE_SHARDS', SHARDS):
+            copied = database.copy_to_shards()
+            assert (copied['Users'], copied['DailyMileage'], copied['WeeklyTotals']) == (3, 3, 3)
+            assert database.copy_to_shards()['DailyMileage'] == 0
+
+            assert database.get_user_context(3)['mileage_goal'] == 23.0
+            assert [a['activity_id'] for a in database.get_activities_for_user(2)] == [200]
+            assert database.get_user_by_strava_athlete_id(20)['id'] == 2
+            assert database.authenticate('runner1', 'password')['id'] == 1
+            database.close_pooled_connection()
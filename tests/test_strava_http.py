@@ -0,0 +1,191 @@
+import sys
+import os
+import json
+import threading
+import pytest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import requests
+import metrics
+import strava_http
+
+
+class StubStrava(BaseHTTPRequestHandler):
+    """
+    Local stand-in for Strava. Each test loads `responses` with
+    (status, headers, body) tuples served in order; the last one repeats.
+    """
+    responses = []
+    requests_seen = []
+
+    def _respond(self):
+        StubStrava.requests_seen.append((self.command, self.path))
+        index = min(len(StubStrava.requests_seen), len(StubStrava.responses)) - 1
+        status, headers, body = StubStrava.responses[index]
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    do_GET = _respond
+    do_POST = _respond
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def stub_server():
+    StubStrava.responses = []
+    StubStrava.requests_seen = []
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubStrava)
+    thread = threading.Thread(target=server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(autouse=True)
+def no_backoff_sleep():
+    with patch('time.sleep'):
+        yield
+
+
+RATE_HEADERS = {"X-RateLimit-Limit": "100,1000", "X-RateLimit-Usage": "40,300"}
+
+
+def test_get_returns_json_and_rate_limit(stub_server):
+    """
+    UNIT TEST: A successful response carries the parsed rate-limit headers.
+    """
+    StubStrava.responses = [(200, RATE_HEADERS, [{"id": 1}])]
+
+    response = strava_http.get(stub_server + "/athlete/activities")
+
+    assert response.json() == [{"id": 1}]
+    assert response.rate_limit['short_remaining'] == 60
+    assert response.rate_limit['daily_remaining'] == 700
+    assert strava_http.last_rate_limit == response.rate_limit
+
+def test_retries_server_errors(stub_server):
+    """
+    UNIT TEST: 5xx responses are retried until one succeeds.
+    """
+    StubStrava.responses = [(503, {}, {}), (502, {}, {}), (200, {}, {"ok": True})]
+
+    response = strava_http.get(stub_server + "/athlete/activities")
+
+    assert response.status_code == 200
+    assert len(StubStrava.requests_seen) == 3
+
+def test_gives_up_after_max_retries(stub_server):
+    """
+    UNIT TEST: After MAX_RETRIES the last error response is returned.
+    """
+    StubStrava.responses = [(500, {}, {})]
+
+    response = strava_http.get(stub_server + "/athlete/activities")
+
+    assert response.status_code == 500
+    assert len(StubStrava.requests_seen) == strava_http.MAX_RETRIES + 1
+
+def test_retries_429_with_budget_left(stub_server):
+    """
+    UNIT TEST: A 429 is retried while the rate-limit headers show budget left.
+    """
+    StubStrava.responses = [(429, RATE_HEADERS, {}), (200, RATE_HEADERS, {})]
+
+    response = strava_http.post(stub_server + "/oauth/token")
+
+    assert response.status_code == 200
+    assert len(StubStrava.requests_seen) == 2
+
+def test_does_not_retry_429_when_budget_exhausted(stub_server):
+    """
+    UNIT TEST: A 429 with the 15-minute budget used up is returned immediately.
+    """
+    exhausted = {"X-RateLimit-Limit": "100,1000", "X-RateLimit-Usage": "100,300"}
+    StubStrava.responses = [(429, exhausted, {})]
+
+    response = strava_http.get(stub_server + "/athlete/activities")
+
+    assert response.status_code == 429
+    assert len(StubStrava.requests_seen) == 1
+
+def test_does_not_retry_client_errors(stub_server):
+    """
+    UNIT TEST: 4xx responses other than 429 are not retried.
+    """
+    StubStrava.responses = [(401, {}, {"message": "Authorization Error"})]
+
+    response = strava_http.get(stub_server + "/athlete/activities")
+
+    assert response.status_code == 401
+    assert len(StubStrava.requests_seen) == 1
+
+def test_retries_connection_errors():
+    """
+    UNIT TEST: Connection failures are retried, then re-raised.
+    """
+    with patch.object(strava_http.get_session(), 'request', side_effect=requests.ConnectionError) as mock_request:
+        with pytest.raises(requests.ConnectionError):
+            strava_http.get("http://127.0.0.1:9/unreachable")
+
+    assert mock_request.call_count == strava_http.MAX_RETRIES + 1
+
+def test_does_not_retry_post_read_timeouts():
+    """
+    UNIT TEST: A POST that timed out mid-response is not sent again.
+    """
+    with patch.object(strava_http.get_session(), 'request', side_effect=requests.ReadTimeout) as mock_request:
+        with pytest.raises(requests.ReadTimeout):
+            strava_http.post("http://127.0.0.1:9/oauth/token")
+
+    assert mock_request.call_count == 1
+
+def test_sets_default_timeout():
+    """
+    UNIT TEST: Requests get explicit connect/read timeouts by default.
+    """
+    with patch.object(strava_http.get_session(), 'request') as mock_request:
+        mock_request.return_value.headers = {}
+        mock_request.return_value.status_code = 200
+        strava_http.get("http://127.0.0.1:9/athlete")
+
+    assert mock_request.call_args.kwargs['timeout'] == (strava_http.CONNECT_TIMEOUT, strava_http.READ_TIMEOUT)
+
+def test_parse_rate_limit_handles_missing_headers():
+    """
+    UNIT TEST: Responses without rate-limit headers parse to None.
+    """
+    assert strava_http.parse_rate_limit({}) is None
+    assert strava_http.parse_rate_limit({"X-RateLimit-Limit": "x", "X-RateLimit-Usage": "1,2"}) is None
+
+def test_session_is_reused():
+    """
+    UNIT TEST: All calls share one pooled session.
+    """
+    assert strava_http.get_session() is strava_http.get_session()
+
+def test_records_latency_per_attempt(stub_server):
+    """
+    UNIT TEST: Every attempt is timed, labelled by endpoint (IDs collapsed) and status.
+    """
+    StubStrava.responses = [(503, {}, {}), (200, RATE_HEADERS, {"id": 7})]
+
+    strava_http.get(stub_server + "/api/v3/activities/12345")
+
+    counts = {labels: value for (name, labels, series), value in metrics._pending.items()
+              if name == 'strava_request_duration_seconds' and series == 'count'}
+    assert counts == {
+        'endpoint="/api/v3/activities/{id}",method="GET",status="503"': 1,
+        'endpoint="/api/v3/activities/{id}",method="GET",status="200"': 1,
+    }
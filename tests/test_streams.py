@@ -0,0 +1,156 @@
+import sys
+import os
+import json
+import time
+import pytest
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import collector
+import database
+import streams
+from bench.fake_strava import FakeStravaServer, fake_streams
+
+ATHLETE_ID = 7
+ACTIVITY_ID = ATHLETE_ID * 1_000_000 + 3
+
+
+pytestmark = pytest.mark.usefixtures('unlimited_strava_budget', 'empty_token_cache')
+
+
+@pytest.fixture
+def fake_strava(test_db):
+    """A connected user with one saved activity, queued for its streams, on a fake Strava."""
+    server = FakeStravaServer(activities_per_user=5).start()
+    with patch.object(collector, 'ACTIVITY_URL', server.url + "/api/v3/activities/{activity_id}"):
+        user_id = database.create_user('runner', 'password')
+        database.save_user_tokens_and_info(user_id, f"token-{ATHLETE_ID}", "refresh", int(time.time()) + 3600, ATHLETE_ID)
+        database.create_activity(user_id, '2025-06-01', 5.0, ACTIVITY_ID, "Run 3")
+        yield server
+    server.stop()
+
+
+def test_encode_round_trips_at_stream_scale():
+    """
+    UNIT TEST: Values come back exactly, as integers in units of 1/scale.
+    """
+    velocity = [3.01, 3.02, 2.98, 3.5, 0.0, 4.27]
+    typecode, count, data = streams.encode(velocity, 100)
+
+    assert (typecode, count) == ('h', 6)
+    assert list(streams.decode(typecode, data)) == [301, 302, 298, 350, 0, 427]
+
+def test_encode_repeats_last_value_for_missing_samples():
+    """
+    UNIT TEST: Gaps (None) in a stream repeat the previous sample, so every stream stays aligned with time.
+    """
+    typecode, count, data = streams.encode([None, 140, None, None, 150], 1)
+
+    assert count == 5
+    assert list(streams.decode(typecode, data)) == [0, 140, 140, 140, 150]
+
+def test_encode_widens_typecode_only_when_deltas_need_it():
+    """
+    UNIT TEST: The narrowest array type that holds every delta is used.
+    """
+    assert streams.encode([0, 100, 200], 1)[0] == 'b'
+    assert streams.encode([0, 1000, 2000], 1)[0] == 'h'
+    assert streams.encode([0, 100000], 1)[0] == 'i'
+    with pytest.raises(ValueError):
+        streams.encode([0, 2 ** 40], 1)
+
+def test_packed_stream_is_much_smaller_than_json():
+    """
+    UNIT TEST: A realistic hour-long stream packs to a small fraction of Strava's JSON.
+    """
+    fetched = fake_streams(ACTIVITY_ID, streams.STREAM_TYPES)
+    packed = [streams.pack(stream_type, stream['data']) for stream_type, stream in fetched.items()]
+
+    json_size = len(json.dumps({key: stream['data'] for key, stream in fetched.items()}))
+    assert sum(len(stream['data']) for stream in packed) * 10 < json_size
+
+def test_downsample_averages_buckets():
+    """
+    UNIT TEST: Long streams are averaged into evenly sized buckets; short ones are only scaled.
+    """
+    values = streams.decode(*streams.encode([1, 2, 3, 4, 5, 6], 10)[::2])
+
+    assert streams.downsample(values, 10, 3) == [1.5, 3.5, 5.5]
+    assert streams.downsample(values, 10, 10) == [1, 2, 3, 4, 5, 6]
+
+def test_pending_fetch_saves_streams_for_new_activity(fake_strava):
+    """
+    INTEGRATION TEST: A saved activity's streams are fetched once, stored packed and loadable for charting.
+    """
+    version = database.get_user_context(1)['data_version']
+
+    assert streams.run_pending_stream_fetches() == 1
+    assert streams.run_pending_stream_fetches() == 0
+
+    stored = database.get_activity_streams(1, ACTIVITY_ID)
+    assert set(stored) == {'time', 'distance', 'velocity_smooth', 'altitude', 'heartrate', 'cadence'}
+    expected = fake_streams(ACTIVITY_ID, ['heartrate'])['heartrate']['data']
+    assert list(streams.decode(stored['heartrate']['typecode'], stored['heartrate']['data'])) == expected
+
+    series = streams.load_series(1, ACTIVITY_ID, ['velocity_smooth'], points=100)
+    assert list(series) == ['velocity_smooth']
+    assert len(series['velocity_smooth']) == 100
+    # Streams are versioned on their own; the activity data hasn't changed
+    assert database.get_user_context(1)['data_version'] == version
+    assert database.get_streams_version(1, ACTIVITY_ID) == 1
+    assert fake_strava.requests['activities'] == 1
+
+def test_fetch_for_missing_activity_dequeues_it(fake_strava):
+    """
+    INTEGRATION TEST: An activity Strava no longer shows is taken off the queue without storing anything.
+    """
+    fake_strava.deleted.add(ACTIVITY_ID)
+
+    streams.run_pending_stream_fetches()
+
+    assert database.get_activity_streams(1, ACTIVITY_ID) == {}
+    assert database.claim_next_stream_fetch(streams.LEASE_SECONDS) is None
+
+def test_streams_not_saved_for_activity_deleted_meanwhile(fake_strava):
+    """
+    UNIT TEST: Streams fetched for an activity deleted during the fetch are dropped.
+    """
+    database.delete_activity(1, ACTIVITY_ID)
+
+    assert not database.save_activity_streams(1, ACTIVITY_ID, [streams.pack('heartrate', [140])])
+    assert database.get_activity_streams(1, ACTIVITY_ID) == {}
+
+def test_fetch_deferred_when_budget_exhausted(fake_strava):
+    """
+    UNIT TEST: Running out of budget stops this run and leaves the fetch queued until the window resets.
+    """
+    with patch('database.reserve_strava_requests', return_value={'granted': False, 'retry_at': 4000000000}):
+        assert streams.run_pending_stream_fetches() == 1
+
+    with patch('time.time', return_value=4000000000):
+        item = database.claim_next_stream_fetch(streams.LEASE_SECONDS)
+    assert (item['activity_id'], item['attempts']) == (ACTIVITY_ID, 0)
+
+def test_failing_fetch_is_retried_then_dropped(fake_strava):
+    """
+    UNIT TEST: A failing fetch is retried later, and given up after MAX_ATTEMPTS failures.
+    """
+    with patch('streams.fetch_and_save_streams', side_effect=RuntimeError("boom")), \
+         patch.object(streams, 'RETRY_SECONDS', -1):
+        for _ in range(streams.MAX_ATTEMPTS - 1):
+            assert streams.run_pending_stream_fetches(limit=1) == 1
+        assert database.claim_next_stream_fetch(0)['attempts'] == streams.MAX_ATTEMPTS - 1
+        assert streams.run_pending_stream_fetches(limit=1) == 1
+
+    assert database.claim_next_stream_fetch(0) is None
+
+def test_stream_fetches_use_low_priority():
+    """
+    UNIT TEST: Stream fetches leave the reserve for syncs and webhooks.
+    """
+    with patch('collector.strava_call') as mock_call:
+        mock_call.return_value.status_code = 404
+        assert collector.fetch_activity_streams("token", ACTIVITY_ID, ['time']) is None
+
+    assert mock_call.call_args[0][2] == 'low'
@@ -0,0 +1,91 @@
+import sys
+import os
+import asyncio
+import threading
+import time
+import pytest
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import collector
+import database
+import strava_http
+import sync_engine
+from bench.fake_strava import FakeStravaServer
+
+
+def test_sync_all_reports_totals():
+    """
+    UNIT TEST: Per-user outcomes are rolled up into the totals.
+    """
+    users = [{'id': 1, 'last_login_time': 0}, {'id': 2, 'last_login_time': 0}, {'id': 3, 'last_login_time': 0}]
+    outcomes = {1: 4, 2: None, 3: collector.RateLimitDeferred(0)}
+
+    def fake_fetch(user_id, per_page, priority):
+        outcome = outcomes[user_id]
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    with patch('collector.fetch_and_save_user_data', side_effect=fake_fetch), \
+         patch('database.update_last_sync_time') as mock_sync_time, \
+         patch('database.enqueue_sync_job') as mock_enqueue:
+        report = asyncio.run(sync_engine.sync_all(users, concurrency=2))
+
+    totals = report['totals']
+    assert (totals['ok'], totals['failed'], totals['deferred']) == (1, 1, 1)
+    assert totals['activities_imported'] == 4
+    mock_sync_time.assert_called_once_with(1)
+    # The deferred sync is queued for the sync worker at its priority, due when the budget resets
+    mock_enqueue.assert_called_once_with(3, 'low', 0)
+    assert [r['status'] for r in report['users']] == ['ok', 'failed', 'deferred']
+
+def test_sync_all_bounds_concurrency():
+    """
+    UNIT TEST: No more than `concurrency` syncs run at the same time.
+    """
+    in_flight = 0
+    max_in_flight = 0
+    lock = threading.Lock()
+
+    def slow_fetch(user_id, per_page, priority):
+        nonlocal in_flight, max_in_flight
+        with lock:
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+        time.sleep(0.02)
+        with lock:
+            in_flight -= 1
+        return 0
+
+    users = [{'id': n, 'last_login_time': 0} for n in range(20)]
+    with patch('collector.fetch_and_save_user_data', side_effect=slow_fetch), \
+         patch('database.update_last_sync_time'):
+        asyncio.run(sync_engine.sync_all(users, concurrency=4))
+
+    assert 1 < max_in_flight <= 4
+
+def test_sync_all_against_fake_strava(test_db):
+    """
+    INTEGRATION TEST: Every connected user's paginated history lands in the database,
+    including a user whose token has to be refreshed first.
+    """
+    server = FakeStravaServer(activities_per_user=5).start()
+    try:
+        with patch.object(collector, 'TOKEN_URL', server.url + "/oauth/token"), \
+             patch.object(collector, 'ACTIVITIES_URL', server.url + "/api/v3/athlete/activities"):
+            for name, expires_at in [('fresh', int(time.time()) + 3600), ('expired', 0)]:
+                user_id = database.create_user(name, 'password')
+                database.update_user_tokens(user_id, f"token-{user_id}", f"refresh-{user_id}", expires_at)
+
+            report = asyncio.run(sync_engine.sync_all(database.get_users_with_strava(), concurrency=2, per_page=2))
+    finally:
+        server.stop()
+
+    assert report['totals']['ok'] == 2
+    assert report['totals']['activities_imported'] == 10
+    assert server.requests['token'] == 1
+    assert len(database.get_activities_for_user(1)) == 5
+    assert len(database.get_activities_for_user(2)) == 5
+    assert database.get_user_tokens(2)['strava_access_token'] == "token-2"
@@ -0,0 +1,80 @@
+import sys
+import os
+import pytest
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import sync_worker
+
+
+def test_run_job_records_imported_activities():
+    """
+    UNIT TEST: A successful sync updates the sync time and finishes the job.
+    """
+    job = {'id': 3, 'user_id': 1}
+
+    with patch('collector.fetch_and_save_user_data', return_value=5), \
+         patch('database.update_last_sync_time') as mock_sync_time, \
+         patch('database.finish_sync_job') as mock_finish:
+
+        sync_worker.run_job(job)
+
+        mock_sync_time.assert_called_once_with(1)
+        mock_finish.assert_called_once_with(3, activities_imported=5)
+
+def test_run_job_marks_failed_sync():
+    """
+    UNIT TEST: A failed sync marks the job failed and leaves the sync time alone.
+    """
+    job = {'id': 3, 'user_id': 1}
+
+    with patch('collector.fetch_and_save_user_data', return_value=None), \
+         patch('database.update_last_sync_time') as mock_sync_time, \
+         patch('database.finish_sync_job') as mock_finish:
+
+        sync_worker.run_job(job)
+
+        mock_sync_time.assert_not_called()
+        mock_finish.assert_called_once_with(3, error="Strava sync failed")
+
+def test_run_job_defers_when_budget_exhausted():
+    """
+    UNIT TEST: A sync that runs out of Strava budget goes back in the queue.
+    """
+    job = {'id': 3, 'user_id': 1, 'priority': 'low'}
+
+    with patch('collector.fetch_and_save_user_data', side_effect=sync_worker.collector.RateLimitDeferred(5000)) as mock_fetch, \
+         patch('database.defer_sync_job') as mock_defer, \
+         patch('database.finish_sync_job') as mock_finish:
+
+        sync_worker.run_job(job)
+
+        mock_fetch.assert_called_once_with(1, priority='low')
+        mock_defer.assert_called_once_with(3, 5000)
+        mock_finish.assert_not_called()
+
+def test_run_pending_jobs_drains_queue():
+    """
+    UNIT TEST: Jobs are claimed and run until the queue is empty.
+    """
+    jobs = [{'id': 1, 'user_id': 10}, {'id': 2, 'user_id': 11}, None]
+
+    with patch('database.claim_next_sync_job', side_effect=jobs), \
+         patch('sync_worker.run_job') as mock_run:
+
+        assert sync_worker.run_pending_jobs() == 2
+        assert mock_run.call_count == 2
+
+def test_run_pending_jobs_survives_job_errors():
+    """
+    UNIT TEST: An exception in one job marks it failed and the worker moves on.
+    """
+    jobs = [{'id': 1, 'user_id': 10}, None]
+
+    with patch('database.claim_next_sync_job', side_effect=jobs), \
+         patch('sync_worker.run_job', side_effect=RuntimeError("boom")), \
+         patch('database.finish_sync_job') as mock_finish:
+
+        assert sync_worker.run_pending_jobs() == 1
+        mock_finish.assert_called_once_with(1, error="boom")
@@ -0,0 +1,193 @@
+import sys
+import os
+import time
+import pytest
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import collector
+import database
+import webhooks
+from bench.fake_strava import FakeStravaServer
+from bench.webhook_simulator import activity_event, deauthorization_event
+
+ATHLETE_ID = 7
+ACTIVITY_ID = ATHLETE_ID * 1_000_000 + 3
+
+
+pytestmark = pytest.mark.usefixtures('unlimited_strava_budget', 'empty_token_cache')
+
+
+@pytest.fixture
+def fake_strava(test_db):
+    """A connected user (athlete ATHLETE_ID) and a fake Strava serving their activities."""
+    server = FakeStravaServer(activities_per_user=5).start()
+    with patch.object(collector, 'ACTIVITY_URL', server.url + "/api/v3/activities/{activity_id}"):
+        user_id = database.create_user('runner', 'password')
+        database.save_user_tokens_and_info(user_id, f"token-{ATHLETE_ID}", "refresh", int(time.time()) + 3600, ATHLETE_ID)
+        yield server
+    server.stop()
+
+
+def _deliver(event):
+    with patch.object(webhooks, 'SUBSCRIPTION_ID', str(event['subscription_id'])):
+        assert webhooks.accept_event(event)
+    return webhooks.run_pending_events()
+
+
+def test_verify_subscription_echoes_challenge():
+    """
+    UNIT TEST: The handshake only succeeds with our verify token.
+    """
+    args = {'hub.mode': 'subscribe', 'hub.verify_token': 'secret', 'hub.challenge': 'abc'}
+    with patch.object(webhooks, 'VERIFY_TOKEN', 'secret'):
+        assert webhooks.verify_subscription(args) == 'abc'
+        assert webhooks.verify_subscription({**args, 'hub.verify_token': 'wrong'}) is None
+    with patch.object(webhooks, 'VERIFY_TOKEN', None):
+        assert webhooks.verify_subscription(args) is None
+
+def test_accept_event_rejects_malformed_and_foreign_events():
+    """
+    UNIT TEST: Events missing fields, for another subscription, or with no subscription configured are not queued.
+    """
+    event = activity_event('create', ACTIVITY_ID, ATHLETE_ID, subscription_id=5)
+    with patch('database.enqueue_webhook_event') as mock_enqueue, \
+         patch.object(webhooks, 'SUBSCRIPTION_ID', '5'):
+        assert not webhooks.accept_event({k: v for k, v in event.items() if k != 'owner_id'})
+        assert not webhooks.accept_event({**event, 'subscription_id': 6})
+        assert not webhooks.accept_event([event])
+        assert webhooks.accept_event(event)
+    with patch('database.enqueue_webhook_event') as mock_unconfigured, \
+         patch.object(webhooks, 'SUBSCRIPTION_ID', None):
+        assert not webhooks.accept_event(event)
+    mock_enqueue.assert_called_once_with(event)
+    mock_unconfigured.assert_not_called()
+
+def test_redelivered_event_is_queued_once(test_db):
+    """
+    UNIT TEST: Strava retries unacknowledged events; a retry doesn't queue the event again.
+    """
+    event = activity_event('create', ACTIVITY_ID, ATHLETE_ID, event_time=1000)
+    assert database.enqueue_webhook_event(event)
+    assert not database.enqueue_webhook_event(dict(event))
+
+    claimed = database.claim_next_webhook_event()
+    assert claimed['object_id'] == ACTIVITY_ID
+    assert claimed['updates'] == {}
+    assert database.claim_next_webhook_event() is None
+
+def test_create_event_imports_the_activity(fake_strava):
+    """
+    INTEGRATION TEST: A create event fetches just that activity and saves it.
+    """
+    assert _deliver(activity_event('create', ACTIVITY_ID, ATHLETE_ID)) == 1
+
+    [activity] = database.get_activities_for_user(1)
+    assert activity['activity_id'] == ACTIVITY_ID
+    assert activity['activity_title'] == "Run 3"
+    assert fake_strava.requests['activities'] == 1
+
+def test_update_event_changes_distance_date_and_title(fake_strava):
+    """
+    INTEGRATION TEST: An edited activity moves between days and the rollups follow it.
+    """
+    _deliver(activity_event('create', ACTIVITY_ID, ATHLETE_ID, event_time=1))
+    old_date = database.get_activities_for_user(1)[0]['date']
+    version = database.get_user_context(1)['data_version']
+
+    fake_strava.edits[ACTIVITY_ID] = {'name': "Long run", 'distance': 16093.4, 'start_date_local': "2025-06-08T07:00:00Z"}
+    _deliver(activity_event('update', ACTIVITY_ID, ATHLETE_ID, {'title': "Long run"}, event_time=2))
+
+    [activity] = database.get_activities_for_user(1)
+    assert (activity['date'], activity['activity_title']) == ('2025-06-08', "Long run")
+    assert activity['distance'] == pytest.approx(10.0, abs=0.01)
+    assert database.get_user_context(1)['data_version'] == version + 1
+    assert database.get_weekly_summary(1, '2025-06-02', 1)[0]['longest_run'] == pytest.approx(10.0, abs=0.01)
+    assert database.get_weekly_summary(1, old_date, 1)[0]['total'] == 0
+
+def test_delete_event_removes_the_activity(fake_strava):
+    """
+    INTEGRATION TEST: A delete event removes the activity once Strava confirms it is gone.
+    """
+    _deliver(activity_event('create', ACTIVITY_ID, ATHLETE_ID, event_time=1))
+    fake_strava.deleted.add(ACTIVITY_ID)
+    _deliver(activity_event('delete', ACTIVITY_ID, ATHLETE_ID, event_time=2))
+
+    assert database.get_activities_for_user(1) == []
+    assert fake_strava.requests['activities'] == 2
+    assert database.get_activity_changes(1, 1)['deleted'] == [ACTIVITY_ID]
+
+def test_delete_event_for_activity_strava_still_shows_keeps_it(fake_strava):
+    """
+    INTEGRATION TEST: A delete event (forged, or out of date) doesn't remove an activity Strava still has.
+    """
+    _deliver(activity_event('create', ACTIVITY_ID, ATHLETE_ID, event_time=1))
+    _deliver(activity_event('delete', ACTIVITY_ID, ATHLETE_ID, event_time=2))
+
+    [activity] = database.get_activities_for_user(1)
+    assert activity['activity_id'] == ACTIVITY_ID
+    assert database.get_activity_changes(1, 1)['deleted'] == []
+
+def test_update_for_activity_strava_no_longer_shows_deletes_it(fake_strava):
+    """
+    INTEGRATION TEST: An activity that 404s (deleted or made private) is removed.
+    """
+    _deliver(activity_event('create', ACTIVITY_ID, ATHLETE_ID, event_time=1))
+    fake_strava.deleted.add(ACTIVITY_ID)
+    _deliver(activity_event('update', ACTIVITY_ID, ATHLETE_ID, {'private': 'true'}, event_time=2))
+
+    assert database.get_activities_for_user(1) == []
+
+def test_deauthorization_disconnects_user(fake_strava):
+    """
+    INTEGRATION TEST: Deauthorizing removes the tokens and the imported activities.
+    """
+    _deliver(activity_event('create', ACTIVITY_ID, ATHLETE_ID, event_time=1))
+    _deliver(deauthorization_event(ATHLETE_ID, event_time=2))
+
+    assert not database.user_has_strava(1)
+    assert database.get_user_by_strava_athlete_id(ATHLETE_ID) is None
+    assert database.get_activities_for_user(1) == []
+    assert database.get_activity_changes(1, 1)['deleted'] == [ACTIVITY_ID]
+
+def test_disconnect_in_another_process_drops_cached_token(fake_strava):
+    """
+    INTEGRATION TEST: A token cached here isn't used once another process has disconnected the user.
+    """
+    assert collector.get_valid_access_token(1) == f"token-{ATHLETE_ID}"
+    # As another process would: the revocation is only in the database, not this process's cache
+    database.disconnect_strava(1)
+
+    with patch.object(collector, 'TOKEN_GENERATION_INTERVAL', 0):
+        assert collector.get_cached_tokens(1)['strava_access_token'] is None
+
+def test_event_for_unknown_athlete_is_ignored(fake_strava):
+    """
+    UNIT TEST: Events for athletes who aren't users here don't call Strava.
+    """
+    _deliver(activity_event('create', 99_000_001, 99))
+
+    assert fake_strava.requests['activities'] == 0
+
+def test_event_deferred_when_budget_exhausted(test_db):
+    """
+    UNIT TEST: An event that runs out of Strava budget waits in the queue.
+    """
+    database.enqueue_webhook_event(activity_event('create', ACTIVITY_ID, ATHLETE_ID))
+    with patch('webhooks.handle_event', side_effect=collector.RateLimitDeferred(5000)), \
+         patch('database.defer_webhook_event') as mock_defer:
+        assert webhooks.run_pending_events() == 1
+
+    mock_defer.assert_called_once_with(1, 5000)
+
+def test_failed_event_is_recorded(test_db):
+    """
+    UNIT TEST: An error finishes the event with the error instead of stopping the worker.
+    """
+    database.enqueue_webhook_event(activity_event('create', ACTIVITY_ID, ATHLETE_ID))
+    with patch('webhooks.handle_event', side_effect=RuntimeError("boom")), \
+         patch('database.finish_webhook_event') as mock_finish:
+        webhooks.run_pending_events()
+
+    mock_finish.assert_called_once_with(1, error="boom")
@@ -0,0 +1,186 @@
+"""
+Strava push subscriptions (webhooks).
+
+Strava POSTs an event to /strava/webhook whenever a connected athlete creates,
+updates or deletes an activity, or deauthorizes the app. app.py only stores
+the event (Strava wants a 200 within two seconds); sync_worker.py then runs
+handle_event for each one, fetching and saving just the affected activity.
+
+A subscription is created once per app, pointing at the public callback URL:
+
+    python -m webhooks subscribe --callback-url https://example.com/strava/webhook
+    python -m webhooks list
+    python -m webhooks unsubscribe <subscription_id>
+
+Set STRAVA_WEBHOOK_VERIFY_TOKEN before subscribing (Strava echoes it in the
+verification handshake) and STRAVA_WEBHOOK_SUBSCRIPTION_ID afterwards. Until
+it is set every event is refused; after, events for other subscriptions are
+rejected and dashboard polling backs off.
+
+Anyone can POST to the callback URL, so an event is only a hint: deletes are
+confirmed by fetching the activity, and only removed once Strava no longer
+shows it to us.
+"""
+import argparse
+import json
+import os
+import sys
+from dotenv import load_dotenv
+import database
+import collector
+import metrics
+import strava_http
+
+load_dotenv()
+
+VERIFY_TOKEN = os.getenv("STRAVA_WEBHOOK_VERIFY_TOKEN")
+SUBSCRIPTION_ID = os.getenv("STRAVA_WEBHOOK_SUBSCRIPTION_ID")
+
+EVENT_FIELDS = ('object_type', 'object_id', 'aspect_type', 'owner_id', 'event_time')
+
+
+def push_subscriptions_url():
+    return f"{collector.STRAVA_BASE_URL}/api/v3/push_subscriptions"
+
+
+def enabled():
+    """True once this app has a Strava push subscription configured."""
+    return bool(SUBSCRIPTION_ID)
+
+
+def verify_subscription(args):
+    """
+    Answer Strava's subscription handshake (the query args of GET /strava/webhook).
+    Returns the hub.challenge to echo back, or None if the request isn't ours.
+    """
+    if args.get('hub.mode') != 'subscribe' or not VERIFY_TOKEN:
+        return None
+    if args.get('hub.verify_token') != VERIFY_TOKEN:
+        return None
+    return args.get('hub.challenge')
+
+
+def accept_event(event):
+    """
+    Queue a pushed event for the worker. Returns False if it's malformed, for
+    another subscription, or no subscription is configured; redeliveries of a
+    stored event are accepted.
+    """
+    if not isinstance(event, dict) or any(event.get(field) is None for field in EVENT_FIELDS):
+        return False
+    if not SUBSCRIPTION_ID or str(event.get('subscription_id')) != str(SUBSCRIPTION_ID):
+        return False
+    database.enqueue_webhook_event(event)
+    return True
+
+
+def handle_event(event):
+    """
+    Apply one stored event. Returns what happened ('inserted', 'updated',
+    'unchanged', 'deleted', 'deauthorized' or 'ignored').
+    Raises collector.RateLimitDeferred if the Strava budget is too low.
+    """
+    user = database.get_user_by_strava_athlete_id(event['owner_id'])
+    if user is None:
+        return 'ignored'
+    user_id = user['id']
+
+    if event['object_type'] == 'athlete':
+        if str(event['updates'].get('authorized')).lower() == 'false':
+            database.disconnect_strava(user_id)
+            collector.clear_token_cache(user_id)
+            return 'deauthorized'
+        return 'ignored'
+
+    if event['object_type'] != 'activity':
+        return 'ignored'
+
+    token = collector.get_valid_access_token(user_id)
+    if token is None:
+        raise RuntimeError(f"No Strava tokens for User {user_id}")
+    priority = collector.priority_for_last_login(user.get('last_login_time'))
+    activity = collector.fetch_activity(token, event['object_id'], priority)
+    if activity is None:
+        # Deleted or made private (a delete event is only acted on once Strava agrees)
+        return 'deleted' if database.delete_activity(user_id, event['object_id']) else 'unchanged'
+
+    row = collector.parse_activity(activity)
+    return database.save_activity(user_id, row['date'], row['distance'], row['activity_id'], row['activity_title'])
+
+
+def run_pending_events():
+    """Handle queued events until there are none left. Returns how many ran."""
+    count = 0
+    event = database.claim_next_webhook_event()
+    while event is not None:
+        try:
+            handle_event(event)
+            database.finish_webhook_event(event['id'])
+        except collector.RateLimitDeferred as e:
+            print(f"Deferring webhook event {event['id']} until {e.retry_at}: Strava budget is low")
+            database.defer_webhook_event(event['id'], e.retry_at)
+        except Exception as e:
+            print(f"Webhook event {event['id']} failed: {e}")
+            database.finish_webhook_event(event['id'], error=str(e))
+        count += 1
+        metrics.maybe_flush()
+        event = database.claim_next_webhook_event()
+    return count
+
+
+# SUBSCRIPTION MANAGEMENT
+
+def _client_credentials():
+    return {'client_id': os.getenv('STRAVA_CLIENT_ID'), 'client_secret': os.getenv('STRAVA_CLIENT_SECRET')}
+
+
+def subscribe(callback_url):
+    """Create the app's push subscription. Strava calls callback_url to verify it first."""
+    if not VERIFY_TOKEN:
+        raise ValueError("Set STRAVA_WEBHOOK_VERIFY_TOKEN before subscribing")
+    response = strava_http.post(push_subscriptions_url(), data={
+        **_client_credentials(), 'callback_url': callback_url, 'verify_token': VERIFY_TOKEN,
+    })
+    response.raise_for_status()
+    return response.json()
+
+
+def list_subscriptions():
+    response = strava_http.get(push_subscriptions_url(), params=_client_credentials())
+    response.raise_for_status()
+    return response.json()
+
+
+def unsubscribe(subscription_id):
+    response = strava_http.request("DELETE", f"{push_subscriptions_url()}/{subscription_id}",
+                                   params=_client_credentials())
+    response.raise_for_status()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m webhooks", description="Manage the Strava push subscription.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    subscribe_parser = commands.add_parser('subscribe', help="create the subscription")
+    subscribe_parser.add_argument('--callback-url', required=True)
+    commands.add_parser('list', help="show the current subscription")
+    unsubscribe_parser = commands.add_parser('unsubscribe', help="delete a subscription")
+    unsubscribe_parser.add_argument('subscription_id')
+    args = parser.parse_args(argv)
+
+    try:
+        if args.command == 'subscribe':
+            subscription = subscribe(args.callback_url)
+            print(f"Subscribed; set STRAVA_WEBHOOK_SUBSCRIPTION_ID={subscription['id']}")
+        elif args.command == 'list':
+            print(json.dumps(list_subscriptions(), indent=2))
+        else:
+            unsubscribe(args.subscription_id)
+            print(f"Deleted subscription {args.subscription_id}")
+    except Exception as e:
+        print(f"Error: {e}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())